@@ -111,7 +111,9 @@ def csvs_to_tbl(args: argparse.Namespace) -> List[Tuple[str, str, int, str]]:
                     continue
                 fname = fname[:-3]
                 if fname in fnames:
-                    recs.append(tuple((car_url, fname, int(tsize), cid)))
+                    # "-" is a size the html listing only showed rounded
+                    tsize = int(tsize) if tsize.isdigit() else None
+                    recs.append(tuple((car_url, fname, tsize, cid)))
                     valid_fnames += 1
                 else:
                     invalid_fnames += 1
@@ -8,16 +8,28 @@
 # trove-to-ipfs/bin/add_file_cids_pg.py
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import json
 import logging
+import os
 from pathlib import Path
 import tomllib as toml
-from typing import List, NamedTuple
+from typing import List, NamedTuple, Tuple
 
 # --- these are not part of the std library
 import psycopg  # noqa: E402
 from psycopg import sql
 
+try:  # optional, parses the big dag json files several times faster
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# --- in this repo
+import unixfs
+
 global logger
 DEBUG = True
 
@@ -49,6 +61,15 @@ def getargs() -> argparse.Namespace:
         help="Path to dir of json files from ipfs dag get",
         default=f"{YOURTMPPATH}/car-did-json",
     )
+    parser.add_argument(
+        "-b",
+        "--bulk",
+        help="parse json in parallel, COPY to a staging table, one UPDATE",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="(bulk) json parsing processes", default=4, type=int
+    )
     parser.add_argument(
         "-o", "--outputdir", help="directory to write results", default="output/"
     )
@@ -135,6 +156,135 @@ def prox_1_car_cid(args: argparse.Namespace, car_cid: str):
     logger.info(f"processed {len(recs)} json / {chgd} rows for car_cid={car_cid}")
 
 
+def parse_json_rows(jpath: str) -> Tuple[str, bool, int, list]:
+    """(jpath, sharded, n skipped links, rows of (car_url, fname, tsize,
+    file_cid)). Links whose names don't end in .gz aren't trove files;
+    they're counted, not loaded. A HAMT-sharded root's links are named by
+    bucket ("FF" for a sub-shard, "A3name.msg.gz" for a file), and its top
+    node doesn't list every file anyway, so none of them are loaded:
+    resolve_dir.py walks the whole shard. Runs in a worker process."""
+    car_cid = Path(jpath).stem
+    car_url = f"https://w3s.link/ipfs/{car_cid}"
+    with open(jpath, "rb") as f:
+        js = json_loads(f.read())
+    links = js.get("Links", [])
+    if unixfs.dag_json_unixfs(js)["type"] == unixfs.UNIXFS_HAMT_SHARD:
+        return jpath, True, len(links), []
+    rows = []
+    skipped = 0
+    for r in links:
+        if not r["Name"].endswith(".gz"):
+            skipped += 1
+            continue
+        rows.append((car_url, r["Name"][:-3], r["Tsize"], r["Hash"]["/"]))
+    return jpath, False, skipped, rows
+
+
+def ensure_ledger(args: argparse.Namespace) -> None:
+    create_q = """
+        CREATE TABLE IF NOT EXISTS ingest_ledger (
+            source TEXT,
+            jfile TEXT,
+            fsize BIGINT,
+            mtime DOUBLE PRECISION,
+            nrows INTEGER,
+            ingested_tm TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (source, jfile)) ; """
+    with args.conn.cursor() as cur:
+        cur.execute(create_q)
+
+
+def unprocessed_jsons(args: argparse.Namespace, cids: set, source: str) -> list:
+    """json files for these cids that aren't in the ledger with the same
+    size and mtime, i.e., new or re-downloaded since the last run"""
+    with args.conn.cursor() as cur:
+        cur.execute(
+            "SELECT jfile, fsize, mtime FROM ingest_ledger WHERE source = %s",
+            (source,),
+        )
+        done = {r.jfile: (r.fsize, r.mtime) for r in cur.fetchall()}
+    todo = []
+    for cid in cids:
+        jpath = f"{args.tmpdir}/{cid}.json"
+        try:
+            st = os.stat(jpath)
+        except FileNotFoundError:
+            continue
+        if st.st_size < 5:
+            continue
+        if done.get(Path(jpath).name) == (st.st_size, st.st_mtime):
+            continue
+        todo.append(jpath)
+    logger.info(f"{len(todo)} json files to ingest, {len(done)} in ledger")
+    return todo
+
+
+def bulk_ingest(
+    args: argparse.Namespace, jpaths: list, source: str = "dag-json"
+) -> int:
+    """parse jpaths in a process pool, stream their rows into one COPY, then
+    apply them with one joined UPDATE and record the files in the ledger,
+    all in one transaction"""
+    create_q = """
+        CREATE TEMP TABLE toupd (
+            car_url VARCHAR(128),
+            fname TEXT,
+            tsize INTEGER,
+            file_cid VARCHAR(60)) ON COMMIT DROP ; """
+    copy_q = "COPY toupd (car_url, fname, tsize, file_cid) FROM STDIN"
+    update_q = """
+        UPDATE fs f
+        SET file_cid = t.file_cid,
+            tsize = t.tsize
+        FROM toupd t
+        WHERE f.car_url = t.car_url
+        AND f.fname = t.fname ; """
+    ledger_q = """
+        INSERT INTO ingest_ledger (source, jfile, fsize, mtime, nrows)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (source, jfile) DO UPDATE
+        SET fsize = EXCLUDED.fsize, mtime = EXCLUDED.mtime,
+            nrows = EXCLUDED.nrows, ingested_tm = now() ; """
+
+    nrows = nskipped = 0
+    ledger = []
+    sharded = []
+    with args.conn.transaction():
+        with args.conn.cursor() as cur:
+            cur.execute(create_q)
+            with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+                with cur.copy(copy_q) as copy:
+                    for jpath, shard, skipped, rows in pool.map(
+                        parse_json_rows, jpaths, chunksize=16
+                    ):
+                        nskipped += skipped
+                        if shard:  # not in the ledger until it's resolved
+                            sharded.append(Path(jpath).stem)
+                            continue
+                        for row in rows:
+                            copy.write_row(row)
+                        nrows += len(rows)
+                        st = os.stat(jpath)
+                        jfile = Path(jpath).name
+                        ledger.append(
+                            (source, jfile, st.st_size, st.st_mtime, len(rows))
+                        )
+            logger.info(
+                f"copied {nrows} rows from {len(jpaths)} json files, "
+                f"skipped {nskipped} links"
+            )
+            if sharded:
+                logger.warning(
+                    f"{len(sharded)} sharded cars need resolve_dir.py: "
+                    f"{' '.join(sharded)}"
+                )
+            cur.execute(update_q)
+            chgd = cur.rowcount
+            cur.executemany(ledger_q, ledger)
+    logger.info(f"updated {chgd} rows in fs, {nrows - chgd} rows unmatched")
+    return chgd
+
+
 if __name__ == "__main__":
     args = getargs()
     logger = getlogger(args)
@@ -163,8 +313,12 @@ if __name__ == "__main__":
     cids = set([c[len(hdr) :] for c in car_urls])  # trim hdr
     logger.info(f"{len(cids)} cids found with null tsize, will be processed")
 
-    for car_cid in cids:
-        prox_1_car_cid(args, car_cid)
+    if args.bulk:
+        ensure_ledger(args)
+        bulk_ingest(args, unprocessed_jsons(args, cids, "dag-json"))
+    else:
+        for car_cid in cids:
+            prox_1_car_cid(args, car_cid)
 
     args.conn.close()
 
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-10
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/bench-carpack.py
+
+"""time the in-process packer against `npx ipfs-car pack` on the same
+directory, and check that the root CIDs are identical. The synthetic cardir
+has one file over 175MiB, so the file layout's width is checked too."""
+
+import argparse
+from functools import partial
+import gzip
+import os
+from pathlib import Path
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+# --- in this repo
+import unixfs
+
+sr = partial(subprocess.run, text=True, capture_output=True)
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="benchmark car packers")
+    parser.add_argument(
+        "-d",
+        "--cardir",
+        help="directory of .gz files to pack (default: make a synthetic one)",
+        default=None,
+    )
+    parser.add_argument(
+        "-n", "--nfiles", help="files in the synthetic cardir", default=2000, type=int
+    )
+    parser.add_argument(
+        "-s",
+        "--meansize",
+        help="mean file size (bytes) in the synthetic cardir",
+        default=70_000,
+        type=int,
+    )
+    parser.add_argument(
+        "-b",
+        "--bigfile",
+        help="MiB of one more file in the synthetic cardir, 0 for none",
+        default=200,
+        type=int,
+    )
+    parser.add_argument(
+        "--skip-npx", help="only time the python packer", action="store_true"
+    )
+    parser.add_argument(
+        "-t", "--tmproot", help="where to write the cars", default="/var/tmp"
+    )
+    return parser.parse_args()
+
+
+def synthetic_cardir(tmproot: str, nfiles: int, meansize: int, bigfile: int) -> Path:
+    cardir = Path(tempfile.mkdtemp(dir=tmproot))
+    rng = random.Random(1)
+    for i in range(nfiles):
+        size = int(rng.expovariate(1 / meansize))
+        body = rng.randbytes(size // 2) + bytes(size - size // 2)
+        with gzip.open(cardir / f"{i:07d}.msg.gz", "wb") as f:
+            f.write(body)
+    if bigfile:  # random bytes, so the .gz is as big: > 174 chunks
+        with gzip.open(cardir / "big.msg.gz", "wb", compresslevel=1) as f:
+            for _ in range(bigfile):
+                f.write(rng.randbytes(1024 * 1024))
+    return cardir
+
+
+def time_python(cardir: Path, carpth: Path) -> tuple:
+    start = time.perf_counter()
+    car_cid, filecids = unixfs.pack_dir(cardir, carpth)
+    return car_cid, time.perf_counter() - start
+
+
+def time_npx(cardir: Path, carpth: Path) -> tuple:
+    start = time.perf_counter()
+    result = sr(["npx", "ipfs-car", "pack", cardir, "--output", carpth])
+    assert result.returncode == 0, result.stderr
+    return result.stderr.strip(), time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    args = getargs()
+    made = args.cardir is None
+    if made:
+        cardir = synthetic_cardir(
+            args.tmproot, args.nfiles, args.meansize, args.bigfile
+        )
+    else:
+        cardir = Path(args.cardir)
+    files = os.listdir(cardir)
+    mb = sum(os.path.getsize(cardir / f) for f in files) / (1024 * 1024)
+    print(f"{cardir}: {len(files)} files, {mb:.1f}MB")
+
+    results = {}
+    packers = [("python", time_python)]
+    if not args.skip_npx:
+        packers.append(("npx", time_npx))
+    for name, packer in packers:
+        carpth = Path(f"{cardir}.{name}.car")
+        car_cid, secs = packer(cardir, carpth)
+        results[name] = car_cid
+        carmb = carpth.stat().st_size / (1024 * 1024)
+        print(
+            f"{name:>6}: {secs:7.2f}s {mb / secs:7.1f}MB/s car={carmb:.1f}MB {car_cid}"
+        )
+        carpth.unlink()
+
+    if len(results) > 1:
+        same = len(set(results.values())) == 1
+        print("root CIDs match" if same else "ROOT CIDs DIFFER")
+    if made:
+        shutil.rmtree(cardir)
+
+# done.
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-12
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/bench-compress.py
+
+"""compare the old serial `writelines` gzip loop from cp_files_tmp with
+compress.gzip_files on a synthetic set of small files"""
+
+import argparse
+from functools import partial
+import gzip
+from pathlib import Path
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+# --- in this repo
+import compress
+
+sr = partial(subprocess.run, text=True, capture_output=True)
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="benchmark gzip stage")
+    parser.add_argument("-n", "--nfiles", default=5000, type=int)
+    parser.add_argument("-s", "--meansize", default=70_000, type=int)
+    parser.add_argument(
+        "-w", "--workers", help="comma-separated worker counts", default="1,4,8"
+    )
+    parser.add_argument("-l", "--level", default=compress.GZIP_LEVEL, type=int)
+    parser.add_argument("-t", "--tmproot", default="/var/tmp")
+    return parser.parse_args()
+
+
+def synthetic_files(srcdir: Path, nfiles: int, meansize: int) -> list:
+    # roughly text-like: compressible but not trivially so
+    rng = random.Random(1)
+    words = [rng.randbytes(rng.randint(2, 9)).hex().encode() for _ in range(4000)]
+    files = []
+    for i in range(nfiles):
+        size = max(200, int(rng.expovariate(1 / meansize)))
+        body = b" ".join(rng.choices(words, k=size // 10))[:size]
+        p = srcdir / f"{i:07d}.msg"
+        p.write_bytes(body)
+        files.append(p)
+    return files
+
+
+def serial_writelines(files: list, cardir: Path) -> None:
+    """the loop cp_files_tmp used to run"""
+    for f in files:
+        with open(f, "rb") as f_in:
+            with gzip.open(cardir / f"{f.name}.gz", "wb") as f_out:
+                f_out.writelines(f_in)
+
+
+def timed(label: str, fn, mb: float) -> None:
+    start = time.perf_counter()
+    fn()
+    secs = time.perf_counter() - start
+    print(f"{label:>20}: {secs:7.2f}s {mb / secs:7.1f}MB/s")
+
+
+if __name__ == "__main__":
+    args = getargs()
+    root = Path(tempfile.mkdtemp(dir=args.tmproot))
+    srcdir = root / "src"
+    srcdir.mkdir()
+    files = synthetic_files(srcdir, args.nfiles, args.meansize)
+    mb = sum(f.stat().st_size for f in files) / (1024 * 1024)
+    print(f"{len(files)} files, {mb:.1f}MB")
+
+    def fresh(name: str) -> Path:
+        cardir = root / name
+        cardir.mkdir()
+        return cardir
+
+    timed("serial writelines", partial(serial_writelines, files, fresh("old")), mb)
+    for kind in ("thread", "process"):
+        for w in map(int, args.workers.split(",")):
+            name = f"{kind}-{w}"
+            run = partial(
+                compress.gzip_files, files, fresh(name), w, args.level, kind
+            )
+            timed(name, run, mb)
+
+    # the new output has to pass the same check the README relies on
+    outs = sorted((root / name).glob("*.gz"))[:200]
+    result = sr(["gzip", "-t", *map(str, outs)])
+    print("gzip -t OK" if result.returncode == 0 else f"gzip -t FAIL {result}")
+    shutil.rmtree(root)
+
+# done.
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-04
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/bench-e2e.py
+
+"""car-to-ipfs.py end to end, offline: carblocks/hour, MB/s, and where the
+time goes, without Storacha, a gateway, or the USB disks.
+
+  - a synthetic trove under the workdir: lognormal sizes (like the real
+    one, mostly small with a long tail), text-like content that gzips
+    about as well as the .msg files, and some exact duplicates;
+  - a throwaway postgres cluster (initdb + pg_ctl, on its own port, gone
+    afterwards) with an fs table for the trove, cut into carblocks by
+    cumulative size like gen-carblock-id.py;
+  - stand-in-w3.py and stand-in-ipfs.py on the PATH as `w3` and `ipfs`,
+    and stand-in-gateway.py serving what was "uploaded", each with its own
+    latency and failure rate;
+  - --workers copies of car-to-ipfs.py run until every carblock is done.
+
+The per-stage numbers come from carblock_stage_timings (stage_timing.py).
+Results go to a json file; with --baseline a run slower than an earlier
+one by more than --tolerance exits 1, so a regression in the pack/upload
+path can fail a check. initdb won't run as root."""
+
+import argparse
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import random
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+# --- these are not part of the std library
+import psycopg  # noqa: E402
+
+logger = logging.getLogger("main")
+BINDIR = Path(__file__).resolve().parent
+MB = 1024 * 1024
+WORDS = (
+    b"the of and to in is for on with that this from message subject re fw "
+    b"date sent received attached report meeting please regards thanks "
+    b"case file record list name number office department 2010 2011 2012 "
+).split()
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="car-to-ipfs.py end to end")
+    parser.add_argument(
+        "-d", "--workdir", help="(default: a new dir in /var/tmp, removed after)"
+    )
+    parser.add_argument("--keep", help="keep the workdir", action="store_true")
+    parser.add_argument(
+        "-n", "--files", help="files in the trove", default=5000, type=int
+    )
+    parser.add_argument(
+        "--median-size", help="median file size, bytes", default=40_000, type=int
+    )
+    parser.add_argument(
+        "--sigma", help="lognormal sigma of file sizes", default=1.5, type=float
+    )
+    parser.add_argument("--max-size", help="largest file", default=50 * MB, type=int)
+    parser.add_argument(
+        "--dup-rate",
+        help="fraction of files that copy another",
+        default=0.02,
+        type=float,
+    )
+    parser.add_argument(
+        "--disks", help="top-level dirs the trove is spread over", default=2, type=int
+    )
+    parser.add_argument(
+        "--carblock-mb", help="source MB per carblock", default=50, type=int
+    )
+    parser.add_argument(
+        "-j", "--workers", help="car-to-ipfs.py processes", default=2, type=int
+    )
+    parser.add_argument(
+        "--c2i-args",
+        help='more car-to-ipfs.py arguments, e.g. "--daemon --stream"',
+        default="",
+    )
+    parser.add_argument("--w3-latency", default=0.5, type=float)
+    parser.add_argument(
+        "--w3-mbps", help="simulated upload MB/s (0: no limit)", default=20, type=float
+    )
+    parser.add_argument("--w3-fail-rate", default=0.05, type=float)
+    parser.add_argument("--gw-latency", default=0.05, type=float)
+    parser.add_argument("--gw-fail-rate", default=0.0, type=float)
+    parser.add_argument("--gw-port", default=8089, type=int)
+    parser.add_argument("--pg-port", default=54329, type=int)
+    parser.add_argument(
+        "--timeout",
+        help="give up on the run after this many seconds",
+        default=3600,
+        type=int,
+    )
+    parser.add_argument("--seed", default=1, type=int)
+    parser.add_argument("--label", help="name for this run in the results")
+    parser.add_argument(
+        "-o", "--results", help="where to write the json", default="bench-e2e.json"
+    )
+    parser.add_argument("--baseline", help="an earlier run's json to compare to")
+    parser.add_argument(
+        "--tolerance",
+        help="fraction slower than the baseline that counts as a regression",
+        default=0.15,
+        type=float,
+    )
+    return parser.parse_args()
+
+
+def file_sizes(args: argparse.Namespace, rng: random.Random) -> list:
+    mu = math.log(args.median_size)
+    return [
+        max(1, min(args.max_size, int(rng.lognormvariate(mu, args.sigma))))
+        for _ in range(args.files)
+    ]
+
+
+def make_trove(args: argparse.Namespace, trove: Path) -> list:
+    """write the files; returns (pth, fname, fsize) rows for fs"""
+    rng = random.Random(args.seed)
+    # one pool of text and random bytes (attachments) that gzips to about
+    # 0.7, like the real carblocks (500MB -> 350MB); every file is a slice
+    # of it after its own header, so files differ
+    pool = bytearray()
+    while len(pool) < 8 * MB:
+        pool += b" ".join(rng.choices(WORDS, k=4096)) + b"\n"
+        pool += rng.randbytes(32 * 1024)
+    pool = bytes(pool)
+    rows = []
+    written = []
+    for i, size in enumerate(file_sizes(args, rng)):
+        pth = trove / f"disk{i % args.disks}" / f"d{i // 1000:04d}"
+        pth.mkdir(parents=True, exist_ok=True)
+        fname = f"{i:08d}.msg"
+        if written and rng.random() < args.dup_rate:
+            shutil.copyfile(rng.choice(written), pth / fname)
+        else:
+            with open(pth / fname, "wb") as f:
+                head = f"Message-ID: <{i}.{rng.getrandbits(64)}@bench>\n".encode()
+                f.write(head)
+                left = max(0, size - len(head))
+                while left > 0:
+                    start = rng.randrange(len(pool) - 1)
+                    piece = pool[start : start + min(left, MB)]
+                    f.write(piece)
+                    left -= len(piece)
+        written.append(pth / fname)
+        rows.append((str(pth), fname, (pth / fname).stat().st_size))
+    nbytes = sum(r[2] for r in rows)
+    logger.info(f"trove: {len(rows)} files, {nbytes / MB:.1f}MB in {trove}")
+    return rows
+
+
+def pg_bindir() -> Path:
+    found = shutil.which("initdb")
+    if found:
+        return Path(found).parent
+    versions = sorted(Path("/usr/lib/postgresql").glob("*/bin/initdb"))
+    if not versions:
+        sys.exit("no initdb on the PATH or in /usr/lib/postgresql")
+    return versions[-1].parent
+
+
+def start_postgres(args: argparse.Namespace, workdir: Path) -> Path:
+    """a new cluster with trust auth on its own port; returns the data dir"""
+    pgbin = pg_bindir()
+    pgdata = workdir / "pgdata"
+    subprocess.run(
+        [pgbin / "initdb", "-D", pgdata, "-A", "trust", "-U", "bench"],
+        check=True,
+        capture_output=True,
+    )
+    opts = f"-p {args.pg_port} -k {workdir} -c fsync=off"
+    pg_ctl = [pgbin / "pg_ctl", "-D", pgdata, "-o", opts, "-l", workdir / "pg.log"]
+    subprocess.run(pg_ctl + ["-w", "start"], check=True, capture_output=True)
+    createdb = [pgbin / "createdb", "-h", "localhost", "-p", str(args.pg_port)]
+    subprocess.run(
+        createdb + ["-U", "bench", "pescados"], check=True, capture_output=True
+    )
+    return pgdata
+
+
+def stop_postgres(pgdata: Path) -> None:
+    subprocess.run(
+        [pg_bindir() / "pg_ctl", "-D", pgdata, "-m", "immediate", "stop"],
+        capture_output=True,
+    )
+
+
+def pg_connect(args: argparse.Namespace) -> psycopg.Connection:
+    return psycopg.connect(
+        host="localhost",
+        port=args.pg_port,
+        user="bench",
+        dbname="pescados",
+        row_factory=psycopg.rows.namedtuple_row,
+    )
+
+
+def load_fs(args: argparse.Namespace, rows: list) -> int:
+    """the fs table for the trove, with carblocks; returns how many"""
+    create_q = """
+        CREATE TABLE fs (
+            pth TEXT, fname TEXT, fsize BIGINT, carblock INT,
+            blocked_tm TIMESTAMPTZ, uploaded_tm TIMESTAMPTZ,
+            car_url VARCHAR(128), file_cid VARCHAR(60), tsize INTEGER,
+            PRIMARY KEY (pth, fname)) ;"""
+    carblock_q = """
+        UPDATE fs SET carblock = c.carblock
+        FROM (
+            SELECT pth, fname,
+                (sum(fsize) OVER (ORDER BY pth, fname) / %s)::int AS carblock
+            FROM fs) c
+        WHERE (fs.pth, fs.fname) = (c.pth, c.fname) ;"""
+    with pg_connect(args) as conn:
+        with conn.cursor() as cur:
+            cur.execute(create_q)
+            with cur.copy("COPY fs (pth, fname, fsize) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(row)
+            cur.execute(carblock_q, (args.carblock_mb * MB,))
+            cur.execute("CREATE INDEX fs_carblock ON fs (carblock)")
+            cur.execute("ANALYZE fs")
+            cur.execute("SELECT count(DISTINCT carblock) AS n FROM fs")
+            n = cur.fetchone().n
+        conn.commit()
+    logger.info(f"fs: {len(rows)} rows in {n} carblocks")
+    return n
+
+
+def write_creds(args: argparse.Namespace, workdir: Path) -> tuple:
+    pgcreds = workdir / "psql.toml"
+    pgcreds.write_text(
+        f'user = "bench"\npassword = ""\ndbname = "pescados"\n'
+        f'host = "localhost"\nport = {args.pg_port}\n'
+    )
+    w3creds = workdir / "w3.toml"
+    w3creds.write_text(
+        'w3email = "bench@example.org"\nspace_did = "did:key:z6MkSpace"\n'
+        'user_did = "did:key:z6MkStandIn"\n'
+    )
+    return pgcreds, w3creds
+
+
+def stand_ins(args: argparse.Namespace, workdir: Path) -> dict:
+    """`w3` and `ipfs` on a PATH of their own; returns the env for them"""
+    stubdir = workdir / "stubs"
+    stubdir.mkdir()
+    for name in ("w3", "ipfs"):
+        stub = stubdir / name
+        stub.write_text(
+            f'#!/bin/sh\nexec {sys.executable} {BINDIR}/stand-in-{name}.py "$@"\n'
+        )
+        stub.chmod(0o755)
+    gateway = f"http://127.0.0.1:{args.gw_port}"
+    env = dict(os.environ)
+    env.update(
+        PATH=f"{stubdir}:{env['PATH']}",
+        PYTHONPATH=str(BINDIR),
+        W3_STANDIN_CARDIR=str(workdir / "uploaded"),
+        W3_STANDIN_GATEWAY=gateway,
+        W3_STANDIN_DID="did:key:z6MkStandIn",
+        W3_STANDIN_LATENCY=str(args.w3_latency),
+        W3_STANDIN_MBPS=str(args.w3_mbps),
+        W3_STANDIN_FAIL_RATE=str(args.w3_fail_rate),
+        IPFS_STANDIN_GATEWAY=gateway,
+    )
+    return env
+
+
+def wait_for_table(args: argparse.Namespace, table: str, proc) -> None:
+    with pg_connect(args) as conn:
+        while proc.poll() is None:
+            if conn.execute("SELECT to_regclass(%s) AS t", (table,)).fetchone().t:
+                break
+            time.sleep(0.2)
+
+
+def run_workers(args, workdir: Path, env: dict, pgcreds, w3creds) -> float:
+    """the car-to-ipfs.py processes, until they're all done; returns secs"""
+    outdir = workdir / "output"
+    outdir.mkdir()
+    cmd = [sys.executable, str(BINDIR / "car-to-ipfs.py")]
+    cmd += ["-c", str(pgcreds), "-w", str(w3creds), "-o", str(outdir)]
+    cmd += ["--gateway", env["W3_STANDIN_GATEWAY"], "--prom-dir", str(outdir)]
+    cmd += shlex.split(args.c2i_args)
+    start = time.perf_counter()
+    procs = []
+    for i in range(args.workers):
+        log = open(outdir / f"worker-{i}.out", "wb")
+        procs.append(subprocess.Popen(cmd, env=env, stdout=log, stderr=log))
+        if i == 0:
+            # the first one creates the tables, two at once could collide
+            wait_for_table(args, "carblock_stage_timings", procs[0])
+    deadline = time.monotonic() + args.timeout
+    for p in procs:
+        try:
+            p.wait(timeout=max(1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            logger.error(f"worker {p.pid} still running after {args.timeout}s")
+            p.send_signal(signal.SIGINT)
+            p.wait()
+        if p.returncode:
+            logger.warning(f"worker {p.pid} exited {p.returncode}, see {outdir}")
+    return time.perf_counter() - start
+
+
+def collect(args: argparse.Namespace, wall: float) -> dict:
+    totals_q = """
+        SELECT
+            (SELECT count(*) FROM carblock_lease WHERE state = 'done') AS done,
+            (SELECT count(*) FROM carblock_lease WHERE state <> 'done') AS not_done,
+            count(*) FILTER (WHERE car_url IS NOT NULL) AS files,
+            count(*) AS files_all,
+            coalesce(sum(fsize) FILTER (WHERE car_url IS NOT NULL), 0)::float8
+                AS bytes
+        FROM fs"""
+    stages_q = """
+        SELECT stage, count(*) AS n,
+            count(*) FILTER (WHERE NOT ok) AS failed,
+            sum(secs) AS secs,
+            avg(secs) AS avg_secs,
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY secs) AS p50_secs,
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY secs) AS p95_secs,
+            sum(bytes_in)::float8 AS bytes_in,
+            sum(bytes_out)::float8 AS bytes_out,
+            sum(retries) AS retries
+        FROM carblock_stage_timings
+        GROUP BY stage ORDER BY sum(secs) DESC"""
+    with pg_connect(args) as conn:
+        t = conn.execute(totals_q).fetchone()
+        stages = {
+            r.stage: {k: v for k, v in r._asdict().items() if k != "stage"}
+            for r in conn.execute(stages_q).fetchall()
+        }
+    for s in stages.values():
+        s["mb_per_s"] = s["bytes_in"] / MB / s["secs"] if s["secs"] else None
+    return {
+        "label": args.label,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {
+            k: v for k, v in vars(args).items() if k not in ("results", "baseline")
+        },
+        "wall_secs": wall,
+        "carblocks": t.done,
+        "carblocks_not_done": t.not_done,
+        "files": t.files,
+        "files_not_uploaded": t.files_all - t.files,
+        "mb": t.bytes / MB,
+        "carblocks_per_hour": t.done / wall * 3600,
+        "mb_per_s": t.bytes / MB / wall,
+        "stages": stages,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """what got slower than the baseline by more than tolerance"""
+    worse = []
+    for k in ("carblocks_per_hour", "mb_per_s"):
+        if results[k] < baseline[k] * (1 - tolerance):
+            worse.append(f"{k}: {results[k]:.2f}, was {baseline[k]:.2f}")
+    for stage, s in results["stages"].items():
+        old = baseline["stages"].get(stage)
+        if old and s["avg_secs"] > old["avg_secs"] * (1 + tolerance):
+            worse.append(
+                f"{stage} avg: {s['avg_secs']:.2f}s, was {old['avg_secs']:.2f}s"
+            )
+    return worse
+
+
+def report(results: dict) -> None:
+    logger.info(
+        f"{results['carblocks']} carblocks ({results['carblocks_not_done']} not "
+        f"done), {results['files']} files, {results['mb']:.1f}MB in "
+        f"{results['wall_secs']:.1f}s: {results['carblocks_per_hour']:.1f} "
+        f"carblocks/hour, {results['mb_per_s']:.2f}MB/s"
+    )
+    for stage, s in results["stages"].items():
+        logger.info(
+            f"{stage:>10}: {s['n']:4d} runs, {s['failed']} failed, "
+            f"{s['secs']:8.1f}s total, avg {s['avg_secs']:6.2f}s, "
+            f"p95 {s['p95_secs']:6.2f}s, {s['retries']} retries"
+        )
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    if args.workdir is None:
+        workdir = Path(tempfile.mkdtemp(dir="/var/tmp", prefix="bench-e2e-"))
+    else:
+        workdir = Path(args.workdir)
+        workdir.mkdir(parents=True)
+    (workdir / "uploaded").mkdir()
+    pgdata = gateway = None
+    try:
+        rows = make_trove(args, workdir / "trove")
+        pgdata = start_postgres(args, workdir)
+        load_fs(args, rows)
+        pgcreds, w3creds = write_creds(args, workdir)
+        env = stand_ins(args, workdir)
+        gwcmd = [sys.executable, str(BINDIR / "stand-in-gateway.py")]
+        gwcmd += ["-d", str(workdir / "uploaded"), "-p", str(args.gw_port)]
+        gwcmd += ["--latency", str(args.gw_latency)]
+        gwcmd += ["--fail-rate", str(args.gw_fail_rate)]
+        gateway = subprocess.Popen(gwcmd, env=env, stderr=subprocess.DEVNULL)
+        wall = run_workers(args, workdir, env, pgcreds, w3creds)
+        results = collect(args, wall)
+    finally:
+        if gateway is not None:
+            gateway.terminate()
+        if pgdata is not None:
+            stop_postgres(pgdata)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report(results)
+    with open(args.results, "wt") as f:
+        json.dump(results, f, indent=2, default=str)
+    logger.info(f"results in {args.results}")
+    if args.baseline:
+        with open(args.baseline, "rt") as f:
+            worse = compare(results, json.load(f), args.tolerance)
+        for w in worse:
+            logger.error(f"regression: {w}")
+        sys.exit(1 if worse else 0)
+
+# done.
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-17
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/bench-writeback.py
+
+"""rows/s of the per-file executemany write-back against the COPY + joined
+UPDATE in car-to-ipfs.py. Runs against a TEMP table named fs, which hides
+the real fs for this session only, so nothing real is touched."""
+
+import argparse
+import importlib.util
+import logging
+from pathlib import Path
+import time
+from types import SimpleNamespace
+
+logger = logging.getLogger("main")
+
+
+def load_car_to_ipfs():
+    pth = Path(__file__).with_name("car-to-ipfs.py")
+    spec = importlib.util.spec_from_file_location("car_to_ipfs", pth)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    mod.logger = logger
+    return mod
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="benchmark db write-back")
+    parser.add_argument(
+        "-c",
+        "--creds",
+        help="Path to the postgres credentials file",
+        default=f"{str(Path.home())}/creds/psql.toml",
+    )
+    parser.add_argument(
+        "-r", "--rows", help="rows in the fake fs", default=500_000, type=int
+    )
+    parser.add_argument(
+        "-f", "--files", help="files per carblock", default=5000, type=int
+    )
+    parser.add_argument(
+        "-n", "--carblocks", help="carblocks to time", default=3, type=int
+    )
+    return parser.parse_args()
+
+
+def make_fake_fs(conn, rows: int, per_carblock: int) -> None:
+    create_q = """
+        CREATE TEMP TABLE fs (
+            pth TEXT, fname TEXT, fsize BIGINT, carblock INT,
+            blocked_tm TIMESTAMPTZ, uploaded_tm TIMESTAMPTZ,
+            car_url VARCHAR(128), car_path TEXT, file_cid VARCHAR(60),
+            tsize INTEGER) ;"""
+    fill_q = """
+        INSERT INTO fs (pth, fname, fsize, carblock, blocked_tm)
+        SELECT '/media/usb' || (i / 1000)::text, i::text || '.msg', 70000,
+            i / %s, now()
+        FROM generate_series(0, %s - 1) i ;"""
+    with conn.cursor() as cur:
+        cur.execute(create_q)
+        cur.execute(fill_q, (per_carblock, rows))
+        cur.execute("CREATE INDEX ON fs (pth, fname)")
+        cur.execute("CREATE INDEX ON fs (carblock)")
+        cur.execute("ANALYZE fs")
+    conn.commit()
+
+
+def ftuples_for(conn, carblock: int) -> list:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pth, fname FROM fs WHERE carblock = %s", (carblock,))
+        return [(r.pth, r.fname) for r in cur.fetchall()]
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(level=logging.WARNING)
+    c2i = load_car_to_ipfs()
+    conn = c2i.pg_connect(args.creds)
+    make_fake_fs(conn, args.rows, args.files)
+    run = SimpleNamespace(conn=conn, debug_limit=None, layout="flat")
+    c2i.ensure_fs_columns(run)  # whatever's been added to fs since
+
+    def filecids(ftuples):
+        return {f: ("bafkrei" + "a" * 52, 2000) for _, f in ftuples}
+
+    def carpaths(ftuples):
+        return {f: f"{f}.gz" for _, f in ftuples}
+
+    methods = {
+        "rowwise": lambda cb, ft: c2i.update_url_in_db_rowwise(
+            run, ft, f"https://w3s.link/ipfs/{cb}", filecids(ft)
+        ),
+        "copy+join": lambda cb, ft: c2i.update_url_in_db(
+            run,
+            cb,
+            ft,
+            f"https://w3s.link/ipfs/{cb}",
+            filecids(ft),
+            carpaths(ft),
+            fence=False,
+        ),
+        "by carblock": lambda cb, ft: c2i.update_url_in_db(
+            run,
+            cb,
+            ft,
+            f"https://w3s.link/ipfs/{cb}",
+            None,
+            carpaths(ft),
+            fence=False,
+        ),
+    }
+    carblock = 0
+    for name, method in methods.items():  # each once, before any timing
+        ftuples = ftuples_for(conn, carblock)
+        nrows = method(carblock, ftuples)
+        assert nrows == len(ftuples), f"{name}: {nrows} of {len(ftuples)} rows"
+        carblock += 1
+    for name, method in methods.items():
+        nrows, secs = 0, 0.0
+        for _ in range(args.carblocks):
+            ftuples = ftuples_for(conn, carblock)
+            start = time.perf_counter()
+            nrows += method(carblock, ftuples)
+            secs += time.perf_counter() - start
+            carblock += 1
+        print(f"{name:>12}: {nrows} rows in {secs:6.2f}s, {nrows / secs:9.0f} rows/s")
+    conn.close()
+
+# done.
@@ -11,40 +11,66 @@ import argparse
 from functools import partial
 import filecmp
 import gzip
+import io
 import logging
 from pathlib import Path
-from operator import itemgetter
 import os
+import queue
 import random
 import signal
 import subprocess
 import tempfile
+import threading
 import time
 import tomllib as toml
 import shutil
+from types import SimpleNamespace
 from typing import Tuple
 
 # --- these are not part of the std library
 import psycopg  # noqa: E402
 import requests
 
+# --- in this repo
+import carblocks
+import compress
+import journal
+import leases
+import preflight
+import scratch
+import stage_timing
+import unixfs
+import upload_control
+import verify_car
+
 global logger
 DEBUG = True
 sr = partial(subprocess.run, text=True, capture_output=True)
 
 
+STOP = threading.Event()
+
+
 def signal_handler(sig, frame):
-    raise AssertionError("SIGINT caught")
+    """first ^C: finish what's in flight and stop; second: give up now"""
+    if STOP.is_set():
+        raise AssertionError("SIGINT caught")
+    STOP.set()
+    logger.warning("SIGINT caught, finishing in-flight carblocks (^C again to abort)")
 
 
-# from perplexity.ai
-def get_dir_size_no_recursion(path: Path | str) -> float:
-    bytes = sum(
-        os.path.getsize(os.path.join(path, f))
-        for f in os.listdir(path)
-        if os.path.isfile(os.path.join(path, f))
+def pg_connect(credsfile: str, **kwargs) -> psycopg.Connection:
+    with open(credsfile, "rb") as f:
+        creds = toml.load(f)
+    return psycopg.connect(
+        host=creds.get("host", "localhost"),
+        user=creds["user"],
+        password=creds["password"],
+        row_factory=psycopg.rows.namedtuple_row,
+        dbname=creds["dbname"],
+        port=creds.get("port", 5432),
+        **kwargs,
     )
-    return round((bytes / (1024 * 1024.0)), 1)
 
 
 def getargs() -> argparse.Namespace:
@@ -72,6 +98,26 @@ def getargs() -> argparse.Namespace:
         default=1,
         type=float,
     )
+    parser.add_argument(
+        "--verify",
+        help=(
+            "cid: check every file's CID in the car before upload, and fetch "
+            "a sample back by CID; download: the old one-file byte compare"
+        ),
+        choices=["cid", "download"],
+        default="cid",
+    )
+    parser.add_argument(
+        "--verify-sample",
+        help="(cid) files fetched back from a checked carblock",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--gateway",
+        help="(cid) where the sample is fetched from",
+        default="https://w3s.link",
+    )
     parser.add_argument(
         "-l",
         "--debug_limit",
@@ -79,25 +125,185 @@ def getargs() -> argparse.Namespace:
         default=None,
         type=int,
     )
+    parser.add_argument(
+        "-p",
+        "--packer",
+        help="build the car in-process (python) or with `npx ipfs-car pack` (npx)",
+        choices=["python", "npx"],
+        default="python",
+    )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        help="gzip straight into the car, without staging the .gz files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-d",
+        "--daemon",
+        help="one long-running process: build, upload and record in a pipeline",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--inflight",
+        help="(daemon) max carblocks claimed but not yet recorded",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--build-workers",
+        help="(daemon) carblocks compressed+packed at once",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--upload-workers",
+        help="(daemon) carblocks uploaded at once (with --adaptive, at most)",
+        default=2,
+        type=int,
+    )
+    parser.add_argument(
+        "--adaptive",
+        help="(daemon) set the uploads at once from throughput and failures",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-upload-mbps",
+        help="pace uploads to average under this many MB/s (0: no cap)",
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "--upload-retries",
+        help="retries after a failed w3 up (so 3 tries in all by default), "
+        "with jittered exponential backoff",
+        default=2,
+        type=int,
+    )
+    parser.add_argument(
+        "--upload-backoff",
+        help="seconds before the first retry, doubling after",
+        default=10.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--compress-workers",
+        help="how many files to gzip at once",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--compress-pool",
+        help="run the gzip workers as threads or processes",
+        choices=["thread", "process"],
+        default="thread",
+    )
+    parser.add_argument(
+        "--gzip-level",
+        help="gzip compression level [1-9]",
+        default=compress.GZIP_LEVEL,
+        type=int,
+    )
+    parser.add_argument(
+        "--layout",
+        help="files at the root of the car (flat) or in hash-prefix subdirs (nested)",
+        choices=["flat", "nested"],
+        default="flat",
+    )
+    parser.add_argument(
+        "--max-dir-entries",
+        help="(nested) most entries in any one directory inside the car",
+        default=500,
+        type=int,
+    )
+    parser.add_argument(
+        "--dedup",
+        help="upload one copy of each content_hash (from hash_files.py)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--preflight-workers",
+        help="files probed at once before a carblock is packed",
+        default=16,
+        type=int,
+    )
+    parser.add_argument(
+        "--preflight-retries",
+        help="retries, with backoff, of a file that raises OSError",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--max-repairs",
+        help="quarantines before a file is given up on",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--repair",
+        help="first gather quarantined files into a repair carblock",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--prom-dir",
+        help="write per-stage totals to {dir}/trove-to-ipfs_{worker}.prom",
+    )
+    parser.add_argument(
+        "--profile",
+        help="profile each stage: cProfile stats into outputdir, or peak memory",
+        choices=stage_timing.PROFILERS,
+        default="none",
+    )
+    parser.add_argument(
+        "--scratch",
+        help="where carblocks are built, PATH[:SIZE] (e.g. /dev/shm:16G); repeat "
+        "for more than one (default /var/tmp)",
+        action="append",
+        dest="scratch_roots",
+    )
+    parser.add_argument(
+        "--scratch-reserve",
+        help="free space left alone on each scratch root without a SIZE",
+        default="5G",
+    )
+    parser.add_argument(
+        "--journal-dir",
+        help="where each carblock's finished stages are journaled, to resume",
+        default="/var/tmp/trove-journal",
+    )
+    parser.add_argument(
+        "--lease-secs",
+        help="how long a claim on a carblock lasts without a heartbeat",
+        default=900,
+        type=int,
+    )
     parser.add_argument(
         "-o", "--outputdir", help="directory to write results", default="output/"
     )
     args = parser.parse_args()
     assert Path(args.outputdir).exists()
+    assert 1 <= args.gzip_level <= 9
+    assert not (args.stream and args.packer == "npx"), "--stream needs python packer"
     print(args)
 
-    with open(args.creds, "rb") as f:
-        creds = toml.load(f)
-    conn = psycopg.connect(
-        host="localhost",
-        user=creds["user"],
-        password=creds["password"],
-        row_factory=psycopg.rows.namedtuple_row,
-        dbname=creds["dbname"],
-        port=5432,
+    setattr(args, "conn", pg_connect(args.creds))
+    setattr(args, "worker", leases.worker_id())
+    prom = None
+    if args.prom_dir is not None:
+        promname = f"trove-to-ipfs_{args.worker.replace(':', '_')}.prom"
+        prom = stage_timing.PromFile(Path(args.prom_dir) / promname, args.worker)
+    setattr(args, "prom", prom)
+    uploads = upload_control.UploadController(
+        args.upload_workers if args.daemon else 1,
+        adaptive=args.adaptive and args.daemon,
+        max_mbps=args.max_upload_mbps,
+        retries=args.upload_retries,
+        backoff=args.upload_backoff,
     )
-    setattr(args, "conn", conn)
-    del creds
+    setattr(args, "uploads", uploads)
+    roots = args.scratch_roots or ["/var/tmp"]
+    reserve = scratch.parse_size(args.scratch_reserve)
+    setattr(args, "scratch", scratch.Scratch(roots, reserve))
 
     with open(args.w3creds, "rb") as f:
         creds = toml.load(f)
@@ -133,16 +339,15 @@ def getlogger(args: argparse.Namespace) -> logging.Logger:
     return logger
 
 
-def get_carblocks(args: argparse.Namespace) -> list:
-    select_q = """SELECT DISTINCT carblock FROM fs
-        WHERE blocked_tm IS NULL AND
-            uploaded_tm IS NULL;"""
+def ensure_fs_columns(args: argparse.Namespace) -> None:
+    """columns added to fs after the first uploads"""
     with args.conn.cursor() as cur:
-        cur.execute(select_q)
-        # NB: itemgetter is a little more efficient for large lists
-        carblocks = list(map(itemgetter(0), cur.fetchall()))
-    logger.info(f"found {len(carblocks)} carblocks")
-    return carblocks
+        cur.execute("ALTER TABLE fs ADD COLUMN IF NOT EXISTS car_path TEXT;")
+        cur.execute("ALTER TABLE fs ADD COLUMN IF NOT EXISTS content_hash TEXT;")
+        cur.execute(
+            "ALTER TABLE fs ADD COLUMN IF NOT EXISTS deduped BOOLEAN DEFAULT false;"
+        )
+    args.conn.commit()
 
 
 def lock_carblock_files(args: argparse.Namespace, carblock: int) -> bool:
@@ -167,18 +372,27 @@ def lock_carblock_files(args: argparse.Namespace, carblock: int) -> bool:
 def rollback_carblock_lock(
     args: argparse.Namespace, carblock: int, cardir: Path | None
 ) -> bool:
+    """unlock the files and hand the lease back. With DEBUG the staged files
+    are left in place to look at, but the lock is always released. A lease
+    that's been lost is left alone, with the files: they're the new
+    holder's now."""
+    with args.conn.cursor() as cur:
+        if not leases.holds(args.conn, args.worker, carblock, lock=True):
+            args.conn.rollback()
+            logger.error(f"carblock={carblock}: lease lost, not rolled back")
+            return False
+        cur.execute(
+            """
+                    UPDATE fs
+                    SET blocked_tm = NULL
+                    WHERE carblock = %s AND car_url is NULL;
+                    """,
+            (carblock,),
+        )
+        logger.error(f"{cur.rowcount} rows rolled back to NULL time")
+        args.conn.commit()
+    leases.release_carblock(args.conn, args.worker, carblock, "todo")
     if not DEBUG:
-        with args.conn.cursor() as cur:
-            cur.execute(
-                """
-                        UPDATE fs
-                        SET blocked_tm = NULL
-                        WHERE carblock = %s AND car_url is NULL;
-                        """,
-                (carblock,),
-            )
-            logger.error(f"{cur.rowcount} rows rolled back to NULL time")
-            args.conn.commit()
         try:
             shutil.rmtree(str(cardir))
         except FileNotFoundError:  # other errors raised but ignores FileNotFound
@@ -186,62 +400,209 @@ def rollback_carblock_lock(
     return True
 
 
-def get_filenames(
-    args: argparse.Namespace, carblock: int, check: bool = False
-) -> Tuple[list, list]:
+def get_filenames(args: argparse.Namespace, carblock: int) -> Tuple[list, list]:
+    """the files not uploaded yet, but not the ones given up on (preflight.py)"""
     with args.conn.cursor() as cur:
         cur.execute(
-            """
+            f"""
                     SELECT pth,fname,blocked_tm
                     FROM fs
-                    WHERE carblock = %s AND car_url IS NULL;
+                    WHERE carblock = %s AND car_url IS NULL
+                    AND NOT {preflight.GIVEN_UP};
                     """,
             (carblock,),
         )
         fetched = cur.fetchall()
-    # NB if fetched is empty, the next line ends the run
-    logger.debug(f"(carblock={carblock}), first row is {fetched[0]}")
+    if fetched:
+        logger.debug(f"(carblock={carblock}), first row is {fetched[0]}")
     assert all(x.blocked_tm is not None for x in fetched)
     files = [Path(r.pth, r.fname) for r in fetched]
     ftuples = [(r.pth, r.fname) for r in fetched]
     logger.info(
         f"{len(files)} not-uploaded files in carblock={carblock} to be uploaded"
     )
-    if check:
-        for p in files:
-            try:
-                if not p.exists():
-                    logger.warn(
-                        f"{str(p)} does not exist in filesystem, skipping carblock={carblock}"
-                    )
-                    return list(), list()
-            except OSError:
-                logger.warn(
-                    f"{str(p)} raises OSError (disk failure?), skipping carblock={carblock}"
-                )
-                return list(), list()
-        logger.debug(f"all {len(files)} in carblock={carblock} exist in filesystem")
     if args.debug_limit:
         return files[0 : args.debug_limit], ftuples[0 : args.debug_limit]
     else:
         return files, ftuples
 
 
-def cp_files_tmp(files: list, carblock: int) -> Tuple[Path, Path]:
-    tmproot = "/var/tmp"
-    os.makedirs(tmproot, exist_ok=True)
-    cardir = Path(tempfile.mkdtemp(dir=tmproot))
-    for f in files:
-        gzip_name = f"{f.name}.gz"
-        with open(f, "rb") as f_in:
-            with gzip.open(cardir / gzip_name, "wb") as f_out:
-                f_out.writelines(f_in)
+def preflight_carblock(args: argparse.Namespace, job: SimpleNamespace) -> None:
+    """probe the files (preflight.py); the unreadable ones are quarantined and
+    left out, and the rest of the carblock goes up without them"""
+    with job.timings.stage("preflight", files=len(job.files)) as st:
+        good, bad, st.retries = preflight.check_files(
+            job.files, args.preflight_workers, args.preflight_retries
+        )
+    if not bad:
+        logger.debug(f"all {len(good)} in carblock={job.carblock} are readable")
+        return
+    preflight.quarantine(args.conn, job.carblock, bad, args.max_repairs)
+    job.quarantined = {(str(p.parent), p.name) for p, _, _ in bad}
+    keep = [i for i, t in enumerate(job.ftuples) if t not in job.quarantined]
+    job.files = [job.files[i] for i in keep]
+    job.ftuples = [job.ftuples[i] for i in keep]
+
+
+def link_duplicates(args: argparse.Namespace, carblock: int) -> int:
+    """point this carblock's not-uploaded files at an uploaded copy of the
+    same content: its car_url, car_path and file_cid. The copy in IPFS is
+    the other file's .gz, so only the name in the gzip header differs."""
+    link_q = """
+        UPDATE fs d
+        SET car_url = o.car_url,
+            car_path = o.car_path,
+            file_cid = o.file_cid,
+            tsize = o.tsize,
+            uploaded_tm = now(),
+            deduped = true
+        FROM (
+            SELECT DISTINCT ON (content_hash) content_hash, car_url,
+                coalesce(car_path, fname || '.gz') AS car_path, file_cid, tsize
+            FROM fs
+            WHERE car_url IS NOT NULL AND NOT deduped
+            AND content_hash IN (
+                SELECT content_hash FROM fs
+                WHERE carblock = %s AND car_url IS NULL)
+            ORDER BY content_hash, uploaded_tm) o
+        WHERE d.carblock = %s
+        AND d.car_url IS NULL
+        AND d.content_hash = o.content_hash
+        RETURNING d.fsize ;"""
+    with args.conn.cursor() as cur:
+        cur.execute(link_q, (carblock, carblock))
+        sizes = [r.fsize for r in cur.fetchall()]
+    args.conn.commit()
+    if sizes:
+        mb = round(sum(sizes) / (1024 * 1024.0), 1)
+        logger.info(
+            f"(carblock={carblock}) {len(sizes)} duplicate files ({mb}MB) "
+            "linked to copies already uploaded"
+        )
+    return len(sizes)
+
+
+def inblock_duplicates(args: argparse.Namespace, carblock: int, going: set) -> set:
+    """(pth, fname) of the files in going (the ones that passed preflight)
+    that repeat an earlier one of them; they're left out of the car and
+    linked to it after the upload. The copy kept is always going up, so a
+    quarantined file never takes its readable duplicates down with it."""
+    dups_q = """
+        SELECT pth, fname, content_hash FROM fs
+        WHERE carblock = %s AND car_url IS NULL AND content_hash IS NOT NULL
+        ORDER BY content_hash, pth, fname ;"""
+    kept, dups = set(), set()
+    with args.conn.cursor() as cur:
+        cur.execute(dups_q, (carblock,))
+        for r in cur:
+            if (r.pth, r.fname) not in going:
+                continue
+            if r.content_hash in kept:
+                dups.add((r.pth, r.fname))
+            kept.add(r.content_hash)
+    args.conn.commit()
+    return dups
+
+
+def dedup_carblock(args: argparse.Namespace, job: SimpleNamespace) -> bool:
+    """link what's already uploaded. True if nothing is left to upload (the
+    lease is then released done)."""
+    link_duplicates(args, job.carblock)
+    with args.conn.cursor() as cur:
+        cur.execute(
+            f"""SELECT count(*) AS n FROM fs
+            WHERE carblock = %s AND car_url IS NULL AND NOT {preflight.GIVEN_UP}""",
+            (job.carblock,),
+        )
+        remaining = cur.fetchone().n
+    args.conn.commit()
+    if remaining == 0:
+        logger.info(f"carblock={job.carblock}: every file was a duplicate")
+        leases.release_carblock(args.conn, args.worker, job.carblock, "done")
+        job.files, job.ftuples = [], []
+        return True
+    return False
+
+
+def car_paths(args: argparse.Namespace, files: list) -> dict:
+    """fname -> path of its .gz inside the car"""
+    gznames = [f"{f.name}.gz" for f in files]
+    if args.layout == "flat":
+        return {gz[:-3]: gz for gz in gznames}
+    nested = unixfs.nested_paths(gznames, args.max_dir_entries)
+    return {gz[:-3]: path for gz, path in nested.items()}
+
+
+def cp_files_tmp(
+    args: argparse.Namespace, files: list, carblock: int, carpaths: dict, root: Path
+) -> Tuple[Path, Path, Tuple[int, int]]:
+    """gzip the files into a new dir in the scratch root; returns it, the car
+    to pack it into, and (bytes in, bytes out)"""
+    prefix = args.scratch.prefix(carblock)
+    cardir = Path(tempfile.mkdtemp(prefix=prefix, dir=root))
+    nbytes_in, nbytes = compress.gzip_files(
+        files,
+        cardir,
+        workers=args.compress_workers,
+        level=args.gzip_level,
+        kind=args.compress_pool,
+        relpaths=[carpaths[f.name] for f in files],
+    )
     carpth = Path(f"{str(cardir)}.car")
-    mb = get_dir_size_no_recursion(cardir)
+    mb = round(nbytes / (1024 * 1024.0), 1)
     logger.info(
         f"from (carblock={carblock}), {len(files)} files ({mb}MB) copied to {cardir}"
     )
-    return cardir, carpth
+    return cardir, carpth, (nbytes_in, nbytes)
+
+
+def stream_car(
+    args: argparse.Namespace, files: list, carblock: int, carpaths: dict, root: Path
+) -> Tuple[Path, str, dict]:
+    """gzip each file straight into a car in the scratch root. Only the gzip
+    state and one chunk per file are held in memory; nothing else is staged.
+    With --compress-workers > 1, a few whole gzipped files are held while
+    waiting their turn to be written."""
+    prefix = args.scratch.prefix(carblock)
+    fd, carname = tempfile.mkstemp(prefix=prefix, dir=root, suffix=".car")
+    carpth = Path(carname)
+    tree = {}
+    filecids = {}
+    with os.fdopen(fd, "wb") as f_car:
+        car = unixfs.CarWriter(f_car)
+        if args.compress_workers > 1:
+            gzipped = compress.gzip_stream(
+                files, args.compress_workers, args.gzip_level, args.compress_pool
+            )
+        else:
+            gzipped = ((f, None) for f in files)
+        for f, gzbytes in gzipped:
+            builder = unixfs.FileBuilder(car)
+            if gzbytes is not None:
+                builder.write(gzbytes)
+            else:
+                with open(f, "rb") as f_in:
+                    gz = gzip.GzipFile(
+                        filename=f.name,
+                        mode="wb",
+                        compresslevel=args.gzip_level,
+                        fileobj=builder,
+                    )
+                    with gz as f_out:
+                        shutil.copyfileobj(f_in, f_out, compress.BUFSIZE)
+            cid, tsize = builder.close()
+            link = unixfs.Link(f"{f.name}.gz", cid, tsize)
+            unixfs.add_to_tree(tree, carpaths[f.name], link)
+            filecids[f.name] = (unixfs.cid_str(cid), tsize)
+        root_cid, _ = unixfs.put_tree(car, tree)
+        car.close(root_cid)
+    car_cid = unixfs.cid_str(root_cid)
+    mb = round(carpth.stat().st_size / (1024 * 1024.0), 1)
+    logger.info(
+        f"from (carblock={carblock}), {len(files)} files streamed to {carpth} "
+        f"({mb}MB), root={car_cid}"
+    )
+    return carpth, car_cid, filecids
 
 
 def w3setup(args: argparse.Namespace) -> bool:
@@ -259,7 +620,7 @@ def w3setup(args: argparse.Namespace) -> bool:
     return True
 
 
-def pack_car(cardir: Path, carpth: Path) -> str:
+def pack_car_npx(cardir: Path, carpth: Path) -> str:
     result = sr(["npx", "ipfs-car", "pack", cardir, "--output", carpth])
     if result.returncode != 0:
         logger.critical(f"ipfs-car failed {str(result)}")
@@ -269,33 +630,76 @@ def pack_car(cardir: Path, carpth: Path) -> str:
     return result.stderr.strip()
 
 
-def upload_car(carpth: Path, car_cid: str) -> str:
+def pack_car(
+    args: argparse.Namespace, cardir: Path, carpth: Path
+) -> Tuple[str, dict | None]:
+    """returns the car's root CID and, for the python packer, a dict of
+    fname (without .gz) -> (file_cid, tsize)"""
+    if args.packer == "npx":
+        return pack_car_npx(cardir, carpth), None
+    car_cid, filecids = unixfs.pack_dir(cardir, carpth)
+    logger.debug(f"packed {len(filecids)} files to {carpth}, root={car_cid}")
+    return car_cid, {Path(r.name).name[:-3]: (r.hash, r.tsize) for r in filecids}
+
+
+def upload_car(
+    carpth: Path,
+    car_cid: str,
+    ctl: upload_control.UploadController,
+    st: SimpleNamespace = None,
+) -> str:
+    """w3 up, retried with backoff; each try is reported to ctl. The caller
+    holds one of ctl's slots, and holds it again when this returns or
+    raises, but it's given back for the backoff so another upload can use
+    it. With st (a stage record) the retries are kept"""
+    nbytes = carpth.stat().st_size
     attempt = 1
     while True:
-        if attempt > 3:
-            logger.warning(f"w3 up failed {str(result)}, attempt={attempt}")
-            logger.critical("no more attempts, giving up.")
-            raise AssertionError
+        start = time.monotonic()
         result = sr(["w3", "up", "--no-wrap", "--car", carpth])
         if result.returncode == 0:
+            ctl.succeeded(nbytes, time.monotonic() - start)
             break
+        ctl.failed()
         logger.warning(f"w3 up failed {str(result)}, attempt={attempt}")
+        if attempt > ctl.retries:
+            logger.critical("no more attempts, giving up.")
+            raise AssertionError
+        ctl.release()
+        try:
+            time.sleep(ctl.backoff(attempt))
+        finally:
+            ctl.acquire(nbytes)
         attempt += 1
+    if st is not None:
+        st.retries = attempt - 1
     car_url = result.stdout.strip()[2:]
-    if not (car_url.startswith("https://") and car_url.endswith(car_cid)):
+    # http:// is the stand-in w3 (bench-e2e.py)
+    ok_url = car_url.startswith(("https://", "http://"))
+    if not (ok_url and car_url.endswith(car_cid)):
         logger.critical(f"car_url={car_url}, upload FAIL")
         raise AssertionError
     logger.debug(f"w3 up returned {car_url}")
     return car_url
 
 
-def update_url_in_db(ftuples: list, car_url: str) -> int:
+def update_url_in_db_rowwise(
+    args: argparse.Namespace, ftuples: list, car_url: str, filecids: dict | None
+) -> int:
+    """one UPDATE per file; kept for comparison in bench-writeback.py"""
     query = """UPDATE fs
                 SET uploaded_tm = to_timestamp(%s),
-                    car_url = %s
+                    car_url = %s,
+                    file_cid = %s,
+                    tsize = %s
                 WHERE (pth, fname) = (%s, %s)
                 """
-    update_data = [(int(time.time()), car_url, pth, fname) for pth, fname in ftuples]
+    now = int(time.time())
+    filecids = filecids or {}
+    update_data = [
+        (now, car_url, *filecids.get(fname, (None, None)), pth, fname)
+        for pth, fname in ftuples
+    ]
     with args.conn.cursor() as cur:
         cur.executemany(query, update_data)
         rowcount = cur.rowcount
@@ -304,11 +708,96 @@ def update_url_in_db(ftuples: list, car_url: str) -> int:
     return rowcount
 
 
-def test_car(ftuples: list, cardir: Path, carblock: int, car_url: str) -> None:
+def update_url_in_db(
+    args: argparse.Namespace,
+    carblock: int,
+    ftuples: list,
+    car_url: str,
+    filecids: dict | None,
+    carpaths: dict,
+    exact: bool = True,
+    fence: bool = True,
+) -> int:
+    """write the upload back in one transaction with one set-based UPDATE.
+
+    When every not-yet-uploaded file in the carblock went up (exact) and there
+    are no per-file CIDs (npx), the carblock key is exact and nothing is copied.
+    Otherwise the results are COPYed to a temp table and joined, like
+    add_cids_from_csv.merge_csvs_to_fs. filecids comes from the packer; when
+    it's missing, file_cid and tsize stay NULL for add_file_cids_pg.py.
+    car_path is where the file is inside the car: `car_url/car_path`.
+
+    With fence, the transaction first locks this worker's lease on the
+    carblock, and raises LostLease (writing nothing) if it isn't ours."""
+    by_carblock_q = """
+        UPDATE fs
+        SET uploaded_tm = to_timestamp(%s), car_url = %s, car_path = fname || '.gz'
+        WHERE carblock = %s AND car_url IS NULL ;"""
+    create_q = """
+        CREATE TEMP TABLE upload_res (
+            pth TEXT,
+            fname TEXT,
+            car_path TEXT,
+            file_cid VARCHAR(60),
+            tsize INTEGER) ON COMMIT DROP ;"""
+    copy_q = "COPY upload_res (pth, fname, car_path, file_cid, tsize) FROM STDIN"
+    update_q = """
+        UPDATE fs f
+        SET uploaded_tm = to_timestamp(%s),
+            car_url = %s,
+            car_path = u.car_path,
+            file_cid = u.file_cid,
+            tsize = u.tsize
+        FROM upload_res u
+        WHERE f.carblock = %s
+        AND (f.pth, f.fname) = (u.pth, u.fname) ;"""
+    now = int(time.time())
+    with args.conn.cursor() as cur:
+        if fence and not leases.holds(args.conn, args.worker, carblock, lock=True):
+            args.conn.rollback()
+            raise leases.LostLease(f"carblock={carblock}: lease lost, not recorded")
+        by_carblock = exact and not args.debug_limit and args.layout == "flat"
+        if filecids is None and by_carblock:
+            cur.execute(by_carblock_q, (now, car_url, carblock))
+        else:
+            filecids = filecids or {}
+            cur.execute(create_q)
+            with cur.copy(copy_q) as copy:
+                for pth, fname in ftuples:
+                    cid, tsize = filecids.get(fname, (None, None))
+                    copy.write_row((pth, fname, carpaths[fname], cid, tsize))
+            cur.execute(update_q, (now, car_url, carblock))
+        rowcount = cur.rowcount
+    args.conn.commit()
+    unmatched = len(ftuples) - rowcount
+    logger.info(
+        f"updated uploaded_tm, car_url in {rowcount} rows (carblock={carblock}), "
+        f"{unmatched} files unmatched."
+    )
+    return rowcount
+
+
+def test_car(
+    ftuples: list,
+    cardir: Path | None,
+    carblock: int,
+    car_url: str,
+    filecids: dict | None,
+    carpaths: dict,
+) -> None:
     _, testfile = random.choice(ftuples)
-    gzpath = cardir / f"{testfile}.gz"
-    ipfsurl = f"{car_url}/{testfile}.gz"
+    car_path = carpaths[testfile]
+    ipfsurl = f"{car_url}/{car_path}"
     response = requests.get(ipfsurl)
+    if cardir is None:
+        # streamed: nothing staged to compare, so check the CID of the download
+        cid, _ = unixfs.file_cid(io.BytesIO(response.content))
+        if cid != filecids[testfile][0]:
+            logger.critical(f"{car_path} in IPFS has cid={cid}, packed differently")
+            raise AssertionError
+        logger.info(f"chk OK: from carblock={carblock}, {car_path} cid matches")
+        return
+    gzpath = cardir / car_path
     tmp = tempfile.NamedTemporaryFile(delete=False)
     with open(tmp.name, "wb") as f:
         f.write(response.content)
@@ -319,37 +808,453 @@ def test_car(ftuples: list, cardir: Path, carblock: int, car_url: str) -> None:
     logger.info(f"chk OK: from carblock={carblock}, {str(gzpath)} matches upload")
 
 
-def up_one_carblock(args: argparse.Namespace) -> bool:
-    carblocks = get_carblocks(args)
-    carblock = carblocks[0]
-    cardir = None
+def claim_carblock(args: argparse.Namespace) -> SimpleNamespace | None:
+    """lease the next carblock and find its files; None if there's no work"""
+    leases.reap_stale_leases(args.conn)
+    carblock = leases.claim_carblock(
+        args.conn, args.worker, args.lease_secs, journal.pending(args.journal_dir)
+    )
+    if carblock is None:
+        return None
+    logger.info(f"claimed carblock={carblock} as {args.worker}")
+    job = SimpleNamespace(
+        carblock=carblock,
+        cardir=None,
+        carpth=None,
+        car_url=None,
+        filecids=None,
+        listing=None,
+        deferred=set(),
+        quarantined=set(),
+        recorded=False,
+        scratch=None,
+        error=None,
+        timings=stage_timing.Timings(carblock, args.profile, Path(args.outputdir)),
+    )
     try:
-        lock_carblock_files(args, carblock)
-        files, ftuples = get_filenames(args, carblock, check=True)
-        if len(files) == 0:
-            return False
-        cardir, carpth = cp_files_tmp(files, carblock)
-        car_cid = pack_car(cardir, carpth)
-        car_url = upload_car(carpth, car_cid)
-        rowcount = update_url_in_db(ftuples, car_url)
-        assert rowcount == len(files)
-
-        if random.random() <= args.check_fraction:
-            test_car(ftuples, cardir, carblock, car_url)
-        else:
-            logger.info("prob too low, no download test conducted.")
-        # cleanup at shell:
-        # for x in /var/tmp/tmp*.car ; do rm -r ${x%.*}; rm $x; done
-        shutil.rmtree(cardir)
-        carpth.unlink()
-        logger.debug(f"{cardir} removed.")
+        with job.timings.stage("lock"):
+            lock_carblock_files(args, job.carblock)
+        if args.dedup:
+            with job.timings.stage("dedup"):
+                linked_all = dedup_carblock(args, job)
+            if linked_all:
+                carblocks.refresh(args.conn, [job.carblock])
+                record_timings(args, job)
+                return job
+        job.files, job.ftuples = get_filenames(args, job.carblock)
+        if len(job.files) == 0:
+            logger.info(f"carblock={job.carblock}: only given-up files are left")
+            leases.release_carblock(args.conn, args.worker, job.carblock, "done")
+            carblocks.refresh(args.conn, [job.carblock])
+            record_timings(args, job)
+            return job
+        preflight_carblock(args, job)
+        if args.dedup:  # after preflight, so the copy kept is a readable one
+            job.deferred = inblock_duplicates(args, job.carblock, set(job.ftuples))
+        if job.deferred:
+            keep = [i for i, t in enumerate(job.ftuples) if t not in job.deferred]
+            job.files = [job.files[i] for i in keep]
+            job.ftuples = [job.ftuples[i] for i in keep]
+            logger.info(
+                f"carblock={job.carblock}: {len(job.deferred)} in-carblock "
+                "duplicates left out, linked after upload"
+            )
+    except:  # noqa: E722
+        release_carblock(args, job)
+        raise
+    if len(job.files) == 0:
+        # nothing readable: keep blocked_tm as before, but don't hold the lease
+        leases.release_carblock(args.conn, args.worker, carblock, "failed")
+        record_timings(args, job)
+    return job
+
+
+def admit_carblock(
+    args: argparse.Namespace, job: SimpleNamespace, force: bool = False
+) -> bool:
+    """room in a scratch root for the carblock (scratch.py); False if it has
+    to wait for a carblock in flight to finish"""
+    size_q = f"""
+        SELECT coalesce(sum(fsize::bigint), 0) FROM fs
+        WHERE carblock = %s AND car_url IS NULL AND NOT {preflight.GIVEN_UP}"""
+    if getattr(job, "nbytes", None) is None:
+        job.nbytes = args.conn.execute(size_q, (job.carblock,)).fetchone()[0]
+        args.conn.commit()
+    footprint = args.scratch.estimate(job.nbytes, args.stream)
+    job.scratch = args.scratch.admit(job.carblock, footprint, force)
+    return job.scratch is not None
+
+
+def build_recipe(args: argparse.Namespace) -> dict:
+    """the options that change what's in a car"""
+    return {
+        "stream": args.stream,
+        "packer": args.packer,
+        "layout": args.layout,
+        "max_dir_entries": args.max_dir_entries,
+        "gzip_level": args.gzip_level,
+    }
+
+
+def resume_carblock(args: argparse.Namespace, job: SimpleNamespace) -> dict | None:
+    """pick up the stages journaled for this carblock on this host, after
+    checking the car again; None (and the leftovers removed) if they can't
+    be used"""
+    entry = journal.load(args.journal_dir, job.carblock)
+    if entry is None:
+        return None
+    try:
+        if entry.get("files") != [list(t) for t in job.ftuples]:
+            raise ValueError("the carblock's files changed")
+        if entry.get("recipe") != build_recipe(args):
+            raise ValueError("the packing options changed")
+        if journal.done(entry, "packed"):
+            carpth = Path(entry["carpth"])
+            filecids = entry["filecids"]
+            if filecids is not None:
+                filecids = {f: tuple(v) for f, v in filecids.items()}
+            expected = None
+            if filecids is not None:
+                expected = {job.carpaths[f]: cid for f, (cid, _) in filecids.items()}
+            nbytes = carpth.stat().st_size
+            with job.timings.stage("resume", files=len(job.files), bytes_in=nbytes):
+                job.listing = verify_car.verify_local(
+                    carpth, entry["car_cid"], expected, None, args.compress_workers
+                )
+            job.carpth, job.car_cid, job.filecids = carpth, entry["car_cid"], filecids
+            if entry.get("cardir") and Path(entry["cardir"]).is_dir():
+                job.cardir = Path(entry["cardir"])
+        elif journal.done(entry, "staged"):
+            cardir = Path(entry["cardir"])
+            gone = [p for p in job.carpaths.values() if not (cardir / p).is_file()]
+            if gone:
+                raise ValueError(f"{len(gone)} staged files are gone")
+            job.cardir, job.carpth = cardir, Path(entry["carpth"])
+        if journal.done(entry, "uploaded"):
+            job.car_url = entry["car_url"]
+    except (OSError, ValueError, verify_car.VerifyError) as err:
+        logger.warning(
+            f"carblock={job.carblock}: can't resume after {entry.get('stage')} "
+            f"({err!r}), starting over"
+        )
+        journal.discard(args.journal_dir, job.carblock)
+        return None
+    logger.info(f"carblock={job.carblock}: resuming after {entry['stage']}")
+    return entry
+
+
+def build_carblock(args: argparse.Namespace, job: SimpleNamespace) -> None:
+    """compress+pack, no db access (so it's safe in a worker thread). Each
+    stage is journaled, and one journaled by an earlier try is skipped."""
+    job.carpaths = car_paths(args, job.files)
+    nfiles = len(job.files)
+    entry = resume_carblock(args, job)
+    ckpt = partial(journal.checkpoint, args.journal_dir, job.carblock)
+    what = {"files": job.ftuples, "recipe": build_recipe(args)}
+    if journal.done(entry, "packed"):
+        pass
+    elif args.stream:
+        with job.timings.stage("stream", files=nfiles) as st:
+            job.carpth, job.car_cid, job.filecids = stream_car(
+                args, job.files, job.carblock, job.carpaths, job.scratch.root
+            )
+            st.bytes_out = job.carpth.stat().st_size
+        ckpt(
+            "packed",
+            carpth=job.carpth,
+            car_cid=job.car_cid,
+            filecids=job.filecids,
+            **what,
+        )
+    else:
+        if not journal.done(entry, "staged"):
+            with job.timings.stage("compress", files=nfiles) as st:
+                job.cardir, job.carpth, (st.bytes_in, st.bytes_out) = cp_files_tmp(
+                    args, job.files, job.carblock, job.carpaths, job.scratch.root
+                )
+            ckpt("staged", cardir=job.cardir, carpth=job.carpth, **what)
+        with job.timings.stage("pack", files=nfiles) as st:
+            job.car_cid, job.filecids = pack_car(args, job.cardir, job.carpth)
+            st.bytes_out = job.carpth.stat().st_size
+        ckpt("packed", car_cid=job.car_cid, filecids=job.filecids)
+    if args.verify == "cid" and not journal.done(entry, "verified"):
+        with job.timings.stage("verify", files=nfiles) as st:
+            st.bytes_in = job.carpth.stat().st_size
+            try:
+                verify_built(args, job)
+            except verify_car.VerifyError:
+                # a bad car isn't worth keeping for the next try
+                journal.discard(args.journal_dir, job.carblock, artifacts=False)
+                raise
+        ckpt("verified")
+
+
+def upload_stage(args: argparse.Namespace, job: SimpleNamespace) -> None:
+    """w3 up when upload_control gives it a slot, both timed. Skipped when
+    an earlier try got as far as the upload."""
+    if job.car_url is not None:
+        logger.info(f"carblock={job.carblock}: already uploaded to {job.car_url}")
+        return
+    # an upload thread has no share of args.conn, so the check gets its own
+    with pg_connect(args.creds, autocommit=True) as conn:
+        if not leases.holds(conn, args.worker, job.carblock):
+            raise leases.LostLease(f"carblock={job.carblock}: lease lost, not uploaded")
+    nbytes = job.carpth.stat().st_size
+    with job.timings.stage("upload_wait", bytes_in=nbytes):
+        args.uploads.acquire(nbytes)
+    try:
+        nfiles = len(job.files)
+        with job.timings.stage("upload", files=nfiles, bytes_in=nbytes) as st:
+            job.car_url = upload_car(job.carpth, job.car_cid, args.uploads, st)
+    finally:
+        args.uploads.release()
+    journal.checkpoint(args.journal_dir, job.carblock, "uploaded", car_url=job.car_url)
+
+
+def verify_built(args: argparse.Namespace, job: SimpleNamespace) -> None:
+    """every file's CID, checked in the car before it goes up (verify_car.py)"""
+    expected = None
+    if job.filecids is not None:
+        expected = {job.carpaths[f]: cid for f, (cid, _) in job.filecids.items()}
+    job.listing = verify_car.verify_local(
+        job.carpth, job.car_cid, expected, job.cardir, args.compress_workers
+    )
+    logger.info(
+        f"chk OK: carblock={job.carblock}, {len(job.listing)} file CIDs "
+        f"linked from root={job.car_cid}"
+    )
+
+
+def finish_carblock(args: argparse.Namespace, job: SimpleNamespace) -> None:
+    with job.timings.stage("db", files=len(job.files)):
+        rowcount = update_url_in_db(
+            args,
+            job.carblock,
+            job.ftuples,
+            job.car_url,
+            job.filecids,
+            job.carpaths,
+            exact=not (job.deferred or job.quarantined),
+        )
+        assert rowcount == len(job.files)
+        job.recorded = True
+        journal.discard(args.journal_dir, job.carblock, artifacts=False)
+        if job.deferred:
+            link_duplicates(args, job.carblock)
+        preflight.mark_repaired(args.conn, job.carblock)
+        leases.release_carblock(args.conn, args.worker, job.carblock, "done")
+        carblocks.uploaded(args.conn, job.carblock, job.carpth.stat().st_size)
+
+    if random.random() > args.check_fraction:
+        logger.info("prob too low, no download test conducted.")
+    elif args.verify == "cid":
+        with job.timings.stage("check", files=args.verify_sample):
+            n = verify_car.verify_sample(
+                args.gateway, job.car_cid, job.listing, args.verify_sample
+            )
+        logger.info(f"chk OK: carblock={job.carblock}, {n} fetched files match")
+    else:
+        with job.timings.stage("check", files=1):
+            test_car(
+                job.ftuples,
+                job.cardir,
+                job.carblock,
+                job.car_url,
+                job.filecids,
+                job.carpaths,
+            )
+    record_timings(args, job)
+    # a worker that dies before this leaves them to gc_scratch() at startup
+    if job.cardir is not None:
+        shutil.rmtree(job.cardir)
+    job.carpth.unlink()
+    args.scratch.release(job.scratch)
+    logger.debug(f"{job.carpth} removed.")
+    logger.info(f"carblock={job.carblock} uploaded successfully to {job.car_url}")
+
+
+def record_timings(args: argparse.Namespace, job: SimpleNamespace) -> None:
+    """the carblock's stage timings to the db and the Prometheus textfile.
+    A failure here is logged, it never fails the carblock."""
+    try:
+        stage_timing.write_timings(args.conn, args.worker, job.timings)
+        if args.prom is not None:
+            args.prom.add(job.timings)
+    except Exception as err:
+        args.conn.rollback()
+        logger.warning(f"carblock={job.carblock}: timings not recorded: {err!r}")
+
+
+def release_carblock(args: argparse.Namespace, job: SimpleNamespace) -> None:
+    args.scratch.release(job.scratch)
+    if job.recorded:
+        # the upload is in the db, only the check after it failed
+        logger.error(f"carblock={job.carblock} is uploaded but failed its check")
+        record_timings(args, job)
+        return
+    if journal.load(args.journal_dir, job.carblock) is not None:
+        # journaled stages are kept for the next try (journal.py)
+        rollback_carblock_lock(args, job.carblock, None)
+        logger.info(f"carblock={job.carblock}: kept for a resume on this host")
+    else:
+        rollback_carblock_lock(args, job.carblock, job.cardir)
+        if job.carpth is not None and not DEBUG:
+            job.carpth.unlink(missing_ok=True)
+    record_timings(args, job)
+
+
+def gc_scratch(args: argparse.Namespace) -> None:
+    """at startup: forget the journaled carblocks that have been uploaded
+    since (from this host or another), then remove what dead workers left
+    in the scratch roots, keeping what the journal still points at"""
+    done_q = """
+        SELECT carblock FROM carblock_lease
+        WHERE carblock = ANY(%s) AND state = 'done'"""
+    pending = journal.pending(args.journal_dir)
+    if pending:
+        finished = [r[0] for r in args.conn.execute(done_q, (pending,))]
+        args.conn.commit()
+        for carblock in finished:
+            logger.info(f"carblock={carblock} is done, its journal entry removed")
+            journal.discard(args.journal_dir, carblock)
+    keep = []
+    for carblock in journal.pending(args.journal_dir):
+        entry = journal.load(args.journal_dir, carblock) or {}
+        keep += [entry[k] for k in ("cardir", "carpth") if entry.get(k)]
+    args.scratch.gc(keep)
+    args.scratch.set_budgets()
+
+
+def up_one_carblock(args: argparse.Namespace) -> bool | None:
+    """True if uploaded, False if skipped, None if there's nothing left"""
+    job = claim_carblock(args)
+    if job is None:
+        return None
+    if len(job.files) == 0:
+        return False
+    try:
+        admit_carblock(args, job, force=True)
+        build_carblock(args, job)
+        upload_stage(args, job)
+        finish_carblock(args, job)
     except:  # noqa: E722
-        rollback_carblock_lock(args, carblock, cardir)
+        release_carblock(args, job)
         raise
-    logger.info(f"carblock={carblock} uploaded successfully to {car_url}, done.")
     return True
 
 
+def stage_worker(name: str, fn, inq: queue.Queue, outq: queue.Queue) -> None:
+    """take jobs from inq, run fn(job), pass them on. Failures are passed on
+    too (with job.error set) so the main thread can roll them back."""
+    while True:
+        job = inq.get()
+        if job is None:
+            break
+        if job.error is None:
+            try:
+                fn(job)
+            except Exception as err:
+                logger.error(f"{name} failed for carblock={job.carblock}: {err!r}")
+                job.error = err
+        outq.put(job)
+
+
+def run_daemon(args: argparse.Namespace, run_n: int) -> int:
+    """claim -> build -> upload -> record, with carblock N+1 built while N
+    uploads. Only the main thread uses args.conn, so one connection and one
+    w3 login are shared by every stage; an upload thread checks its lease
+    on a short connection of its own. Returns carblocks done."""
+    most = max(args.inflight, args.upload_workers + args.build_workers)
+    buildq = queue.Queue(maxsize=most)
+    uploadq = queue.Queue(maxsize=most)
+    doneq = queue.Queue()
+
+    def inflight() -> int:
+        """enough claimed to keep every upload slot and builder busy"""
+        return max(args.inflight, args.uploads.limit + args.build_workers)
+
+    threads = [
+        threading.Thread(
+            target=stage_worker,
+            args=("build", partial(build_carblock, args), buildq, uploadq),
+            daemon=True,
+        )
+        for _ in range(args.build_workers)
+    ]
+    threads += [
+        threading.Thread(
+            target=stage_worker,
+            args=("upload", partial(upload_stage, args), uploadq, doneq),
+            daemon=True,
+        )
+        for _ in range(args.upload_workers)
+    ]
+    for t in threads:
+        t.start()
+
+    active = {}  # carblock -> job, claimed but not yet recorded
+    waiting = None  # claimed, but there's no scratch space for it yet
+    claimed = done = failed = 0
+    exhausted = False
+    try:
+        while True:
+            while not STOP.is_set() and len(active) < inflight():
+                if waiting is None:
+                    if exhausted or claimed >= run_n:
+                        exhausted = True
+                        break
+                    job = claim_carblock(args)
+                    if job is None:
+                        logger.info("no more carblocks to claim")
+                        exhausted = True
+                        break
+                    claimed += 1
+                    if len(job.files) == 0:
+                        continue
+                    waiting = job
+                # with nothing in flight, nothing would ever make room
+                if not admit_carblock(args, waiting, force=not active):
+                    break
+                active[waiting.carblock] = waiting
+                buildq.put(waiting)
+                waiting = None
+            if not active:
+                break
+            try:
+                job = doneq.get(timeout=1)
+            except queue.Empty:
+                continue
+            if job.error is None:
+                try:
+                    finish_carblock(args, job)
+                    done += 1
+                    del active[job.carblock]
+                    continue
+                except Exception as err:
+                    job.error = err
+            failed += 1
+            logger.error(f"carblock={job.carblock} failed: {job.error!r}, rollback")
+            release_carblock(args, job)
+            del active[job.carblock]
+    except:  # noqa: E722
+        for job in active.values():
+            release_carblock(args, job)
+        raise
+    finally:
+        if waiting is not None:
+            release_carblock(args, waiting)
+
+    # the build workers have drained, so these sentinels end them in order
+    for _ in range(args.build_workers):
+        buildq.put(None)
+    for _ in range(args.upload_workers):
+        uploadq.put(None)
+    for t in threads:
+        t.join()
+    logger.info(f"daemon stopping: {done} carblocks done, {failed} failed")
+    return done
+
+
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
     args = getargs()
@@ -357,9 +1262,27 @@ if __name__ == "__main__":
     if args.num_carblocks < 1:
         logger.warning("no num_carblocks set, will run until there are no more.")
     w3setup(args)
+    leases.ensure_lease_table(args.conn)
+    ensure_fs_columns(args)
+    if carblocks.ensure_table(args.conn):
+        carblocks.refresh(args.conn)
+    preflight.ensure_quarantine_table(args.conn)
+    stage_timing.ensure_timings_table(args.conn)
+    if args.repair:
+        preflight.make_repair_carblock(args.conn)
+    gc_scratch(args)
+    heartbeat = leases.Heartbeat(
+        partial(pg_connect, args.creds), args.worker, args.lease_secs
+    )
+    heartbeat.start()
 
     run_n = args.num_carblocks if args.num_carblocks >= 1 else 10000
-    for i in range(run_n):
-        up_one_carblock(args)
+    if args.daemon:
+        run_daemon(args, run_n)
+    else:
+        for i in range(run_n):
+            if STOP.is_set() or up_one_carblock(args) is None:
+                break
+    heartbeat.stop()
 
 # done.
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-08
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/carblocks.py
+
+"""one row per carblock, and the indexes fs needs.
+
+fs has ~5M rows and until now no indexes but the ones a script happened to
+make (gen-carblock-id.py --mode pandas rewrites the table and drops them
+all). Every lookup by carblock, by car_url, and every "what's still
+missing" was a full scan.
+
+  migrate   build fs's indexes (CONCURRENTLY, so workers can keep going),
+            bring carblock_lease in line with fs, and fill carblock_stats
+  refresh   recompute carblock_stats from fs
+  status    carblocks, files and bytes by state
+
+carblock_stats holds what's otherwise a GROUP BY over fs: files and
+bytes, how many are uploaded and have CIDs, the car(s) they went up in,
+and when. Which carblocks there are, and their state ('todo', 'claimed',
+'done', 'failed'), is only ever in carblock_lease (leases.py), which is
+what workers claim from. carblock is a view of the two: each carblock in
+carblock_lease, with its state and worker, and its stats if it has them.
+
+car-to-ipfs.py refreshes a carblock's stats when it records the upload,
+preflight.py when it makes a repair carblock, gen-carblock-id.py (with
+migrate) after numbering, reconcile_cids.py after a merge. After anything
+else that writes fs (add_file_cids_pg.py, add_cids_from_csv.py, psql),
+run refresh."""
+
+import argparse
+import logging
+from pathlib import Path
+import tomllib as toml
+from typing import List
+
+# --- these are not part of the std library
+import psycopg  # noqa: E402
+
+# --- in this repo
+import leases
+
+logger = logging.getLogger("main")
+
+# name -> definition; the partial ones are what the workers and the
+# recovery scripts ask for, and they stay small as the upload goes on
+FS_INDEXES = {
+    "fs_pth_fname": "fs (pth, fname)",
+    "fs_carblock": "fs (carblock)",
+    "fs_carblock_todo": "fs (carblock) WHERE car_url IS NULL",
+    "fs_no_carblock": "fs (pth, fname) WHERE carblock IS NULL",
+    "fs_car_url": "fs (car_url, fname)",
+    "fs_no_tsize": "fs (car_url) WHERE tsize IS NULL",
+    "fs_no_file_cid": "fs (car_url) WHERE file_cid IS NULL",
+}
+
+
+def pg_connect(credsfile: str, **kwargs) -> psycopg.Connection:
+    with open(credsfile, "rb") as f:
+        creds = toml.load(f)
+    return psycopg.connect(
+        host=creds.get("host", "localhost"),
+        user=creds["user"],
+        password=creds["password"],
+        row_factory=psycopg.rows.namedtuple_row,
+        dbname=creds["dbname"],
+        port=creds.get("port", 5432),
+        **kwargs,
+    )
+
+
+def ensure_indexes(conn: psycopg.Connection) -> int:
+    """CREATE INDEX CONCURRENTLY each missing (or invalid, from a build that
+    was interrupted) fs index; conn must be autocommit. Returns how many."""
+    assert conn.autocommit, "CREATE INDEX CONCURRENTLY needs autocommit"
+    invalid_q = """
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE NOT i.indisvalid AND c.relname = ANY(%s)"""
+    invalid = [r[0] for r in conn.execute(invalid_q, (list(FS_INDEXES),))]
+    for name in invalid:
+        logger.warning(f"{name} is invalid (an interrupted build?), rebuilding")
+        conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    made = 0
+    for name, definition in FS_INDEXES.items():
+        exists = conn.execute("SELECT to_regclass(%s)", (name,)).fetchone()[0]
+        if exists is None:
+            logger.info(f"creating {name} ON {definition}")
+            conn.execute(f"CREATE INDEX CONCURRENTLY {name} ON {definition}")
+            made += 1
+    conn.execute("ANALYZE fs")
+    return made
+
+
+def ensure_table(conn: psycopg.Connection) -> bool:
+    """carblock_stats and the carblock view. A carblock table from before
+    the view, with its own copy of the state, becomes carblock_stats.
+    True if carblock_stats was just created (and so is empty)"""
+    create_q = """
+        CREATE TABLE IF NOT EXISTS carblock_stats (
+            carblock INT PRIMARY KEY,
+            nfiles INT,
+            nbytes BIGINT,
+            nuploaded INT,
+            nbytes_uploaded BIGINT,
+            ncids INT,
+            ncars INT,
+            car_cid TEXT,
+            car_url TEXT,
+            car_bytes BIGINT,
+            first_uploaded_tm TIMESTAMPTZ,
+            last_uploaded_tm TIMESTAMPTZ,
+            refreshed_tm TIMESTAMPTZ DEFAULT now()) ;"""
+    view_q = """
+        CREATE OR REPLACE VIEW carblock AS
+        SELECT l.carblock, l.state, l.worker, l.lease_until,
+            s.nfiles, s.nbytes, s.nuploaded, s.nbytes_uploaded, s.ncids,
+            s.ncars, s.car_cid, s.car_url, s.car_bytes, s.first_uploaded_tm,
+            s.last_uploaded_tm, s.refreshed_tm
+        FROM carblock_lease l
+        LEFT JOIN carblock_stats s USING (carblock) ;"""
+    leases.ensure_lease_schema(conn)
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname, c.relkind FROM pg_class c
+            WHERE c.relname IN ('carblock', 'carblock_stats')
+            AND pg_table_is_visible(c.oid)""")
+        kinds = dict(cur.fetchall())
+        if kinds.get("carblock") == "r" and "carblock_stats" not in kinds:
+            logger.info("carblock table becomes carblock_stats, without state")
+            cur.execute("ALTER TABLE carblock RENAME TO carblock_stats")
+            cur.execute("ALTER TABLE carblock_stats DROP COLUMN state")
+            kinds["carblock_stats"] = "r"
+        created = "carblock_stats" not in kinds
+        cur.execute(create_q)
+        cur.execute(view_q)
+    conn.commit()
+    return created
+
+
+def refresh(conn: psycopg.Connection, carblocks: List[int] | None = None) -> int:
+    """recompute the stats of these carblocks (all of them with None) from
+    fs; car_bytes, which fs doesn't know, is kept. Returns rows written."""
+    where, cwhere, params = "carblock IS NOT NULL", "true", ()
+    if carblocks is not None:
+        where, cwhere = "carblock = ANY(%s)", "c.carblock = ANY(%s)"
+        params = (list(carblocks),)
+    upsert_q = f"""
+        INSERT INTO carblock_stats (carblock, nfiles, nbytes, nuploaded,
+            nbytes_uploaded, ncids, ncars, car_url, car_cid,
+            first_uploaded_tm, last_uploaded_tm, refreshed_tm)
+        SELECT carblock,
+            count(*),
+            sum(fsize::bigint),
+            count(car_url),
+            coalesce(sum(fsize::bigint) FILTER (WHERE car_url IS NOT NULL), 0),
+            count(file_cid),
+            count(DISTINCT car_url),
+            (array_agg(car_url ORDER BY uploaded_tm DESC)
+                FILTER (WHERE car_url IS NOT NULL))[1],
+            regexp_replace((array_agg(car_url ORDER BY uploaded_tm DESC)
+                FILTER (WHERE car_url IS NOT NULL))[1], '^.*/', ''),
+            min(uploaded_tm),
+            max(uploaded_tm),
+            now()
+        FROM fs WHERE {where}
+        GROUP BY carblock
+        ON CONFLICT (carblock) DO UPDATE SET
+            nfiles = EXCLUDED.nfiles,
+            nbytes = EXCLUDED.nbytes,
+            nuploaded = EXCLUDED.nuploaded,
+            nbytes_uploaded = EXCLUDED.nbytes_uploaded,
+            ncids = EXCLUDED.ncids,
+            ncars = EXCLUDED.ncars,
+            car_url = EXCLUDED.car_url,
+            car_cid = EXCLUDED.car_cid,
+            first_uploaded_tm = EXCLUDED.first_uploaded_tm,
+            last_uploaded_tm = EXCLUDED.last_uploaded_tm,
+            refreshed_tm = EXCLUDED.refreshed_tm ;"""
+    # carblocks that no longer have any files (renumbered, or all repaired)
+    gone_q = f"""
+        DELETE FROM carblock_stats c
+        WHERE {cwhere}
+        AND NOT EXISTS (SELECT 1 FROM fs WHERE fs.carblock = c.carblock) ;"""
+    with conn.cursor() as cur:
+        cur.execute(upsert_q, params)
+        n = cur.rowcount
+        cur.execute(gone_q, params)
+        gone = cur.rowcount
+    conn.commit()
+    if carblocks is None or gone:
+        logger.info(f"carblock_stats: {n} rows refreshed, {gone} removed")
+    return n
+
+
+def uploaded(conn: psycopg.Connection, carblock: int, car_bytes: int) -> None:
+    """refresh a carblock just recorded, with the size of its car"""
+    refresh(conn, [carblock])
+    conn.execute(
+        "UPDATE carblock_stats SET car_bytes = %s WHERE carblock = %s",
+        (car_bytes, carblock),
+    )
+    conn.commit()
+
+
+def status(conn: psycopg.Connection) -> list:
+    status_q = """
+        SELECT state, count(*) AS carblocks, sum(nfiles) AS files,
+            sum(nuploaded) AS uploaded, sum(nfiles - ncids) AS no_cid,
+            round(sum(nbytes) / 1024.0^3, 1) AS gb
+        FROM carblock GROUP BY state ORDER BY state"""
+    rows = conn.execute(status_q).fetchall()
+    for r in rows:
+        logger.info(
+            f"{r.state:>8}: {r.carblocks} carblocks, {r.files} files "
+            f"({r.uploaded} uploaded, {r.no_cid} without a CID), {r.gb}GB"
+        )
+    return rows
+
+
+def migrate(conn: psycopg.Connection) -> None:
+    """indexes, leases, stats; conn must be autocommit"""
+    ensure_indexes(conn)
+    leases.ensure_lease_table(conn)
+    ensure_table(conn)
+    refresh(conn)
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="carblock stats and fs indexes")
+    credsfile = f"{str(Path.home())}/creds/psql.toml"
+    parser.add_argument(
+        "-c", "--creds", help="Path to the postgres credentials file", default=credsfile
+    )
+    parser.add_argument("command", choices=["migrate", "refresh", "status"])
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    with pg_connect(args.creds, autocommit=True) as conn:
+        if args.command == "migrate":
+            migrate(conn)
+        elif args.command == "refresh":
+            ensure_table(conn)
+            refresh(conn)
+        status(conn)
+
+# done.
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-12
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/compress.py
+
+"""the gzip stage for car-to-ipfs.py, run on a pool of workers.
+
+zlib releases the GIL, so threads are usually enough; a process pool is
+there for when they aren't. Outputs are ordinary `name.gz` files (or the
+same bytes in memory), so `gzip -t` and the existing naming still work."""
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+import gzip
+import io
+from pathlib import Path
+import shutil
+from typing import Iterator, List, Tuple
+
+BUFSIZE = 1024 * 1024
+GZIP_LEVEL = 9  # what gzip.open uses when not told otherwise
+
+
+def gzip_file(src: Path, dst: Path, level: int = GZIP_LEVEL) -> Tuple[int, int]:
+    """gzip src to dst in BUFSIZE reads, returns (bytes in, bytes out)"""
+    with open(src, "rb") as f_in:
+        with gzip.open(dst, "wb", compresslevel=level) as f_out:
+            shutil.copyfileobj(f_in, f_out, BUFSIZE)
+            nbytes = f_in.tell()
+    return nbytes, dst.stat().st_size
+
+
+def gzip_bytes(src: Path, level: int = GZIP_LEVEL) -> bytes:
+    """the same bytes gzip_file writes, but in memory"""
+    out = io.BytesIO()
+    with open(src, "rb") as f_in:
+        with gzip.GzipFile(
+            filename=src.name, mode="wb", compresslevel=level, fileobj=out
+        ) as f_out:
+            shutil.copyfileobj(f_in, f_out, BUFSIZE)
+    return out.getvalue()
+
+
+def make_pool(workers: int, kind: str = "thread") -> Executor:
+    if kind == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    assert kind == "thread", f"unknown pool kind {kind}"
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def gzip_files(
+    files: List[Path],
+    cardir: Path,
+    workers: int = 1,
+    level: int = GZIP_LEVEL,
+    kind: str = "thread",
+    relpaths: List[str] | None = None,
+) -> Tuple[int, int]:
+    """gzip each file to cardir/name.gz (or to cardir/relpath, for a nested
+    layout), returns total (bytes in, bytes out). With workers=1 this is a
+    plain loop, no pool."""
+    if relpaths is None:
+        dsts = [cardir / f"{f.name}.gz" for f in files]
+    else:
+        dsts = [cardir / rel for rel in relpaths]
+        for d in {d.parent for d in dsts}:
+            d.mkdir(parents=True, exist_ok=True)
+    if workers <= 1:
+        sizes = [gzip_file(f, d, level) for f, d in zip(files, dsts)]
+    else:
+        with make_pool(workers, kind) as pool:
+            sizes = list(pool.map(gzip_file, files, dsts, [level] * len(files)))
+    return sum(s[0] for s in sizes), sum(s[1] for s in sizes)
+
+
+def gzip_stream(
+    files: List[Path],
+    workers: int,
+    level: int = GZIP_LEVEL,
+    kind: str = "thread",
+    window: int | None = None,
+) -> Iterator[Tuple[Path, bytes]]:
+    """yields (file, gzipped bytes) in the order of `files`, with at most
+    `window` (default 4 * workers) compressed files held in memory"""
+    window = window or 4 * workers
+    with make_pool(workers, kind) as pool:
+        pending = deque()
+        for f in files:
+            pending.append((f, pool.submit(gzip_bytes, f, level)))
+            if len(pending) >= window:
+                f_done, fut = pending.popleft()
+                yield f_done, fut.result()
+        while pending:
+            f_done, fut = pending.popleft()
+            yield f_done, fut.result()
+
+# done.
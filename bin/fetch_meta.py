@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-26
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/fetch_meta.py
+
+"""fetch car directory listings, replacing scripts/get-{json,csv,html}.sh.
+
+One asyncio loop with a pooled HTTP client instead of a process per CID:
+
+  html  {gateway}/ipfs/{cid}                 -> {cid}.html  (as get-html.sh)
+  json  {gateway}/ipfs/{cid}?format=dag-json -> {cid}.json  (as get-json.sh)
+  ls    {api}/api/v0/ls?arg={cid}            -> {cid}.csv   (as get-csv.sh)
+
+Requests rotate over the gateways (or kubo API endpoints) on each retry,
+with at most --per-host in flight to any one host and jittered exponential
+backoff between attempts. Bodies are written to {cid}.{ext}.part and only
+renamed once they're complete: html has to end in </html>, json and ls have
+to parse, and when --expect gives a CID's link count the listing has to
+have exactly that many (for json that's the top node's links only: a HAMT
+directory needs resolve_dir.py). A retry resumes a .part with `Range: bytes=N-`
+from the gateway that started it.
+
+html downloads are also read row by row as they arrive (html_listing.py),
+and the rows from every attempt are merged into {cid}.csv in --rows-dir, so
+a download that dies partway still counts. With --names, a car is done
+("salvaged") once every name the db expects has been seen, closing tag or
+not, and {cid}.missing lists what hasn't.
+
+Every outcome is appended to _ledger.tsv in the output directory, and a
+CID whose last status is "ok" isn't fetched again, so re-running the same
+command retries only what's missing or failed. To test without the real
+network, point --gateway or --api at bin/stand-in-gateway.py."""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+import random
+import time
+from typing import Dict, List
+from urllib.parse import urlparse
+
+# --- these are not part of the std library
+import aiohttp  # noqa: E402
+
+# --- in this repo
+import html_listing
+
+logger = logging.getLogger("main")
+
+EXT = {"html": "html", "json": "json", "ls": "csv"}
+LEDGER = "_ledger.tsv"
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class Incomplete(Exception):
+    """a body that parsed short, or ended before its closing tag"""
+
+
+class Truncated(Incomplete):
+    """a body that stopped early; what's there is good, so it can be resumed"""
+
+
+class Permanent(Exception):
+    """an answer that retrying won't change, e.g. a 400 for a bad CID"""
+
+
+def read_ledger(outdir: Path) -> Dict[str, str]:
+    """cid -> last status"""
+    status = {}
+    pth = outdir / LEDGER
+    if pth.exists():
+        with open(pth, "rt") as f:
+            for line in f:
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) >= 3:
+                    status[cols[0]] = cols[2]
+    return status
+
+
+def read_expect(pth: str | None) -> Dict[str, int]:
+    """cid -> number of links, from lines of `cid count`"""
+    if pth is None:
+        return {}
+    with open(pth, "rt") as f:
+        return {
+            cols[0]: int(cols[1]) for cols in (line.split() for line in f) if cols
+        }
+
+
+def read_cids(pth: str) -> List[str]:
+    """one CID per line; car_urls are fine too, the CID is the last part"""
+    with open(pth, "rt") as f:
+        cids = [line.strip().rstrip("/").split("/")[-1] for line in f]
+    return list(dict.fromkeys(c for c in cids if c))
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    return min(cap, base * 2**attempt) * random.uniform(0.5, 1.5)
+
+
+def check_html(body: bytes, expect: int | None) -> bytes:
+    if not body.rstrip().endswith(b"</html>"):
+        raise Truncated(f"{len(body)} bytes, no closing </html>")
+    if expect is not None:
+        rows = body.count(b'class="ipfs-hash"')
+        if rows != expect:
+            raise Incomplete(f"{rows} rows, expected {expect}")
+    return body
+
+
+def check_json(body: bytes, expect: int | None) -> bytes:
+    try:
+        links = json.loads(body)["Links"]
+    except (ValueError, KeyError) as err:
+        raise Incomplete(f"{len(body)} bytes of json: {err}")
+    if expect is not None and len(links) != expect:
+        raise Incomplete(f"{len(links)} links, expected {expect}")
+    return body
+
+
+def check_ls(body: bytes, expect: int | None) -> bytes:
+    """kubo's /api/v0/ls json, rewritten as `ipfs ls` prints it"""
+    try:
+        links = json.loads(body)["Objects"][0]["Links"]
+    except (ValueError, KeyError, IndexError) as err:
+        raise Incomplete(f"{len(body)} bytes of ls json: {err}")
+    if expect is not None and len(links) != expect:
+        raise Incomplete(f"{len(links)} links, expected {expect}")
+    rows = [f"{lk['Hash']} {lk['Size']} {lk['Name']}\n" for lk in links]
+    return "".join(rows).encode("utf-8")
+
+
+CHECK = {"html": check_html, "json": check_json, "ls": check_ls}
+
+
+class Fetcher:
+    def __init__(self, args: argparse.Namespace, session: aiohttp.ClientSession):
+        self.args = args
+        self.session = session
+        self.outdir = Path(args.outdir)
+        self.expect = read_expect(args.expect)
+        if args.kind == "ls":
+            self.endpoints = args.api or ["http://127.0.0.1:5001"]
+        else:
+            self.endpoints = args.gateway or ["https://w3s.link"]
+        self.hostsem = {
+            urlparse(e).netloc: asyncio.Semaphore(args.per_host)
+            for e in self.endpoints
+        }
+        self.ledger = open(self.outdir / LEDGER, "at", buffering=1)
+        self.counts = {}
+        if args.kind == "html":
+            self.names = html_listing.read_names(args.names)
+            Path(args.rows_dir).mkdir(parents=True, exist_ok=True)
+
+    def record(self, cid: str, status: str, nbytes: int, tries: int, note="") -> None:
+        self.counts[status] = self.counts.get(status, 0) + 1
+        note = note.replace("\t", " ").replace("\n", " ")[:200]
+        self.ledger.write(
+            f"{cid}\t{self.args.kind}\t{status}\t{nbytes}\t{tries}\t"
+            f"{time.strftime('%Y-%m-%dT%H:%M:%S')}\t{note}\n"
+        )
+
+    def request(self, cid: str, endpoint: str, offset: int):
+        if self.args.kind == "ls":
+            url = f"{endpoint}/api/v0/ls"
+            return self.session.post(url, params={"arg": cid})
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        params = {"format": "dag-json"} if self.args.kind == "json" else {}
+        return self.session.get(
+            f"{endpoint}/ipfs/{cid}", params=params, headers=headers
+        )
+
+    async def download(self, cid: str, endpoint: str, part: Path, salv=None) -> None:
+        """one attempt, appending to part (and feeding salv, for html); raises
+        on anything but a whole body"""
+        src = part.with_suffix(".src")  # which endpoint's bytes are in part
+        offset = part.stat().st_size if part.exists() else 0
+        if offset and (not src.exists() or src.read_text() != endpoint):
+            offset = 0  # another gateway's page won't line up byte for byte
+        async with self.hostsem[urlparse(endpoint).netloc]:
+            async with self.request(cid, endpoint, offset) as response:
+                if response.status == 416:
+                    part.unlink(missing_ok=True)
+                if response.status in RETRY_STATUS | {416}:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info,
+                        response.history,
+                        status=response.status,
+                        message=response.reason or "",
+                    )
+                if response.status not in (200, 206):
+                    raise Permanent(f"{endpoint} returned {response.status}")
+                # a 200 to a Range request is the whole body again
+                mode = "ab" if response.status == 206 else "wb"
+                if mode == "wb":
+                    src.write_text(endpoint)
+                    if salv is not None:
+                        salv.restart()
+                with open(part, mode) as f:
+                    async for chunk in response.content.iter_chunked(1024 * 1024):
+                        f.write(chunk)
+                        if salv is not None:
+                            salv.feed(chunk)
+
+    async def fetch(self, cid: str) -> None:
+        ext = EXT[self.args.kind]
+        final = self.outdir / f"{cid}.{ext}"
+        part = self.outdir / f"{cid}.{ext}.part"
+        if self.args.kind == "ls":
+            part.unlink(missing_ok=True)  # a POST can't be resumed
+        salv = None
+        if self.args.kind == "html":
+            salv = html_listing.Salvage(cid, self.args.rows_dir, self.names.get(cid))
+            if part.exists():
+                html_listing.salvage_file(salv, part)
+        note = ""
+        first = random.randrange(len(self.endpoints))
+        for attempt in range(self.args.retries):
+            endpoint = self.endpoints[(first + attempt) % len(self.endpoints)]
+            try:
+                await asyncio.wait_for(
+                    self.download(cid, endpoint, part, salv), self.args.timeout
+                )
+                body = CHECK[self.args.kind](part.read_bytes(), self.expect.get(cid))
+            except Permanent as err:
+                note = str(err)
+                break
+            except Truncated as err:
+                note = f"truncated: {err}"
+            except Incomplete as err:
+                # a parsed-short body can't be resumed, so start over
+                note = f"incomplete: {err}"
+                part.unlink(missing_ok=True)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as err:
+                # keep the .part, the next attempt resumes it
+                note = f"{type(err).__name__}: {err}"
+            else:
+                if self.args.kind == "ls":
+                    part.write_bytes(body)
+                if salv is not None:
+                    salv.save()
+                    salv.write_missing(self.outdir)
+                os.replace(part, final)
+                part.with_suffix(".src").unlink(missing_ok=True)
+                self.record(cid, "ok", len(body), attempt + 1)
+                return
+            if salv is not None:
+                salv.save()
+                salv.write_missing(self.outdir)
+                note = f"{len(salv.rows)} rows, {len(salv.missing())} missing; {note}"
+                if salv.expected and not salv.missing():
+                    self.record(cid, "salvaged", len(salv.rows), attempt + 1, note)
+                    return
+            logger.debug(f"{cid} attempt {attempt + 1} via {endpoint}: {note}")
+            if attempt + 1 < self.args.retries:
+                await asyncio.sleep(
+                    backoff(attempt, self.args.backoff, self.args.max_backoff)
+                )
+        nbytes = part.stat().st_size if part.exists() else 0
+        logger.warning(f"{cid} failed: {note}")
+        self.record(cid, "failed", nbytes, attempt + 1, note)
+
+    async def run(self, cids: List[str]) -> Dict[str, int]:
+        queue = asyncio.Queue()
+        for cid in cids:
+            queue.put_nowait(cid)
+
+        async def worker():
+            while not queue.empty():
+                await self.fetch(queue.get_nowait())
+
+        await asyncio.gather(*[worker() for _ in range(self.args.jobs)])
+        self.ledger.close()
+        return self.counts
+
+
+async def fetch_all(args: argparse.Namespace, cids: List[str]) -> Dict[str, int]:
+    connector = aiohttp.TCPConnector(limit=args.jobs, limit_per_host=args.per_host)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await Fetcher(args, session).run(cids)
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="fetch car directory listings")
+    parser.add_argument(
+        "-i",
+        "--cids",
+        help="file with one car CID (or car_url) per line",
+        required=True,
+    )
+    parser.add_argument(
+        "-k", "--kind", choices=["html", "json", "ls"], default="json"
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        help="where to write; default /var/tmp/pescados/car-did-{json,csv,html}",
+    )
+    parser.add_argument(
+        "-g", "--gateway", help="gateway base url, repeatable", action="append"
+    )
+    parser.add_argument(
+        "-a", "--api", help="kubo RPC base url (for -k ls), repeatable", action="append"
+    )
+    parser.add_argument(
+        "-e", "--expect", help="file of `cid nlinks` lines to check listings against"
+    )
+    parser.add_argument(
+        "-r",
+        "--rows-dir",
+        help="(html) where to merge salvaged rows into {cid}.csv",
+        default="/var/tmp/pescados/car-did-html-csv",
+    )
+    parser.add_argument(
+        "-n", "--names", help="(html) file of `car_cid name` lines the db expects"
+    )
+    parser.add_argument("-j", "--jobs", help="CIDs in flight", default=50, type=int)
+    parser.add_argument(
+        "--per-host", help="requests in flight to any one host", default=8, type=int
+    )
+    parser.add_argument("--retries", default=6, type=int)
+    parser.add_argument(
+        "--timeout", help="seconds for one attempt", default=1200, type=float
+    )
+    parser.add_argument(
+        "--backoff", help="first backoff, seconds", default=2.0, type=float
+    )
+    parser.add_argument("--max-backoff", default=120.0, type=float)
+    parser.add_argument(
+        "--redo", help="fetch even CIDs the ledger says are ok", action="store_true"
+    )
+    args = parser.parse_args()
+    if args.outdir is None:
+        args.outdir = f"/var/tmp/pescados/car-did-{EXT[args.kind]}"
+    return args
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    Path(args.outdir).mkdir(parents=True, exist_ok=True)
+    cids = read_cids(args.cids)
+    done = {} if args.redo else read_ledger(Path(args.outdir))
+    outdir, ext = Path(args.outdir), EXT[args.kind]
+    todo = [
+        c
+        for c in cids
+        if not (
+            done.get(c) == "salvaged"
+            or done.get(c) == "ok"
+            and (outdir / f"{c}.{ext}").exists()
+        )
+    ]
+    logger.info(f"{len(cids)} cids, {len(cids) - len(todo)} already ok")
+    counts = asyncio.run(fetch_all(args, todo))
+    logger.info(f"done: {counts}")
+
+# done.
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-01
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/hash_files.py
+
+"""sha256 of the source files into fs.content_hash, to find duplicates.
+
+Only files that share their size with another file can be duplicates, so
+by default only those are hashed (--all hashes everything). Files are read
+in 1MB pieces on a thread pool (hashlib releases the GIL), rows come off a
+server-side cursor and go back by COPY + one joined UPDATE per batch, so
+memory doesn't grow with the trove and an interrupted run keeps what it
+committed. Re-runs hash only rows still without a content_hash.
+
+car-to-ipfs.py --dedup then packs one copy of each content and points the
+other fs rows at it (deduped = true). The report here says how many bytes
+that saves."""
+
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+from pathlib import Path
+import tomllib as toml
+from typing import Iterator, Tuple
+
+# --- these are not part of the std library
+import psycopg  # noqa: E402
+
+logger = logging.getLogger("main")
+BUFSIZE = 1024 * 1024
+
+
+def pg_connect(credsfile: str, **kwargs) -> psycopg.Connection:
+    with open(credsfile, "rb") as f:
+        creds = toml.load(f)
+    return psycopg.connect(
+        host="localhost",
+        user=creds["user"],
+        password=creds["password"],
+        row_factory=psycopg.rows.namedtuple_row,
+        dbname=creds["dbname"],
+        port=5432,
+        **kwargs,
+    )
+
+
+def ensure_columns(conn: psycopg.Connection) -> None:
+    conn.execute("ALTER TABLE fs ADD COLUMN IF NOT EXISTS content_hash TEXT")
+    conn.execute(
+        "ALTER TABLE fs ADD COLUMN IF NOT EXISTS deduped BOOLEAN DEFAULT false"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS fs_content_hash ON fs (content_hash)")
+    conn.commit()
+
+
+def hash_file(pth: Path) -> str | None:
+    """hex sha256, or None if the file can't be read (logged)"""
+    h = hashlib.sha256()
+    try:
+        with open(pth, "rb") as f:
+            while chunk := f.read(BUFSIZE):
+                h.update(chunk)
+    except OSError as err:
+        logger.warning(f"{pth}: {err!r}, not hashed")
+        return None
+    return h.hexdigest()
+
+
+def hashed(rows, workers: int) -> Iterator[Tuple[str, str, str | None]]:
+    """(pth, fname, hash) for each row, in order, with at most 4 * workers
+    files in flight"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for r in rows:
+            fut = pool.submit(hash_file, Path(r.pth, r.fname))
+            pending.append((r.pth, r.fname, fut))
+            if len(pending) >= 4 * workers:
+                pth, fname, fut = pending.popleft()
+                yield pth, fname, fut.result()
+        while pending:
+            pth, fname, fut = pending.popleft()
+            yield pth, fname, fut.result()
+
+
+def write_batch(conn: psycopg.Connection, batch: list) -> int:
+    with conn.cursor() as cur:
+        cur.execute(
+            "CREATE TEMP TABLE hashes (pth TEXT, fname TEXT, content_hash TEXT) "
+            "ON COMMIT DROP"
+        )
+        with cur.copy("COPY hashes (pth, fname, content_hash) FROM STDIN") as copy:
+            for row in batch:
+                copy.write_row(row)
+        cur.execute("""
+            UPDATE fs f SET content_hash = h.content_hash
+            FROM hashes h
+            WHERE (f.pth, f.fname) = (h.pth, h.fname)""")
+        n = cur.rowcount
+    conn.commit()
+    return n
+
+
+def hash_all(args: argparse.Namespace) -> int:
+    """hash the candidates, a batch per commit; returns rows hashed"""
+    where = "WHERE content_hash IS NULL"
+    if not args.all:
+        where += """ AND fsize IN (
+            SELECT fsize FROM fs GROUP BY fsize HAVING count(*) > 1)"""
+    nrows = unreadable = 0
+    with pg_connect(args.creds) as rconn, pg_connect(args.creds) as wconn:
+        with rconn.cursor(name="to_hash") as rcur:
+            rcur.itersize = 10_000
+            rcur.execute(f"SELECT pth, fname FROM fs {where} ORDER BY pth, fname")
+            batch = []
+            for pth, fname, h in hashed(rcur, args.jobs):
+                if h is None:
+                    unreadable += 1
+                    continue
+                batch.append((pth, fname, h))
+                if len(batch) >= args.batch:
+                    nrows += write_batch(wconn, batch)
+                    logger.info(f"{nrows} files hashed")
+                    batch = []
+            if batch:
+                nrows += write_batch(wconn, batch)
+    logger.info(f"{nrows} files hashed, {unreadable} unreadable")
+    return nrows
+
+
+def report(args: argparse.Namespace) -> dict:
+    """duplicate groups and bytes: how much dedup can save, and has saved"""
+    report_q = """
+        WITH g AS (
+            SELECT content_hash, count(*) AS n, max(fsize::bigint) AS fsize
+            FROM fs WHERE content_hash IS NOT NULL
+            GROUP BY content_hash HAVING count(*) > 1)
+        SELECT count(*) AS groups,
+            coalesce(sum(n - 1), 0) AS dup_files,
+            coalesce(sum((n - 1) * fsize), 0) AS dup_bytes,
+            (SELECT coalesce(sum(fsize::bigint), 0) FROM fs WHERE deduped)
+                AS saved_bytes
+        FROM g"""
+    with pg_connect(args.creds) as conn:
+        r = conn.execute(report_q).fetchone()
+    gb = 1024**3
+    logger.info(
+        f"{r.groups} contents stored more than once: {r.dup_files} extra copies, "
+        f"{r.dup_bytes / gb:.2f}GB (before gzip); "
+        f"{r.saved_bytes / gb:.2f}GB already skipped by --dedup"
+    )
+    return r._asdict()
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="hash source files to find dups")
+    credsfile = f"{str(Path.home())}/creds/psql.toml"
+    parser.add_argument(
+        "-c", "--creds", help="Path to the postgres credentials file", default=credsfile
+    )
+    parser.add_argument("-j", "--jobs", help="files read at once", default=8, type=int)
+    parser.add_argument(
+        "-b", "--batch", help="rows per commit", default=50_000, type=int
+    )
+    parser.add_argument(
+        "-a",
+        "--all",
+        help="hash every file, not only those sharing a size with another",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-r", "--report-only", help="don't hash, just report", action="store_true"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    with pg_connect(args.creds) as conn:
+        ensure_columns(conn)
+    if not args.report_only:
+        hash_all(args)
+    report(args)
+
+# done.
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-27
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/html_listing.py
+
+"""salvage rows from gateway html directory listings, whole or cut short.
+
+For the big cars, curl usually died partway through w3s.link's table, and a
+download without its closing </html> was thrown away. ListingParser reads
+the table incrementally, so every row that arrived whole is kept, and
+Salvage merges the rows from every attempt at the same CID into one
+`ipfs ls`-style csv (`cid tsize name`), which add_cids_from_csv.py reads.
+Given the names the db expects in a car, it also says which are still
+missing, and a listing is complete once none are.
+
+fetch_meta.py -k html feeds its downloads through Salvage as they arrive,
+and resumes the same bytes with Range. Run on its own, this salvages the
+.html and .html.part files already on disk."""
+
+import argparse
+import codecs
+from collections import defaultdict
+from html.parser import HTMLParser
+import logging
+import os
+from pathlib import Path
+import tempfile
+from typing import Dict, List, Set
+from urllib.parse import unquote, urlparse
+
+# --- in this repo
+from unixfs import FileCID, is_cid
+
+logger = logging.getLogger("main")
+
+
+class ListingParser(HTMLParser):
+    """a gateway directory listing, one table row at a time. Feed it text as
+    it arrives; each complete <tr> with a name and an ipfs-hash link is put
+    on .rows. tsize is None when the page only shows a rounded size."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows: List[FileCID] = []
+        self.closed = False
+        self._row = None
+        self._cell = None
+        self._link = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "tr":
+            self._row = {"name": None, "hash": None, "cells": []}
+        elif self._row is None:
+            return
+        elif tag == "td":
+            self._cell = []
+        elif tag == "a":
+            attrs = dict(attrs)
+            self._link = {
+                "hash": "ipfs-hash" in (attrs.get("class") or "").split(),
+                "href": attrs.get("href") or "",
+                "text": [],
+            }
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+        if self._link is not None:
+            self._link["text"].append(data)
+
+    def handle_endtag(self, tag):
+        if tag == "html":
+            self.closed = True
+        if self._row is None:
+            return
+        if tag == "a" and self._link is not None:
+            text = "".join(self._link["text"]).strip()
+            path = urlparse(self._link["href"]).path
+            if self._link["hash"]:
+                # the text may be shortened (bafy…wxyz), the href's
+                # /ipfs/<cid> never is
+                href_cid = path.rstrip("/").split("/")[-1]
+                self._row["hash"] = next(
+                    (c for c in (href_cid, text) if is_cid(c)), None
+                )
+            elif self._row["name"] is None:
+                self._row["name"] = text or unquote(path.rstrip("/").split("/")[-1])
+            self._link = None
+        elif tag == "td" and self._cell is not None:
+            self._row["cells"].append("".join(self._cell).strip())
+            self._cell = None
+        elif tag == "tr":
+            row, self._row = self._row, None
+            if row["hash"] and row["name"] and row["name"] != "..":
+                size = row["cells"][-1] if row["cells"] else ""
+                tsize = int(size) if size.isdigit() else None
+                row = FileCID(hash=row["hash"], name=row["name"], tsize=tsize)
+                self.rows.append(row)
+
+
+def read_rows(pth: Path) -> Dict[str, FileCID]:
+    """name -> row, from a csv written by Salvage.save()"""
+    rows = {}
+    if pth.exists():
+        with open(pth, "rt") as f:
+            for line in f:
+                cid, tsize, name = line.rstrip("\n").split(" ", 2)
+                tsize = int(tsize) if tsize.isdigit() else None
+                rows[name] = FileCID(hash=cid, name=name, tsize=tsize)
+    return rows
+
+
+def read_names(pth: str | None) -> Dict[str, Set[str]]:
+    """car cid -> expected names, from lines of `car_cid name` (a car_url is
+    fine too), e.g. from
+    psql -c "select car_url, fname || '.gz' from fs where file_cid is null" """
+    names = defaultdict(set)
+    if pth is not None:
+        with open(pth, "rt") as f:
+            for line in f:
+                cols = line.split()
+                if len(cols) >= 2:
+                    names[cols[0].rstrip("/").split("/")[-1]].add(cols[1])
+    return names
+
+
+class Salvage:
+    """the merged rows of every attempt at one car's listing"""
+
+    def __init__(self, cid: str, rowsdir: Path, expected: Set[str] | None = None):
+        self.cid = cid
+        self.pth = Path(rowsdir) / f"{cid}.csv"
+        self.expected = expected or set()
+        self.rows = read_rows(self.pth)
+        self.restart()
+
+    def restart(self) -> None:
+        """a new download from byte 0; rows already salvaged are kept"""
+        self.parser = ListingParser()
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def feed(self, chunk: bytes) -> int:
+        """parse the next bytes of the download, returns how many new rows"""
+        self.parser.feed(self.decoder.decode(chunk))
+        new = 0
+        for row in self.parser.rows:
+            old = self.rows.get(row.name)
+            if old is None:
+                new += 1
+            if old is None or old.tsize is None:
+                self.rows[row.name] = row
+        self.parser.rows.clear()
+        return new
+
+    @property
+    def closed(self) -> bool:
+        """the download got to </html>"""
+        return self.parser.closed
+
+    def missing(self) -> List[str]:
+        return sorted(self.expected - self.rows.keys())
+
+    @property
+    def complete(self) -> bool:
+        return self.closed or (bool(self.expected) and not self.missing())
+
+    def save(self) -> None:
+        """rewrite the csv, whole or not at all; a tsize of "-" is unknown"""
+        if not self.rows:
+            return
+        fd, tmpname = tempfile.mkstemp(dir=self.pth.parent, suffix=".part")
+        with os.fdopen(fd, "wt") as f:
+            for r in self.rows.values():
+                tsize = "-" if r.tsize is None else r.tsize
+                f.write(f"{r.hash} {tsize} {r.name}\n")
+        os.replace(tmpname, self.pth)
+
+    def write_missing(self, outdir: Path) -> Path | None:
+        """{cid}.missing lists the expected names not seen yet"""
+        pth = Path(outdir) / f"{self.cid}.missing"
+        missing = self.missing()
+        if not self.expected or not missing:
+            pth.unlink(missing_ok=True)
+            return None
+        with open(pth, "wt") as f:
+            f.writelines(f"{name}\n" for name in missing)
+        return pth
+
+
+def salvage_file(salv: Salvage, pth: Path, bufsize: int = 1024 * 1024) -> int:
+    """feed one downloaded file to salv from the top, returns new rows"""
+    salv.restart()
+    new = 0
+    with open(pth, "rb") as f:
+        while chunk := f.read(bufsize):
+            new += salv.feed(chunk)
+    return new
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="salvage rows from html listings")
+    parser.add_argument(
+        "-t",
+        "--htmldir",
+        help="dir of {cid}.html and {cid}.html.part downloads",
+        default="/var/tmp/pescados/car-did-html",
+    )
+    parser.add_argument(
+        "-o",
+        "--rowsdir",
+        help="where to write one {cid}.csv of merged rows per car",
+        default="/var/tmp/pescados/car-did-html-csv",
+    )
+    parser.add_argument(
+        "-n", "--names", help="file of `car_cid name` lines the db expects"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    htmldir, rowsdir = Path(args.htmldir), Path(args.rowsdir)
+    rowsdir.mkdir(parents=True, exist_ok=True)
+    names = read_names(args.names)
+
+    downloads = defaultdict(list)
+    for pth in sorted(htmldir.iterdir()):
+        if pth.name.endswith((".html", ".html.part")):
+            downloads[pth.name.split(".", 1)[0]].append(pth)
+    totals = defaultdict(int)
+    for cid, pths in downloads.items():
+        salv = Salvage(cid, rowsdir, names.get(cid))
+        before = len(salv.rows)
+        closed = False
+        for pth in pths:
+            salvage_file(salv, pth)
+            closed = closed or salv.closed
+        salv.save()
+        salv.write_missing(htmldir)
+        state = "complete" if closed or salv.complete else "partial"
+        totals[state] += 1
+        totals["rows"] += len(salv.rows)
+        totals["missing"] += len(salv.missing())
+        logger.info(
+            f"{cid}: {state}, {len(salv.rows)} rows (+{len(salv.rows) - before}), "
+            f"{len(salv.missing())} missing"
+        )
+    logger.info(f"{len(downloads)} cars: {dict(totals)}")
+
+# done.
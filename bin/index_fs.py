@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-11
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/index_fs.py
+
+"""walk the source drives into fs: (pth, fname, fsize, mtime) per file.
+
+fs first came from `find -printf "%h,%f,%s"` into sqlite and a dump into
+postgres, which breaks on a comma in a path, and a new drive meant doing it
+all again. Here a pool of threads runs os.scandir() over the directory
+tree (on USB disks most of the time is the disk's latency, so several
+listings and stats in flight go much faster than one), and the files go
+to fs by COPY, a batch per commit.
+
+Each run over a root is a scan, in fs_scan. Rescanning a root (or a new
+drive) only inserts the files fs doesn't have; the ones it has are marked
+seen_tm, a file whose size or mtime isn't what fs says gets changed_tm,
+and when the walk is done the rows under the root it didn't see, and that
+really aren't there any more, get vanished_tm. Nothing is deleted: a
+changed or vanished file may be uploaded already, and that's for a person
+to look at:
+
+  SELECT pth, fname, changed_tm, vanished_tm, car_url FROM fs
+  WHERE changed_tm IS NOT NULL OR vanished_tm IS NOT NULL ;
+
+An interrupted scan picks up where it stopped: the directories whose
+files were committed are in fs_scan_dir, and the next run over the same
+root lists them only to find their subdirectories. The new files have no
+carblock yet; gen-carblock-id.py numbers them."""
+
+import argparse
+from fnmatch import fnmatch
+import logging
+import os
+from pathlib import Path
+import queue
+import threading
+import tomllib as toml
+from types import SimpleNamespace
+from typing import Iterator, List, Set, Tuple
+
+# --- these are not part of the std library
+import psycopg  # noqa: E402
+
+logger = logging.getLogger("main")
+
+
+def pg_connect(credsfile: str, **kwargs) -> psycopg.Connection:
+    with open(credsfile, "rb") as f:
+        creds = toml.load(f)
+    return psycopg.connect(
+        host=creds.get("host", "localhost"),
+        user=creds["user"],
+        password=creds["password"],
+        row_factory=psycopg.rows.namedtuple_row,
+        dbname=creds["dbname"],
+        port=creds.get("port", 5432),
+        **kwargs,
+    )
+
+
+def ensure_tables(conn: psycopg.Connection) -> None:
+    """fs (for a new database), its scan columns, and the scan tables"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS fs (
+                pth TEXT, fname TEXT, fsize BIGINT, carblock INT,
+                blocked_tm TIMESTAMPTZ, uploaded_tm TIMESTAMPTZ,
+                car_url VARCHAR(128), file_cid VARCHAR(60), tsize INTEGER,
+                PRIMARY KEY (pth, fname)) ;""")
+        for col in ("mtime", "seen_tm", "changed_tm", "vanished_tm"):
+            cur.execute(f"ALTER TABLE fs ADD COLUMN IF NOT EXISTS {col} TIMESTAMPTZ")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS fs_scan (
+                scan_id SERIAL PRIMARY KEY,
+                root TEXT,
+                pattern TEXT,
+                started_tm TIMESTAMPTZ DEFAULT now(),
+                finished_tm TIMESTAMPTZ,
+                nfiles BIGINT DEFAULT 0,
+                nnew BIGINT DEFAULT 0,
+                nchanged BIGINT DEFAULT 0,
+                nvanished BIGINT DEFAULT 0) ;""")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS fs_scan_dir (
+                scan_id INT,
+                pth TEXT,
+                PRIMARY KEY (scan_id, pth)) ;""")
+    conn.commit()
+
+
+def start_scan(
+    conn: psycopg.Connection, root: str, pattern: str, new: bool
+) -> Tuple[SimpleNamespace, Set[str]]:
+    """the unfinished scan of root to resume (unless new), or a new one;
+    and the directories it has done"""
+    last_q = """
+        SELECT scan_id, root, pattern, started_tm FROM fs_scan
+        WHERE root = %s AND pattern = %s AND finished_tm IS NULL
+        ORDER BY scan_id DESC LIMIT 1"""
+    new_q = """
+        INSERT INTO fs_scan (root, pattern) VALUES (%s, %s)
+        RETURNING scan_id, root, pattern, started_tm"""
+    scan = None if new else conn.execute(last_q, (root, pattern)).fetchone()
+    if scan is None:
+        scan = conn.execute(new_q, (root, pattern)).fetchone()
+        conn.commit()
+        return SimpleNamespace(**scan._asdict()), set()
+    done_q = "SELECT pth FROM fs_scan_dir WHERE scan_id = %s"
+    done = {r.pth for r in conn.execute(done_q, (scan.scan_id,))}
+    conn.commit()
+    logger.info(
+        f"{root}: resuming scan {scan.scan_id} from {scan.started_tm}, "
+        f"{len(done)} directories already done"
+    )
+    return SimpleNamespace(**scan._asdict()), done
+
+
+def _encodable(s: str) -> bool:
+    """os.scandir gives undecodable bytes as surrogates; postgres can't
+    take them"""
+    try:
+        s.encode("utf-8")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def walk(
+    root: str, workers: int, pattern: str, done: Set[str], failed: List[str]
+) -> Iterator[Tuple[str, list]]:
+    """(directory, [(pth, fname, fsize, mtime), ...]) for each directory
+    under root not in done, listed by `workers` threads. Directories that
+    can't be listed are appended to failed."""
+    dirq = queue.Queue()
+    outq = queue.Queue(maxsize=64 * workers)
+    finished = object()
+
+    def list_dir(d: str) -> None:
+        subdirs, files = [], []
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            subdirs.append(e.path)
+                        elif (
+                            d not in done
+                            and e.is_file(follow_symlinks=False)
+                            and fnmatch(e.name, pattern)
+                        ):
+                            if not _encodable(e.path):
+                                logger.warning(f"{e.path!r}: not utf-8, skipped")
+                                continue
+                            st = e.stat(follow_symlinks=False)
+                            files.append((d, e.name, st.st_size, st.st_mtime))
+                    except OSError as err:
+                        logger.warning(f"{e.path}: {err!r}, skipped")
+        except OSError as err:
+            logger.warning(f"{d}: {err!r}, not listed")
+            failed.append(d)
+            return
+        for s in subdirs:
+            dirq.put(s)
+        if d not in done and _encodable(d):
+            outq.put((d, files))
+
+    def worker() -> None:
+        while True:
+            d = dirq.get()
+            if d is None:
+                break
+            try:
+                list_dir(d)
+            finally:
+                dirq.task_done()
+
+    def closer() -> None:
+        dirq.join()
+        for _ in range(workers):
+            dirq.put(None)
+        outq.put(finished)
+
+    dirq.put(root)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    threads.append(threading.Thread(target=closer, daemon=True))
+    for t in threads:
+        t.start()
+    while (item := outq.get()) is not finished:
+        yield item
+
+
+def write_batch(
+    conn: psycopg.Connection, scan: SimpleNamespace, rows: list, dirs: list
+) -> Tuple[int, int]:
+    """the rows into fs, and dirs as done; returns (new, changed)"""
+    changed_q = """
+        UPDATE fs f SET changed_tm = now()
+        FROM scan s
+        WHERE (f.pth, f.fname) = (s.pth, s.fname) AND f.changed_tm IS NULL
+        AND (f.fsize::bigint <> s.fsize OR f.mtime <> to_timestamp(s.mtime))"""
+    seen_q = """
+        UPDATE fs f
+        SET seen_tm = %s, vanished_tm = NULL,
+            mtime = coalesce(f.mtime, to_timestamp(s.mtime))
+        FROM scan s
+        WHERE (f.pth, f.fname) = (s.pth, s.fname)"""
+    new_q = """
+        INSERT INTO fs (pth, fname, fsize, mtime, seen_tm)
+        SELECT s.pth, s.fname, s.fsize, to_timestamp(s.mtime), %s
+        FROM scan s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM fs f WHERE (f.pth, f.fname) = (s.pth, s.fname))"""
+    dirs_q = """
+        INSERT INTO fs_scan_dir (scan_id, pth)
+        SELECT %s, unnest(%s::text[]) ON CONFLICT DO NOTHING"""
+    counts_q = """
+        UPDATE fs_scan
+        SET nfiles = nfiles + %s, nnew = nnew + %s, nchanged = nchanged + %s
+        WHERE scan_id = %s"""
+    with conn.cursor() as cur:
+        cur.execute(
+            "CREATE TEMP TABLE scan (pth TEXT, fname TEXT, fsize BIGINT, "
+            "mtime DOUBLE PRECISION) ON COMMIT DROP"
+        )
+        with cur.copy("COPY scan (pth, fname, fsize, mtime) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+        cur.execute(changed_q)
+        nchanged = cur.rowcount
+        cur.execute(seen_q, (scan.started_tm,))
+        cur.execute(new_q, (scan.started_tm,))
+        nnew = cur.rowcount
+        cur.execute(dirs_q, (scan.scan_id, dirs))
+        cur.execute(counts_q, (len(rows), nnew, nchanged, scan.scan_id))
+    conn.commit()
+    return nnew, nchanged
+
+
+def flag_vanished(
+    args: argparse.Namespace, scan: SimpleNamespace, failed: List[str]
+) -> int:
+    """rows under the root this scan didn't see, and that aren't there: a
+    file in a directory that couldn't be listed isn't counted as gone"""
+    root = scan.root.rstrip("/") or "/"
+    unseen_q = """
+        SELECT pth, fname FROM fs
+        WHERE (pth = %s OR starts_with(pth, %s))
+        AND (seen_tm IS NULL OR seen_tm < %s) AND vanished_tm IS NULL"""
+    vanished_q = """
+        UPDATE fs f SET vanished_tm = now()
+        FROM gone g WHERE (f.pth, f.fname) = (g.pth, g.fname)"""
+    skip = tuple(d.rstrip("/") + "/" for d in failed)
+    gone = []
+    with pg_connect(args.creds) as rconn:
+        with rconn.cursor(name="unseen") as rcur:
+            rcur.itersize = 10_000
+            rcur.execute(unseen_q, (root, root.rstrip("/") + "/", scan.started_tm))
+            for r in rcur:
+                if r.pth in failed or (r.pth + "/").startswith(skip):
+                    continue
+                if fnmatch(r.fname, scan.pattern) and not os.path.lexists(
+                    os.path.join(r.pth, r.fname)
+                ):
+                    gone.append((r.pth, r.fname))
+    with pg_connect(args.creds) as conn:
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE gone (pth TEXT, fname TEXT) ON COMMIT DROP")
+            with cur.copy("COPY gone (pth, fname) FROM STDIN") as copy:
+                for row in gone:
+                    copy.write_row(row)
+            cur.execute(vanished_q)
+            cur.execute(
+                "UPDATE fs_scan SET nvanished = %s WHERE scan_id = %s",
+                (cur.rowcount, scan.scan_id),
+            )
+        conn.commit()
+    return len(gone)
+
+
+def index_root(args: argparse.Namespace, root: str) -> SimpleNamespace:
+    """scan (or finish scanning) one root; returns its fs_scan row"""
+    root = os.path.abspath(root)
+    with pg_connect(args.creds) as conn:
+        scan, done = start_scan(conn, root, args.pattern, args.new_scan)
+        failed = []
+        rows, dirs = [], []
+        nfiles = nnew = nchanged = 0
+        for d, files in walk(root, args.jobs, args.pattern, done, failed):
+            rows += files
+            dirs.append(d)
+            # a directory's files all go in the same batch, so a done
+            # directory is all in fs
+            if len(rows) >= args.batch:
+                n, c = write_batch(conn, scan, rows, dirs)
+                nfiles, nnew, nchanged = nfiles + len(rows), nnew + n, nchanged + c
+                logger.info(f"{root}: {nfiles} files, {nnew} new, {nchanged} changed")
+                rows, dirs = [], []
+        if rows or dirs:
+            n, c = write_batch(conn, scan, rows, dirs)
+            nfiles, nnew, nchanged = nfiles + len(rows), nnew + n, nchanged + c
+        nvanished = flag_vanished(args, scan, failed)
+        finish_q = """
+            UPDATE fs_scan SET finished_tm = now() WHERE scan_id = %s
+            RETURNING *"""
+        scan = conn.execute(finish_q, (scan.scan_id,)).fetchone()
+        conn.execute("DELETE FROM fs_scan_dir WHERE scan_id = %s", (scan.scan_id,))
+        conn.commit()
+    logger.info(
+        f"{root}: scan {scan.scan_id} done, {scan.nfiles} files ({nfiles} this run), "
+        f"{scan.nnew} new, {scan.nchanged} changed, {nvanished} vanished, "
+        f"{len(failed)} directories couldn't be listed"
+    )
+    return scan
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="index source files into fs")
+    credsfile = f"{str(Path.home())}/creds/psql.toml"
+    parser.add_argument(
+        "-c", "--creds", help="Path to the postgres credentials file", default=credsfile
+    )
+    parser.add_argument("roots", help="directories to index", nargs="+")
+    parser.add_argument(
+        "-p", "--pattern", help="only files whose name matches", default="*"
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="directories listed at once", default=16, type=int
+    )
+    parser.add_argument(
+        "-b", "--batch", help="rows per commit", default=50_000, type=int
+    )
+    parser.add_argument(
+        "-n",
+        "--new-scan",
+        help="start over, rather than resume an interrupted scan of the root",
+        action="store_true",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    with pg_connect(args.creds) as conn:
+        ensure_tables(conn)
+    for root in args.roots:
+        index_root(args, root)
+
+# done.
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-09
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/journal.py
+
+"""how far a carblock got on this host, so a retry starts from there.
+
+When anything after pack_car() failed (a flaky `w3 up`, the db), the
+carblock was rolled back and the next try read its ~500MB off the USB
+disks, gzipped and packed it again. Now each stage that finishes writes a
+checkpoint to {journaldir}/carblock-{N}.json:
+
+  staged    the gzipped files are all in cardir
+  packed    carpth holds the car, with car_cid and the file CIDs
+  verified  every CID in the car was checked (--verify cid)
+  uploaded  w3 up returned car_url
+
+and a rolled-back carblock keeps its cardir and car. The next worker on
+this host to claim it (workers claim carblocks with a checkpoint here
+first) starts after the last stage done: a car is only used again after
+its every block and its root CID are checked again (verify_car.py), and
+only if the carblock's files and the packing options are still the same;
+otherwise the leftovers are removed and it's built from the start. Once
+the upload is in the db the checkpoint is removed.
+
+The journal is a local file, not a table, because the cardir and the car
+it points to are local too, and the build and upload threads don't touch
+the db."""
+
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+from typing import List
+
+logger = logging.getLogger("main")
+STAGES = ("staged", "packed", "verified", "uploaded")
+
+
+def _pth(journaldir: Path, carblock: int) -> Path:
+    return Path(journaldir) / f"carblock-{carblock}.json"
+
+
+def load(journaldir: Path, carblock: int) -> dict | None:
+    try:
+        with open(_pth(journaldir, carblock), "rt") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as err:
+        logger.warning(f"carblock={carblock}: unreadable journal {err!r}, ignored")
+        return None
+
+
+def checkpoint(journaldir: Path, carblock: int, stage: str, **fields) -> dict:
+    """record that stage is done, with fields added to what's recorded"""
+    assert stage in STAGES
+    entry = load(journaldir, carblock) or {"carblock": carblock}
+    entry.update(fields, stage=stage, tm=time.time())
+    Path(journaldir).mkdir(parents=True, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=journaldir, suffix=".part")
+    with os.fdopen(fd, "wt") as f:
+        json.dump(entry, f, default=str)
+    os.replace(tmpname, _pth(journaldir, carblock))
+    logger.debug(f"carblock={carblock}: checkpoint {stage}")
+    return entry
+
+
+def done(entry: dict | None, stage: str) -> bool:
+    """entry has got at least as far as stage"""
+    if entry is None or entry.get("stage") not in STAGES:
+        return False
+    return STAGES.index(entry["stage"]) >= STAGES.index(stage)
+
+
+def discard(journaldir: Path, carblock: int, artifacts: bool = True) -> None:
+    """forget the carblock and (by default) remove its cardir and car"""
+    entry = load(journaldir, carblock)
+    if entry is not None and artifacts:
+        if entry.get("cardir"):
+            shutil.rmtree(entry["cardir"], ignore_errors=True)
+        if entry.get("carpth"):
+            Path(entry["carpth"]).unlink(missing_ok=True)
+    _pth(journaldir, carblock).unlink(missing_ok=True)
+
+
+def pending(journaldir: Path) -> List[int]:
+    """carblocks with a checkpoint on this host"""
+    return sorted(
+        int(p.stem.split("-", 1)[1]) for p in Path(journaldir).glob("carblock-*.json")
+    )
+
+# done.
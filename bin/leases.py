@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-14
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/leases.py
+
+"""carblock claims for concurrent car-to-ipfs.py workers.
+
+Each carblock has one row in carblock_lease. A worker claims a row with
+`FOR UPDATE SKIP LOCKED`, so two workers can never get the same carblock,
+and holds it for `lease_secs`, renewed by a heartbeat thread. If the
+worker dies, the lease runs out and the reaper hands the carblock back
+(and clears fs.blocked_tm) for someone else.
+
+A worker that's alive but whose heartbeat couldn't get through can lose
+its lease the same way, so before it uploads, and in the same transaction
+as the write-back, it checks it still holds the carblock (holds())."""
+
+import logging
+import os
+import random
+import socket
+import threading
+
+# --- these are not part of the std library
+import psycopg  # noqa: E402
+
+# --- in this repo
+import preflight
+
+logger = logging.getLogger("main")
+
+
+class LostLease(Exception):
+    """the carblock isn't claimed by this worker any more"""
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def ensure_lease_schema(conn: psycopg.Connection) -> None:
+    """carblock_lease and its index, empty if they're new"""
+    create_q = """
+        CREATE TABLE IF NOT EXISTS carblock_lease (
+            carblock INT PRIMARY KEY,
+            state TEXT NOT NULL DEFAULT 'todo',
+            worker TEXT,
+            lease_until TIMESTAMPTZ,
+            heartbeat_tm TIMESTAMPTZ) ;"""
+    index_q = """
+        CREATE INDEX IF NOT EXISTS carblock_lease_todo
+        ON carblock_lease (carblock) WHERE state = 'todo' ;"""
+    with conn.cursor() as cur:
+        cur.execute(create_q)
+        cur.execute(index_q)
+    conn.commit()
+
+
+def ensure_lease_table(conn: psycopg.Connection) -> int:
+    """create carblock_lease if needed and bring it in line with fs: add the
+    carblocks not in it yet, reopen ('todo') any not being worked on that
+    have files not uploaded (gen-carblock-id.py renumbers carblocks, so a
+    'done' one can get new files), close ('done') any whose only files left
+    are given up on (preflight.py), and drop the ones with no files left.
+    Returns the number of carblocks added, reopened or closed."""
+    fill_q = f"""
+        INSERT INTO carblock_lease (carblock, state)
+        SELECT carblock,
+            CASE WHEN bool_and(car_url IS NOT NULL OR {preflight.GIVEN_UP})
+                THEN 'done' ELSE 'todo' END
+        FROM fs
+        WHERE carblock IS NOT NULL
+        GROUP BY carblock
+        ON CONFLICT (carblock) DO UPDATE
+        SET state = EXCLUDED.state, worker = NULL, lease_until = NULL
+        WHERE carblock_lease.state NOT IN ('todo', 'claimed')
+        AND carblock_lease.state <> EXCLUDED.state ;"""
+    gone_q = """
+        DELETE FROM carblock_lease l
+        WHERE state <> 'claimed'
+        AND NOT EXISTS (SELECT 1 FROM fs WHERE fs.carblock = l.carblock) ;"""
+    ensure_lease_schema(conn)
+    preflight.ensure_quarantine_table(conn)
+    with conn.cursor() as cur:
+        cur.execute(fill_q)
+        added = cur.rowcount
+        cur.execute(gone_q)
+        gone = cur.rowcount
+    conn.commit()
+    logger.info(
+        f"carblock_lease ready, {added} carblocks added or changed, {gone} removed"
+    )
+    return added
+
+
+def reap_stale_leases(conn: psycopg.Connection) -> int:
+    """hand back carblocks whose lease ran out (their worker died), and
+    clear the orphaned blocked_tm on their not-yet-uploaded files"""
+    reap_q = """
+        UPDATE carblock_lease
+        SET state = 'todo', worker = NULL, lease_until = NULL
+        WHERE state = 'claimed' AND lease_until < now()
+        RETURNING carblock ;"""
+    unblock_q = """
+        UPDATE fs SET blocked_tm = NULL
+        WHERE carblock = ANY(%s) AND car_url IS NULL ;"""
+    with conn.cursor() as cur:
+        cur.execute(reap_q)
+        reaped = [r[0] for r in cur.fetchall()]
+        if reaped:
+            cur.execute(unblock_q, (reaped,))
+    conn.commit()
+    if reaped:
+        logger.warning(f"reaped {len(reaped)} stale leases: carblocks={reaped}")
+    return len(reaped)
+
+
+def claim_carblock(
+    conn: psycopg.Connection,
+    worker: str,
+    lease_secs: int,
+    prefer: list | None = None,
+) -> int | None:
+    """atomically take the lowest unclaimed carblock, None if there are none.
+    Unclaimed carblocks in prefer (ones this host has half built) go first."""
+    claim_q = """
+        UPDATE carblock_lease l
+        SET state = 'claimed', worker = %s, heartbeat_tm = now(),
+            lease_until = now() + %s * interval '1 second'
+        FROM (
+            SELECT carblock FROM carblock_lease
+            WHERE state = 'todo' {}
+            ORDER BY carblock
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1) nxt
+        WHERE l.carblock = nxt.carblock
+        RETURNING l.carblock ;"""
+    row = None
+    with conn.cursor() as cur:
+        if prefer:
+            cur.execute(
+                claim_q.format("AND carblock = ANY(%s)"), (worker, lease_secs, prefer)
+            )
+            row = cur.fetchone()
+        if row is None:
+            cur.execute(claim_q.format(""), (worker, lease_secs))
+            row = cur.fetchone()
+    conn.commit()
+    return None if row is None else row[0]
+
+
+def release_carblock(
+    conn: psycopg.Connection, worker: str, carblock: int, state: str = "todo"
+) -> bool:
+    """end our lease: 'done' after upload, 'todo' to let someone retry"""
+    release_q = """
+        UPDATE carblock_lease
+        SET state = %s, worker = NULL, lease_until = NULL
+        WHERE carblock = %s AND worker = %s ;"""
+    with conn.cursor() as cur:
+        cur.execute(release_q, (state, carblock, worker))
+        ok = cur.rowcount == 1
+    conn.commit()
+    if not ok:
+        logger.error(f"carblock={carblock} was not leased by {worker}, lost lease?")
+    return ok
+
+
+def holds(
+    conn: psycopg.Connection, worker: str, carblock: int, lock: bool = False
+) -> bool:
+    """the carblock is still claimed by worker. With lock the lease row is
+    locked until conn's transaction ends, so the reaper can't take it in
+    between (the caller commits or rolls back)."""
+    holds_q = """
+        SELECT 1 FROM carblock_lease
+        WHERE carblock = %s AND worker = %s AND state = 'claimed'"""
+    if lock:
+        holds_q += " FOR UPDATE"
+    return conn.execute(holds_q, (carblock, worker)).fetchone() is not None
+
+
+class Heartbeat(threading.Thread):
+    """renews all of this worker's leases every lease_secs/3 seconds, on its
+    own autocommit connection so it never shares a transaction with the
+    main thread. A connection that fails is dropped and made again, with
+    backoff, until the beats get through."""
+
+    def __init__(self, connect, worker: str, lease_secs: int):
+        super().__init__(daemon=True, name="heartbeat")
+        self.connect = connect
+        self.worker = worker
+        self.lease_secs = lease_secs
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        beat_q = """
+            UPDATE carblock_lease
+            SET heartbeat_tm = now(),
+                lease_until = now() + %s * interval '1 second'
+            WHERE worker = %s AND state = 'claimed' ;"""
+        interval = self.lease_secs / 3
+        conn = None
+        failures = 0
+        wait = interval
+        while not self.stopped.wait(wait):
+            try:
+                if conn is None or conn.closed:
+                    conn = self.connect(autocommit=True)
+                conn.execute(beat_q, (self.lease_secs, self.worker))
+                failures, wait = 0, interval
+            except psycopg.Error as err:
+                failures += 1
+                wait = min(interval, 2**failures) * random.uniform(0.5, 1.5)
+                logger.warning(
+                    f"heartbeat failed ({failures} in a row): {err!r}, "
+                    f"reconnecting in {wait:.0f}s"
+                )
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg.Error:
+                        pass
+                    conn = None
+        if conn is not None:
+            conn.close()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+# done.
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-02
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/preflight.py
+
+"""check a carblock's source files before packing, and set aside the bad ones.
+
+get_filenames(check=True) used to stat the files one at a time and give
+up the whole carblock at the first missing file or OSError. Here every
+file is stat'ed and read at both ends on a thread pool; an OSError (the
+USB disks throw them and then recover) is retried with backoff, a missing
+file isn't. Files that still fail go into file_quarantine and the rest of
+the carblock is uploaded without them.
+
+make_repair_carblock() later gathers quarantined files into a new
+carblock, so car-to-ipfs.py --repair drives them again like any other. A
+file that fails max_attempts times is marked given_up: it stays in fs
+with no car_url, but it isn't probed again, and it doesn't keep its
+carblock from being done (GIVEN_UP)."""
+
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import logging
+import os
+from pathlib import Path
+import random
+import time
+from typing import List, Tuple
+
+# --- these are not part of the std library
+import psycopg  # noqa: E402
+
+# --- in this repo
+import carblocks
+
+logger = logging.getLogger("main")
+PROBE_BYTES = 64 * 1024
+# true for an fs row (not aliased) whose file has been given up on
+GIVEN_UP = """EXISTS (
+    SELECT 1 FROM file_quarantine q
+    WHERE (q.pth, q.fname) = (fs.pth, fs.fname) AND q.state = 'given_up')"""
+
+
+def probe(
+    pth: Path, retries: int = 3, backoff: float = 1.0, nbytes: int = PROBE_BYTES
+) -> Tuple[str | None, int]:
+    """(None, tries) if pth can be stat'ed and its first and last nbytes
+    read, else (the last error, tries)"""
+    for attempt in range(retries + 1):
+        try:
+            size = os.stat(pth).st_size
+            with open(pth, "rb") as f:
+                f.read(nbytes)
+                if size > nbytes:
+                    f.seek(max(nbytes, size - nbytes))
+                    f.read(nbytes)
+            return None, attempt + 1
+        except FileNotFoundError as err:
+            return f"missing: {err}", attempt + 1
+        except OSError as err:
+            msg = f"{errno.errorcode.get(err.errno, err.errno)}: {err}"
+            if attempt < retries:
+                time.sleep(backoff * 2**attempt * random.uniform(0.5, 1.5))
+    return msg, retries + 1
+
+
+def check_files(
+    files: List[Path], workers: int = 8, retries: int = 3, backoff: float = 1.0
+) -> Tuple[List[Path], List[Tuple[Path, str, int]], int]:
+    """(readable files, [(file, error, tries)], retries over all files),
+    probed workers at a time"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda p: probe(p, retries, backoff), files))
+    good = [p for p, (err, _) in zip(files, results) if err is None]
+    bad = [(p, err, n) for p, (err, n) in zip(files, results) if err is not None]
+    return good, bad, sum(n - 1 for _, n in results)
+
+
+def ensure_quarantine_table(conn: psycopg.Connection) -> None:
+    create_q = """
+        CREATE TABLE IF NOT EXISTS file_quarantine (
+            pth TEXT,
+            fname TEXT,
+            carblock INT,
+            error TEXT,
+            tries INT,
+            attempts INT NOT NULL DEFAULT 1,
+            state TEXT NOT NULL DEFAULT 'quarantined',
+            first_tm TIMESTAMPTZ DEFAULT now(),
+            last_tm TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (pth, fname)) ;"""
+    with conn.cursor() as cur:
+        cur.execute(create_q)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS file_quarantine_todo
+            ON file_quarantine (last_tm) WHERE state = 'quarantined' ;""")
+    conn.commit()
+
+
+def quarantine(
+    conn: psycopg.Connection, carblock: int, bad: list, max_attempts: int = 3
+) -> None:
+    """record bad files; the max_attempts-th failure of a file gives it up"""
+    upsert_q = """
+        INSERT INTO file_quarantine (pth, fname, carblock, error, tries)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (pth, fname) DO UPDATE
+        SET carblock = EXCLUDED.carblock,
+            error = EXCLUDED.error,
+            tries = EXCLUDED.tries,
+            attempts = file_quarantine.attempts + 1,
+            last_tm = now(),
+            state = CASE WHEN file_quarantine.attempts + 1 >= %s
+                THEN 'given_up' ELSE 'quarantined' END ;"""
+    rows = [
+        (str(p.parent), p.name, carblock, err, n, max_attempts) for p, err, n in bad
+    ]
+    with conn.cursor() as cur:
+        cur.executemany(upsert_q, rows)
+    conn.commit()
+    for p, err, n in bad[:5]:
+        logger.warning(f"quarantined {p} after {n} tries: {err}")
+    logger.warning(f"carblock={carblock}: {len(bad)} files quarantined")
+
+
+def mark_repaired(conn: psycopg.Connection, carblock: int) -> int:
+    """quarantined files from this carblock that have since been uploaded"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE file_quarantine q SET state = 'repaired', last_tm = now()
+            FROM fs f
+            WHERE f.carblock = %s AND f.car_url IS NOT NULL
+            AND (q.pth, q.fname) = (f.pth, f.fname)
+            AND q.state <> 'repaired' ;""",
+            (carblock,),
+        )
+        n = cur.rowcount
+    conn.commit()
+    if n:
+        logger.info(f"carblock={carblock}: {n} quarantined files repaired")
+    return n
+
+
+def make_repair_carblock(conn: psycopg.Connection, max_files: int = 1000) -> int | None:
+    """move up to max_files quarantined files into a new carblock and queue
+    it in carblock_lease; returns its number, or None if there's nothing"""
+    move_q = """
+        WITH nxt AS (SELECT coalesce(max(carblock), -1) + 1 AS cb FROM fs),
+        picked AS (
+            SELECT pth, fname, carblock AS old FROM file_quarantine
+            WHERE state = 'quarantined'
+            ORDER BY last_tm
+            LIMIT %s)
+        UPDATE fs f SET carblock = nxt.cb, blocked_tm = NULL
+        FROM nxt, picked p
+        WHERE (f.pth, f.fname) = (p.pth, p.fname) AND f.car_url IS NULL
+        RETURNING f.pth, f.fname, f.carblock, p.old ;"""
+    with conn.cursor() as cur:
+        cur.execute(move_q, (max_files,))
+        moved = cur.fetchall()
+        if not moved:
+            conn.rollback()
+            return None
+        carblock = moved[0][2]
+        cur.executemany(
+            """UPDATE file_quarantine SET state = 'repairing', carblock = %s
+            WHERE (pth, fname) = (%s, %s)""",
+            [(carblock, r[0], r[1]) for r in moved],
+        )
+        cur.execute(
+            """INSERT INTO carblock_lease (carblock, state) VALUES (%s, 'todo')
+            ON CONFLICT (carblock) DO UPDATE SET state = 'todo'""",
+            (carblock,),
+        )
+    conn.commit()
+    carblocks.refresh(conn, [carblock] + sorted({r[3] for r in moved}))
+    logger.info(f"repair carblock={carblock}: {len(moved)} quarantined files")
+    return carblock
+
+# done.
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-28
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/reconcile_cids.py
+
+"""one pass that brings file CIDs from every listing source into fs.
+
+add_file_cids_pg.py (dag json), add_cids_from_csv.py (`ipfs ls`) and the
+html scraping each parsed their own files and wrote fs their own way. This
+streams rows from all of them into one staging table, cid_staging, tagged
+with the source and file they came from, and then updates fs with one
+set-based merge.
+
+  dag-json  car-did-json/{cid}.json      fetch_meta.py -k json, `ipfs dag get`
+  ls        car-did-csv/{cid}.csv        fetch_meta.py -k ls, resolve_dir.py
+  html      car-did-html-csv/{cid}.csv   fetch_meta.py -k html, html_listing.py
+
+Only source files that are new or changed (by size and mtime, recorded in
+cid_staging_files) are read; their old staged rows are replaced, and only
+the cars they list are merged again. Rows go from a generator straight
+into COPY, so memory doesn't grow with the trove.
+
+When sources disagree about a file, the merge picks, in order: a row with
+a tsize, the source with the lower rank (dag-json, ls, html), the smaller
+CID, so the same staging table always gives the same fs. Disagreements are
+written to cid-conflicts.csv, and what's still missing to cid-gaps.csv,
+one line per carblock."""
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+import logging
+from pathlib import Path
+import tomllib as toml
+from typing import Iterator, List, Tuple
+
+# --- these are not part of the std library
+import psycopg  # noqa: E402
+
+# --- in this repo
+import carblocks
+import unixfs
+
+try:  # optional, parses the big dag json files several times faster
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+HDR = "https://w3s.link/ipfs/"
+RANK = {"dag-json": 1, "ls": 2, "html": 3}  # lower wins a conflict
+GLOB = {"dag-json": "*.json", "ls": "*.csv", "html": "*.csv"}
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="reconcile file CIDs into fs")
+    credsfile = f"{str(Path.home())}/creds/psql.toml"
+    parser.add_argument(
+        "-c", "--creds", help="Path to the postgres credentials file", default=credsfile
+    )
+    parser.add_argument(
+        "--json-dir", default="/var/tmp/pescados/car-did-json", help="dag json"
+    )
+    parser.add_argument(
+        "--ls-dir", default="/var/tmp/pescados/car-did-csv", help="`ipfs ls` csvs"
+    )
+    parser.add_argument(
+        "--html-dir",
+        default="/var/tmp/pescados/car-did-html-csv",
+        help="rows salvaged from html listings",
+    )
+    parser.add_argument(
+        "-s",
+        "--sources",
+        help="which sources to read",
+        nargs="+",
+        choices=list(RANK),
+        default=list(RANK),
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="parsing processes (1: no pool)", default=4, type=int
+    )
+    parser.add_argument(
+        "--full",
+        help="re-read every source file and re-merge every car",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        help="stage, merge and report, then roll it all back",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-o", "--outputdir", help="directory to write results", default="output/"
+    )
+    args = parser.parse_args()
+    assert Path(args.outputdir).exists()
+    args.dirs = {"dag-json": args.json_dir, "ls": args.ls_dir, "html": args.html_dir}
+
+    with open(args.creds, "rb") as f:
+        creds = toml.load(f)
+    args.conn = psycopg.connect(
+        autocommit=True,
+        host="localhost",
+        user=creds["user"],
+        password=creds["password"],
+        row_factory=psycopg.rows.namedtuple_row,
+        dbname="pescados",
+        port=5432,
+    )
+    del creds
+    return args
+
+
+def getlogger(args: argparse.Namespace) -> logging.Logger:
+    logger = logging.getLogger("main")
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        "[%(process)d] %(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    logpath = f"{args.outputdir}/{Path(__file__).stem}.log"
+    file_handler = logging.FileHandler(logpath, mode="a", encoding="utf-8")
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+    logger.addHandler(console_handler)
+    return logger
+
+
+def rows_dag_json(pth: Path) -> Iterator[Tuple[str, int | None, str]]:
+    """(fname, tsize, file_cid) from `ipfs dag get` json. Links not named
+    .gz are subdirectories or other files. A HAMT-sharded root gives no
+    rows: its links are bucket prefixes ("FF") and prefixed names
+    ("A3name.msg.gz"), and the files under its sub-shards aren't there at
+    all, so its files come from the ls source, via resolve_dir.py."""
+    with open(pth, "rb") as f:
+        js = json_loads(f.read())
+    if unixfs.dag_json_unixfs(js)["type"] == unixfs.UNIXFS_HAMT_SHARD:
+        logging.getLogger("main").warning(f"{pth.stem}: sharded, see resolve_dir.py")
+        return
+    for r in js.get("Links", []):
+        if r["Name"].endswith(".gz"):
+            yield r["Name"][:-3], r["Tsize"], r["Hash"]["/"]
+
+
+def rows_ls(pth: Path) -> Iterator[Tuple[str, int | None, str]]:
+    """(fname, tsize, file_cid) from `cid tsize name` lines, as `ipfs ls`,
+    resolve_dir.py and html_listing.py write them; a tsize of "-" is
+    unknown, and nested names are matched on their last part"""
+    with open(pth, "rt") as f:
+        for line in f:
+            cols = line.split(None, 2)
+            if len(cols) < 3:
+                continue
+            cid, tsize, name = cols[0], cols[1], cols[2].strip()
+            name = name.rsplit("/", 1)[-1]
+            if name.endswith(".gz"):
+                yield name[:-3], int(tsize) if tsize.isdigit() else None, cid
+
+
+PARSERS = {"dag-json": rows_dag_json, "ls": rows_ls, "html": rows_ls}
+
+
+def parse_file(source: str, pth: Path) -> Tuple[str, Path, List[tuple]]:
+    """one file's rows at once, for a worker process"""
+    return source, pth, list(PARSERS[source](pth))
+
+
+def changed_files(args: argparse.Namespace) -> List[Tuple[str, Path, int, float]]:
+    """(source, path, size, mtime) of the files not staged as they are now"""
+    with args.conn.cursor() as cur:
+        cur.execute("SELECT source, jfile, fsize, mtime FROM cid_staging_files")
+        staged = {(r.source, r.jfile): (r.fsize, r.mtime) for r in cur}
+    todo = []
+    for source in args.sources:
+        srcdir = Path(args.dirs[source])
+        if not srcdir.exists():
+            logger.warning(f"{source}: no directory {srcdir}")
+            continue
+        for pth in srcdir.glob(GLOB[source]):
+            st = pth.stat()
+            if st.st_size < 5:
+                continue
+            if not args.full and staged.get((source, pth.name)) == (
+                st.st_size,
+                st.st_mtime,
+            ):
+                continue
+            todo.append((source, pth, st.st_size, st.st_mtime))
+    logger.info(f"{len(todo)} source files to stage, {len(staged)} staged before")
+    return todo
+
+
+def parsed(args: argparse.Namespace, files: list) -> Iterator[Tuple[str, Path, list]]:
+    """parse_file over files, in order, with at most 4 * jobs in flight"""
+    if args.jobs <= 1:
+        for source, pth, *_ in files:
+            yield parse_file(source, pth)
+        return
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        pending = deque()
+        for source, pth, *_ in files:
+            pending.append(pool.submit(parse_file, source, pth))
+            if len(pending) >= 4 * args.jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def ensure_tables(args: argparse.Namespace) -> None:
+    with args.conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS cid_staging (
+                source TEXT,
+                jfile TEXT,
+                car_url VARCHAR(128),
+                fname TEXT,
+                tsize INTEGER,
+                file_cid VARCHAR(60)) ; """)
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS cid_staging_key ON cid_staging (car_url, fname)"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS cid_staging_file ON cid_staging (source, jfile)"
+        )
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS cid_staging_files (
+                source TEXT,
+                jfile TEXT,
+                fsize BIGINT,
+                mtime DOUBLE PRECISION,
+                nrows INTEGER,
+                staged_tm TIMESTAMPTZ DEFAULT now(),
+                PRIMARY KEY (source, jfile)) ; """)
+        cur.execute("ALTER TABLE fs ADD COLUMN IF NOT EXISTS cid_source TEXT")
+
+
+def stage(args: argparse.Namespace, cur, files: list) -> int:
+    """replace the staged rows of each changed file with what it says now"""
+    files_q = """
+        INSERT INTO cid_staging_files (source, jfile, fsize, mtime, nrows)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (source, jfile) DO UPDATE
+        SET fsize = EXCLUDED.fsize, mtime = EXCLUDED.mtime,
+            nrows = EXCLUDED.nrows, staged_tm = now() ; """
+    cur.execute("CREATE TEMP TABLE restaged (source TEXT, jfile TEXT) ON COMMIT DROP")
+    with cur.copy("COPY restaged (source, jfile) FROM STDIN") as copy:
+        for source, pth, *_ in files:
+            copy.write_row((source, pth.name))
+    cur.execute("""
+        DELETE FROM cid_staging s USING restaged r
+        WHERE s.source = r.source AND s.jfile = r.jfile""")
+    logger.info(f"dropped {cur.rowcount} stale staged rows")
+
+    nrows = 0
+    ledger = []
+    stats = {pth: (size, mtime) for _, pth, size, mtime in files}
+    copy_q = """COPY cid_staging (source, jfile, car_url, fname, tsize, file_cid)
+        FROM STDIN"""
+    with cur.copy(copy_q) as copy:
+        for source, pth, rows in parsed(args, files):
+            car_url = HDR + pth.name.split(".")[0]
+            for fname, tsize, file_cid in rows:
+                copy.write_row((source, pth.name, car_url, fname, tsize, file_cid))
+            nrows += len(rows)
+            ledger.append((source, pth.name, *stats[pth], len(rows)))
+    cur.executemany(files_q, ledger)
+    logger.info(f"staged {nrows} rows from {len(files)} files")
+    return nrows
+
+
+def merge(args: argparse.Namespace, cur, files: list) -> int:
+    """one UPDATE of fs from the winning staged row of each file, for the
+    cars the changed files list (every staged car, with --full)"""
+    cur.execute("CREATE TEMP TABLE touched (car_url VARCHAR(128)) ON COMMIT DROP")
+    if args.full:
+        cur.execute("INSERT INTO touched SELECT DISTINCT car_url FROM cid_staging")
+    else:
+        cars = sorted({HDR + pth.name.split(".")[0] for _, pth, *_ in files})
+        with cur.copy("COPY touched (car_url) FROM STDIN") as copy:
+            for car_url in cars:
+                copy.write_row((car_url,))
+    cur.execute("ANALYZE touched")
+    ranks = ", ".join(f"('{s}', {r})" for s, r in RANK.items())
+    cur.execute(f"""
+        WITH pick AS (
+            SELECT DISTINCT ON (s.car_url, s.fname)
+                s.car_url, s.fname, s.tsize, s.file_cid, s.source
+            FROM cid_staging s
+            JOIN touched t ON s.car_url = t.car_url
+            JOIN (VALUES {ranks}) AS r (source, rank) ON r.source = s.source
+            ORDER BY s.car_url, s.fname, s.tsize IS NULL, r.rank, s.file_cid)
+        UPDATE fs f
+        SET file_cid = p.file_cid,
+            tsize = coalesce(p.tsize, f.tsize),
+            cid_source = p.source
+        FROM pick p
+        WHERE f.car_url = p.car_url
+        AND f.fname = p.fname
+        AND (f.file_cid IS DISTINCT FROM p.file_cid
+            OR f.tsize IS DISTINCT FROM coalesce(p.tsize, f.tsize)
+            OR f.cid_source IS DISTINCT FROM p.source) ; """)
+    chgd = cur.rowcount
+    logger.info(f"merged: {chgd} rows of fs changed")
+    return chgd
+
+
+def report_conflicts(args: argparse.Namespace, cur) -> int:
+    """files the sources give different CIDs, among the touched cars"""
+    cur.execute("""
+        SELECT s.car_url, s.fname,
+            string_agg(DISTINCT s.source || '=' || s.file_cid, ' ') AS cids
+        FROM cid_staging s JOIN touched t ON s.car_url = t.car_url
+        GROUP BY s.car_url, s.fname
+        HAVING count(DISTINCT s.file_cid) > 1""")
+    n = 0
+    with open(f"{args.outputdir}/cid-conflicts.csv", "wt", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["car_url", "fname", "cids"])
+        for r in cur:
+            writer.writerow([r.car_url, r.fname, r.cids])
+            n += 1
+    if n:
+        logger.warning(f"{n} files with conflicting CIDs, see cid-conflicts.csv")
+    return n
+
+
+def report_gaps(args: argparse.Namespace) -> int:
+    """per carblock: files, files still without a CID or tsize, and which
+    sources have listed its car. Streams, one row per carblock with gaps;
+    run it in a transaction, for the named cursor."""
+    gaps_q = """
+        WITH seen AS (
+            SELECT %s || split_part(jfile, '.', 1) AS car_url,
+                string_agg(DISTINCT source, ',') AS sources
+            FROM cid_staging_files
+            GROUP BY 1)
+        SELECT f.carblock, f.car_url, count(*) AS nfiles,
+            count(*) FILTER (WHERE f.file_cid IS NULL) AS no_cid,
+            count(*) FILTER (WHERE f.tsize IS NULL) AS no_tsize,
+            coalesce(min(seen.sources), '') AS sources
+        FROM fs f LEFT JOIN seen ON f.car_url = seen.car_url
+        WHERE f.car_url IS NOT NULL
+        GROUP BY f.carblock, f.car_url
+        HAVING count(*) FILTER (WHERE f.file_cid IS NULL OR f.tsize IS NULL) > 0
+        ORDER BY f.carblock"""
+    cols = ["carblock", "car_url", "nfiles", "no_cid", "no_tsize", "sources"]
+    nblocks = no_cid = no_tsize = 0
+    with args.conn.cursor(name="gaps") as cur:
+        cur.execute(gaps_q, (HDR,))
+        with open(f"{args.outputdir}/cid-gaps.csv", "wt", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(cols)
+            for r in cur:
+                writer.writerow([getattr(r, c) for c in cols])
+                nblocks += 1
+                no_cid += r.no_cid
+                no_tsize += r.no_tsize
+    logger.info(
+        f"gaps: {no_cid} files without a CID, {no_tsize} without a tsize, "
+        f"in {nblocks} carblocks (cid-gaps.csv)"
+    )
+    return no_cid
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logger = getlogger(args)
+    ensure_tables(args)
+
+    files = changed_files(args)
+    with args.conn.transaction():
+        with args.conn.cursor() as cur:
+            if files:
+                stage(args, cur, files)
+            if files or args.full:
+                merge(args, cur, files)
+                report_conflicts(args, cur)
+        report_gaps(args)
+        if args.dry_run:
+            logger.info("dry run, rolling back")
+            raise psycopg.Rollback()
+    if not args.dry_run and (files or args.full):
+        carblocks.ensure_table(args.conn)
+        carblocks.refresh(args.conn)
+    args.conn.close()
+
+# done.
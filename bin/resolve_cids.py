@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-14
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/resolve_cids.py
+
+"""the file_cid of each uploaded file still without one, one path at a time.
+
+The last ~135K files without a file_cid are in cars whose listing never
+comes back whole (dag get, ipfs ls, the html), but
+{gateway}/ipfs/{car_cid}/{car_path} works for every one of them, and the
+gateway has to resolve the path to the file's CID to answer. So instead
+of listing the directory, ask for each file:
+
+  head  HEAD the path; the CID is the last of X-Ipfs-Roots (or the Etag).
+        Nothing but headers comes back, so there's no tsize: fs.tsize is
+        left as it was (NULL, for these files).
+  raw   GET the path with ?format=raw: the file's root block, a few KB.
+        Its CID is computed from the bytes (so it's checked, not taken on
+        the gateway's word), and tsize comes with it.
+
+Use raw when tsize is wanted too. A file resolved by head has its
+file_cid, so a later run won't ask for it again.
+
+With head, a path whose headers don't name a CID is tried with raw. Each
+(car_url, car_path) is asked once however many fs rows share it (the
+--dedup copies do). Requests rotate over the gateways on each retry, with
+jittered exponential backoff (fetch_meta.py), and thousands in flight on
+one asyncio loop. Results go back to fs in batches, by COPY and one joined
+UPDATE (as hash_files.py), so a run that's stopped keeps what it found;
+re-running asks only for what's still missing. Paths that fail are
+written to --failed. To test without the real network, point --gateway
+at bin/stand-in-gateway.py."""
+
+import argparse
+import asyncio
+import logging
+from pathlib import Path
+import random
+import time
+import tomllib as toml
+from types import SimpleNamespace
+from typing import List, Tuple
+from urllib.parse import quote
+
+# --- these are not part of the std library
+import aiohttp  # noqa: E402
+import psycopg  # noqa: E402
+
+# --- in this repo
+from fetch_meta import RETRY_STATUS, Permanent, backoff
+import unixfs
+
+logger = logging.getLogger("main")
+RAW = "application/vnd.ipld.raw"
+
+
+def pg_connect(credsfile: str, **kwargs) -> psycopg.Connection:
+    with open(credsfile, "rb") as f:
+        creds = toml.load(f)
+    return psycopg.connect(
+        host=creds.get("host", "localhost"),
+        user=creds["user"],
+        password=creds["password"],
+        row_factory=psycopg.rows.namedtuple_row,
+        dbname=creds["dbname"],
+        port=creds.get("port", 5432),
+        **kwargs,
+    )
+
+
+def unresolved(conn: psycopg.Connection, limit: int | None) -> list:
+    """(car_url, car_path) of the uploaded files without a file_cid"""
+    unresolved_q = """
+        SELECT DISTINCT car_url, coalesce(car_path, fname || '.gz') AS car_path
+        FROM fs WHERE file_cid IS NULL AND car_url IS NOT NULL
+        ORDER BY car_url, car_path"""
+    if limit:
+        unresolved_q += f" LIMIT {int(limit)}"
+    rows = conn.execute(unresolved_q).fetchall()
+    conn.commit()
+    return rows
+
+
+def write_batch(conn: psycopg.Connection, batch: list) -> int:
+    """(car_url, car_path, file_cid, tsize) rows into fs; returns rows set"""
+    with conn.cursor() as cur:
+        cur.execute(
+            "CREATE TEMP TABLE resolved (car_url TEXT, car_path TEXT, "
+            "file_cid TEXT, tsize BIGINT) ON COMMIT DROP"
+        )
+        with cur.copy(
+            "COPY resolved (car_url, car_path, file_cid, tsize) FROM STDIN"
+        ) as copy:
+            for row in batch:
+                copy.write_row(row)
+        cur.execute("""
+            UPDATE fs f
+            SET file_cid = r.file_cid, tsize = coalesce(r.tsize, f.tsize)
+            FROM resolved r
+            WHERE f.car_url = r.car_url AND f.file_cid IS NULL
+            AND coalesce(f.car_path, f.fname || '.gz') = r.car_path""")
+        n = cur.rowcount
+    conn.commit()
+    return n
+
+
+def car_cid_of(car_url: str) -> str:
+    return car_url.rstrip("/").split("/")[-1]
+
+
+def block_cid(block: bytes, claimed: str | None) -> Tuple[str, int]:
+    """the CID and tsize of a file's root block. If the gateway named a CID
+    the block has to hash to it; otherwise the codec is worked out from
+    the block (a UnixFS file node, or a raw leaf)."""
+    if claimed is not None:
+        codec = unixfs.cid_codec(unixfs.cid_bytes(claimed))
+    else:
+        codec = unixfs.CODEC_RAW
+        try:
+            _, data = unixfs.decode_dag_pb(block)
+            if data and unixfs.decode_unixfs(data)["type"] == unixfs.UNIXFS_FILE:
+                codec = unixfs.CODEC_DAG_PB
+        except Exception:
+            pass
+    cid = unixfs.cid_str(unixfs.make_cid(codec, block))
+    if claimed is not None and cid != claimed:
+        raise ValueError(f"block hashes to {cid}, gateway says {claimed}")
+    tsize = len(block)
+    if codec == unixfs.CODEC_DAG_PB:
+        links, _ = unixfs.decode_dag_pb(block)
+        tsize += sum(lk.tsize for lk in links)
+    return cid, tsize
+
+
+def header_cid(headers, car_cid: str) -> str | None:
+    """the path's CID from X-Ipfs-Roots (root first, the file last), or
+    from the Etag"""
+    roots = [r.strip() for r in headers.get("X-Ipfs-Roots", "").split(",")]
+    if len(roots) > 1 and roots[0] == car_cid and unixfs.is_cid(roots[-1]):
+        return roots[-1]
+    etag = headers.get("Etag", "").strip().removeprefix("W/").strip('"')
+    if etag != car_cid and unixfs.is_cid(etag):
+        return etag
+    return None
+
+
+class Resolver:
+    def __init__(self, args: argparse.Namespace, session: aiohttp.ClientSession):
+        self.args = args
+        self.session = session
+        self.endpoints = args.gateway or ["https://w3s.link"]
+        self.results = asyncio.Queue()
+        self.counts = {}
+        self.failed = open(args.failed, "at", buffering=1)
+
+    def url(self, endpoint: str, car_cid: str, car_path: str) -> str:
+        return f"{endpoint}/ipfs/{car_cid}/{quote(car_path)}"
+
+    async def _check(self, response: aiohttp.ClientResponse) -> None:
+        if response.status in RETRY_STATUS:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                await asyncio.sleep(min(int(retry_after), self.args.max_backoff))
+            raise aiohttp.ClientResponseError(
+                response.request_info,
+                response.history,
+                status=response.status,
+                message=response.reason or "",
+            )
+        if response.status == 404:
+            raise Permanent(f"{response.url} not found")
+        if response.status != 200:
+            raise Permanent(f"{response.url} returned {response.status}")
+
+    async def by_head(self, endpoint: str, car_cid: str, car_path: str):
+        """(CID, None): a HEAD doesn't tell the tsize"""
+        url = self.url(endpoint, car_cid, car_path)
+        async with self.session.head(url, allow_redirects=True) as response:
+            await self._check(response)
+            return header_cid(response.headers, car_cid), None
+
+    async def by_raw(self, endpoint: str, car_cid: str, car_path: str):
+        url = self.url(endpoint, car_cid, car_path)
+        async with self.session.get(
+            url, params={"format": "raw"}, headers={"Accept": RAW}
+        ) as response:
+            await self._check(response)
+            claimed = header_cid(response.headers, car_cid)
+            block = await response.read()
+        return block_cid(block, claimed)
+
+    async def resolve(self, row: SimpleNamespace) -> None:
+        car_cid = car_cid_of(row.car_url)
+        note = ""
+        first = random.randrange(len(self.endpoints))
+        for attempt in range(self.args.retries):
+            endpoint = self.endpoints[(first + attempt) % len(self.endpoints)]
+            try:
+                cid = tsize = None
+                if self.args.method == "head":
+                    cid, tsize = await asyncio.wait_for(
+                        self.by_head(endpoint, car_cid, row.car_path),
+                        self.args.timeout,
+                    )
+                if cid is None:
+                    cid, tsize = await asyncio.wait_for(
+                        self.by_raw(endpoint, car_cid, row.car_path),
+                        self.args.timeout,
+                    )
+            except Permanent as err:
+                note = str(err)
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+                note = f"{type(err).__name__}: {err}"
+            else:
+                await self.results.put((row.car_url, row.car_path, cid, tsize))
+                self.counts["ok"] = self.counts.get("ok", 0) + 1
+                return
+            logger.debug(f"{row.car_path} attempt {attempt + 1} via {endpoint}: {note}")
+            if attempt + 1 < self.args.retries:
+                await asyncio.sleep(
+                    backoff(attempt, self.args.backoff, self.args.max_backoff)
+                )
+        self.counts["failed"] = self.counts.get("failed", 0) + 1
+        note = note.replace("\t", " ").replace("\n", " ")[:200]
+        self.failed.write(f"{row.car_url}\t{row.car_path}\t{note}\n")
+
+    async def writer(self, conn: psycopg.Connection) -> int:
+        """results to fs, a batch at a time, off the event loop"""
+        nrows = 0
+        batch = []
+        last = time.monotonic()
+        while True:
+            item = await self.results.get()
+            if item is not None:
+                batch.append(item)
+            full = len(batch) >= self.args.batch
+            if batch and (full or item is None or time.monotonic() - last > 60):
+                nrows += await asyncio.to_thread(write_batch, conn, batch)
+                logger.info(f"{nrows} fs rows resolved, {self.counts}")
+                batch, last = [], time.monotonic()
+            if item is None:
+                return nrows
+
+    async def run(self, rows: list, conn: psycopg.Connection) -> int:
+        todo = asyncio.Queue()
+        for row in rows:
+            todo.put_nowait(row)
+
+        async def worker():
+            while not todo.empty():
+                await self.resolve(todo.get_nowait())
+
+        writing = asyncio.create_task(self.writer(conn))
+        await asyncio.gather(*[worker() for _ in range(self.args.jobs)])
+        await self.results.put(None)
+        nrows = await writing
+        self.failed.close()
+        return nrows
+
+
+async def resolve_all(
+    args: argparse.Namespace, rows: List, conn: psycopg.Connection
+) -> int:
+    connector = aiohttp.TCPConnector(limit=args.jobs, limit_per_host=args.per_host)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await Resolver(args, session).run(rows, conn)
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="resolve file CIDs path by path")
+    credsfile = f"{str(Path.home())}/creds/psql.toml"
+    parser.add_argument(
+        "-c", "--creds", help="Path to the postgres credentials file", default=credsfile
+    )
+    parser.add_argument(
+        "-g", "--gateway", help="gateway base url, repeatable", action="append"
+    )
+    parser.add_argument(
+        "-m",
+        "--method",
+        help="headers only (falls back to raw; leaves tsize NULL), or the root "
+        "block (gives tsize too)",
+        choices=["head", "raw"],
+        default="head",
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="requests in flight", default=1000, type=int
+    )
+    parser.add_argument(
+        "--per-host", help="requests in flight to any one host", default=200, type=int
+    )
+    parser.add_argument(
+        "-b", "--batch", help="results per commit", default=5000, type=int
+    )
+    parser.add_argument("--retries", default=6, type=int)
+    parser.add_argument(
+        "--timeout", help="seconds for one attempt", default=120, type=float
+    )
+    parser.add_argument(
+        "--backoff", help="first backoff, seconds", default=2.0, type=float
+    )
+    parser.add_argument("--max-backoff", default=120.0, type=float)
+    parser.add_argument("--limit", help="only this many paths", type=int)
+    parser.add_argument(
+        "-f",
+        "--failed",
+        help="where to append the paths that couldn't be resolved",
+        default="/var/tmp/pescados/resolve-failed.tsv",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    Path(args.failed).parent.mkdir(parents=True, exist_ok=True)
+    with pg_connect(args.creds) as conn:
+        rows = unresolved(conn, args.limit)
+        logger.info(f"{len(rows)} paths without a file_cid")
+        nrows = asyncio.run(resolve_all(args, rows, conn))
+    logger.info(f"done: {nrows} fs rows resolved")
+
+# done.
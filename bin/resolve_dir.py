@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-24
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/resolve_dir.py
+
+"""list every file in a car directory, following HAMT shards.
+
+`ipfs dag get` shows a sharded directory's top node only, so its links are
+named like "FF" (a sub-shard) or "A3name.gz" (a file behind its bucket
+prefix), and json2tbl() read those as filenames. This walks the shards
+itself, one raw block at a time, so it returns the whole listing.
+
+Every block is checked against its CID before it's used or cached, so a
+truncated download is an error, never a short listing, and a shard whose
+link count doesn't match its bitfield is an error too. Blocks are cached
+on disk by CID, so re-runs and overlapping shards are fetched once.
+
+The output is one csv per car CID in the `ipfs ls` format
+(`cid tsize name`), so add_cids_from_csv.py reads it as is."""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
+import logging
+import os
+from pathlib import Path
+import subprocess
+import tempfile
+from typing import Callable, List
+
+# --- in this repo
+import unixfs
+
+logger = logging.getLogger("main")
+sr = partial(subprocess.run, capture_output=True)
+
+
+class BlockError(Exception):
+    """a block that's missing, truncated, or isn't what its CID says"""
+
+
+def verify_block(cid: str, block: bytes) -> None:
+    raw = unixfs.cid_bytes(cid)
+    if raw[-32:] != hashlib.sha256(block).digest():
+        raise BlockError(f"{cid}: {len(block)} bytes don't hash to the cid")
+
+
+def fetch_gateway(cid: str, gateway: str = "https://w3s.link", timeout=60) -> bytes:
+    import requests  # only needed for this fetcher
+
+    response = requests.get(
+        f"{gateway}/ipfs/{cid}",
+        params={"format": "raw"},
+        headers={"Accept": "application/vnd.ipld.raw"},
+        timeout=timeout,
+    )
+    if response.status_code != 200:
+        raise BlockError(f"{cid}: gateway returned {response.status_code}")
+    return response.content
+
+
+def fetch_kubo(cid: str, timeout=120) -> bytes:
+    result = sr(["ipfs", "block", "get", cid], timeout=timeout)
+    if result.returncode != 0:
+        raise BlockError(f"{cid}: ipfs block get failed {result.stderr!r}")
+    return result.stdout
+
+
+class BlockStore:
+    """verified, content-addressed block cache in front of a fetcher. With
+    cachedir=None the blocks are kept in memory instead."""
+
+    def __init__(self, cachedir: Path | str | None, fetch: Callable[[str], bytes]):
+        self.cachedir = None if cachedir is None else Path(cachedir)
+        if self.cachedir is not None:
+            self.cachedir.mkdir(parents=True, exist_ok=True)
+        self.mem = {}
+        self.fetch = fetch
+        self.hits = self.misses = 0
+
+    def path(self, cid: str) -> Path:
+        return self.cachedir / cid[-2:] / cid
+
+    def get(self, cid: str) -> bytes:
+        if self.cachedir is None:
+            if cid not in self.mem:
+                self.misses += 1
+                block = self.fetch(cid)
+                verify_block(cid, block)
+                self.mem[cid] = block
+            return self.mem[cid]
+        pth = self.path(cid)
+        if pth.exists():
+            self.hits += 1
+            return pth.read_bytes()
+        self.misses += 1
+        block = self.fetch(cid)
+        verify_block(cid, block)
+        pth.parent.mkdir(exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=pth.parent)
+        with os.fdopen(fd, "wb") as f:
+            f.write(block)
+        os.replace(tmpname, pth)
+        return block
+
+
+def _node(store: BlockStore, cid: str) -> tuple:
+    links, data = unixfs.decode_dag_pb(store.get(cid))
+    if data is None:
+        raise BlockError(f"{cid}: dag-pb node without UnixFS data")
+    return links, unixfs.decode_unixfs(data)
+
+
+def list_dir(
+    store: BlockStore, cid: str, pool: ThreadPoolExecutor | None = None
+) -> List[unixfs.FileCID]:
+    """the complete (name, cid, tsize) listing of a directory, flat or HAMT"""
+    links, ufs = _node(store, cid)
+    if ufs["type"] == unixfs.UNIXFS_DIRECTORY:
+        return [
+            unixfs.FileCID(hash=unixfs.cid_str(lk.cid), name=lk.name, tsize=lk.tsize)
+            for lk in links
+        ]
+    if ufs["type"] != unixfs.UNIXFS_HAMT_SHARD:
+        raise BlockError(f"{cid}: not a directory (UnixFS type {ufs['type']})")
+    return _list_shard(store, cid, links, ufs, pool)
+
+
+def _list_shard(store, cid, links, ufs, pool) -> List[unixfs.FileCID]:
+    bits = sum(bin(b).count("1") for b in ufs["data"] or b"")
+    if bits != len(links):
+        raise BlockError(f"{cid}: shard has {len(links)} links, bitfield says {bits}")
+    padlen = len(f"{(ufs['fanout'] or unixfs.HAMT_FANOUT) - 1:X}")
+    subshards = [lk for lk in links if len(lk.name) == padlen]
+    if pool is not None:  # warm the cache for this level in parallel
+        list(pool.map(store.get, [unixfs.cid_str(lk.cid) for lk in subshards]))
+
+    out = []
+    for lk in links:
+        child = unixfs.cid_str(lk.cid)
+        if len(lk.name) == padlen:
+            sublinks, subufs = _node(store, child)
+            if subufs["type"] != unixfs.UNIXFS_HAMT_SHARD:
+                raise BlockError(f"{child}: expected a HAMT shard under {cid}")
+            out.extend(_list_shard(store, child, sublinks, subufs, pool))
+        else:
+            name = lk.name[padlen:]
+            out.append(unixfs.FileCID(hash=child, name=name, tsize=lk.tsize))
+    return out
+
+
+def walk_dir(
+    store: BlockStore, cid: str, prefix: str = "", pool=None
+) -> List[unixfs.FileCID]:
+    """like list_dir, but descends into subdirectories (the nested layout),
+    naming files by their path inside the car"""
+    out = []
+    for entry in list_dir(store, cid, pool):
+        raw = unixfs.cid_bytes(entry.hash)
+        if unixfs.cid_codec(raw) == unixfs.CODEC_DAG_PB:
+            _, ufs = _node(store, entry.hash)
+            if ufs["type"] in (unixfs.UNIXFS_DIRECTORY, unixfs.UNIXFS_HAMT_SHARD):
+                out.extend(walk_dir(store, entry.hash, f"{prefix}{entry.name}/", pool))
+                continue
+        out.append(entry._replace(name=f"{prefix}{entry.name}"))
+    return out
+
+
+def cat_file(store: BlockStore, cid: str) -> bytes:
+    """a file's bytes: a raw leaf, or the leaves under a UnixFS file node"""
+    if unixfs.cid_codec(unixfs.cid_bytes(cid)) == unixfs.CODEC_RAW:
+        return store.get(cid)
+    links, ufs = _node(store, cid)
+    if ufs["type"] != unixfs.UNIXFS_FILE:
+        raise BlockError(f"{cid}: not a file (UnixFS type {ufs['type']})")
+    return (ufs["data"] or b"") + b"".join(
+        cat_file(store, unixfs.cid_str(lk.cid)) for lk in links
+    )
+
+
+def resolve_path(store: BlockStore, root: str, path: str) -> List[str]:
+    """the CIDs from root down to root/path, like a gateway's X-Ipfs-Roots"""
+    cids = [root]
+    for name in [p for p in path.split("/") if p]:
+        entries = {e.name: e.hash for e in list_dir(store, cids[-1])}
+        if name not in entries:
+            raise FileNotFoundError(f"{name} not in {cids[-1]}")
+        cids.append(entries[name])
+    return cids
+
+
+def write_listing(outdir: Path, car_cid: str, entries: List[unixfs.FileCID]) -> Path:
+    """`ipfs ls` format, written whole or not at all"""
+    outpth = outdir / f"{car_cid}.csv"
+    fd, tmpname = tempfile.mkstemp(dir=outdir, suffix=".part")
+    with os.fdopen(fd, "wt") as f:
+        for e in entries:
+            f.write(f"{e.hash} {e.tsize} {e.name}\n")
+    os.replace(tmpname, outpth)
+    return outpth
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="list car dirs through HAMT shards")
+    parser.add_argument(
+        "-i", "--cids", help="file with one car CID per line", required=True
+    )
+    parser.add_argument(
+        "-t",
+        "--tmpdir",
+        help="where to write one {cid}.csv per car",
+        default="/var/tmp/pescados/car-did-csv",
+    )
+    parser.add_argument(
+        "-b",
+        "--blockcache",
+        help="on-disk block cache",
+        default="/var/tmp/pescados/blocks",
+    )
+    parser.add_argument(
+        "-f",
+        "--fetcher",
+        help="get blocks from a gateway (?format=raw) or from `ipfs block get`",
+        choices=["gateway", "kubo"],
+        default="gateway",
+    )
+    parser.add_argument("-g", "--gateway", default="https://w3s.link")
+    parser.add_argument("-j", "--jobs", help="parallel fetches", default=8, type=int)
+    parser.add_argument(
+        "--redo", help="re-list cids that already have a csv", action="store_true"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(process)d] %(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    if args.fetcher == "kubo":
+        fetch = fetch_kubo
+    else:
+        fetch = partial(fetch_gateway, gateway=args.gateway)
+    store = BlockStore(args.blockcache, fetch)
+    outdir = Path(args.tmpdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    with open(args.cids, "rt") as f:
+        cids = [line.strip() for line in f if line.strip()]
+    ok = failed = 0
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for car_cid in cids:
+            if not args.redo and (outdir / f"{car_cid}.csv").exists():
+                continue
+            try:
+                entries = walk_dir(store, car_cid, pool=pool)
+            except (BlockError, ValueError, OSError) as err:
+                logger.warning(f"{car_cid} incomplete, not written: {err}")
+                failed += 1
+                continue
+            write_listing(outdir, car_cid, entries)
+            logger.info(f"{car_cid}: {len(entries)} files")
+            ok += 1
+    logger.info(
+        f"{ok} listings written, {failed} failed; "
+        f"block cache hits={store.hits} misses={store.misses}"
+    )
+
+# done.
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-10
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/scratch.py
+
+"""where carblocks are built, and how many fit at once.
+
+A carblock takes its staged .gz files and its car on disk at the same
+time, ~2x its bytes (the car alone with --stream). Everything used to go
+in /var/tmp with nothing checking that it fit, so raising --inflight or
+--build-workers could fill the disk halfway through a run, and a dead
+worker's tmp*.car and tmp*/ stayed until someone ran the shell loop.
+
+Each --scratch root (e.g. /var/tmp, or /dev/shm:16G on tmpfs) has a
+budget, the SIZE given or else its free space at startup less
+--scratch-reserve. Before a carblock is built it's admitted: its
+footprint is estimated from its bytes, and it gets the root with the most
+budget left that it fits in. If none has room it waits until a carblock
+in flight finishes; a carblock that fits nowhere is let in only when
+nothing else is in flight, as before.
+
+What's built is named trove-{pid}-c{carblock}-*, and the admissions are
+files in {root}/.trove-scratch/ (so every worker on the host counts
+them). At startup, anything named for a pid that's no longer running is
+removed, unless the journal (journal.py) still points at it."""
+
+from contextlib import contextmanager
+import fcntl
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+from types import SimpleNamespace
+from typing import Iterable, Iterator, List, Tuple
+
+logger = logging.getLogger("main")
+GB = 1024**3
+UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": GB, "T": 1024**4}
+ARTIFACT_RE = re.compile(r"^trove-(\d+)-c(\d+)-")
+ADMIT_DIR = ".trove-scratch"
+
+
+def parse_size(s: str) -> int:
+    """'16G' -> bytes"""
+    m = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)B?\s*", s.upper())
+    if m is None:
+        raise ValueError(f"not a size: {s!r}")
+    return int(float(m.group(1)) * UNITS[m.group(2)])
+
+
+def fstype(pth: Path) -> str:
+    """the filesystem type of the mount pth is on"""
+    best, kind = "", "?"
+    try:
+        with open("/proc/mounts", "rt") as f:
+            for line in f:
+                _, mnt, typ = line.split()[:3]
+                if str(pth).startswith(mnt) and len(mnt) > len(best):
+                    best, kind = mnt, typ
+    except OSError:
+        pass
+    return kind
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Scratch:
+    def __init__(self, roots: List[str], reserve: int = 0, ratio: float = 1.05):
+        self.reserve = reserve
+        self.ratio = ratio
+        self.pid = os.getpid()
+        self.roots = []
+        for spec in roots:
+            pth, _, size = spec.partition(":")
+            pth = Path(pth)
+            pth.mkdir(parents=True, exist_ok=True)
+            (pth / ADMIT_DIR).mkdir(exist_ok=True)
+            self.roots.append(
+                SimpleNamespace(
+                    pth=pth,
+                    size=parse_size(size) if size else None,
+                    budget=None,
+                    fstype=fstype(pth.resolve()),
+                )
+            )
+
+    def set_budgets(self) -> None:
+        """after gc(), so the orphans' space counts as free"""
+        for r in self.roots:
+            free = shutil.disk_usage(r.pth).free
+            r.budget = r.size if r.size is not None else max(0, free - self.reserve)
+            logger.info(
+                f"scratch {r.pth} ({r.fstype}): budget {r.budget / GB:.1f}GB, "
+                f"{free / GB:.1f}GB free"
+            )
+
+    def estimate(self, nbytes: int, stream: bool) -> int:
+        """the staged files and the car, or just the car"""
+        return int(nbytes * self.ratio * (1 if stream else 2))
+
+    @contextmanager
+    def _locked(self, root: SimpleNamespace) -> Iterator:
+        """one admission at a time per root, across processes"""
+        with open(root.pth / ADMIT_DIR / "lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def admitted(self, root: SimpleNamespace) -> int:
+        """bytes held by the live admissions in root"""
+        total = 0
+        for p in (root.pth / ADMIT_DIR).glob("*.admit"):
+            pid = int(p.stem.split("-", 1)[0])
+            if not pid_alive(pid):
+                p.unlink(missing_ok=True)
+                continue
+            try:
+                total += int(p.read_text())
+            except (OSError, ValueError):
+                pass
+        return total
+
+    def _left(self, root: SimpleNamespace) -> int:
+        """budget not yet admitted in root; call with root locked"""
+        return min(
+            root.budget - self.admitted(root),
+            shutil.disk_usage(root.pth).free - self.reserve,
+        )
+
+    def admit(
+        self, carblock: int, nbytes: int, force: bool = False
+    ) -> SimpleNamespace | None:
+        """room for a carblock of footprint nbytes, None if it has to wait.
+        With force it's let in to the emptiest root however big it is."""
+        best = None
+        for r in self.roots:
+            with self._locked(r):
+                left = self._left(r)
+            if best is None or left > best[1]:
+                best = (r, left)
+        root = best[0]
+        admit_pth = root.pth / ADMIT_DIR / f"{self.pid}-{carblock}.admit"
+        with self._locked(root):
+            # again, under the lock the .admit is written with: another
+            # worker may have been admitted here since
+            left = self._left(root)
+            if nbytes > left and not force:
+                logger.debug(f"carblock={carblock}: {nbytes}B waits for scratch")
+                return None
+            admit_pth.write_text(str(nbytes))
+        if nbytes > left:
+            logger.warning(
+                f"carblock={carblock}: {nbytes / GB:.1f}GB is over the scratch "
+                f"budget ({left / GB:.1f}GB left in {root.pth}), built anyway"
+            )
+        logger.debug(f"carblock={carblock}: {nbytes}B admitted to {root.pth}")
+        return SimpleNamespace(
+            carblock=carblock, root=root.pth, nbytes=nbytes, pth=admit_pth
+        )
+
+    def release(self, adm: SimpleNamespace | None) -> None:
+        if adm is not None:
+            adm.pth.unlink(missing_ok=True)
+
+    def prefix(self, carblock: int) -> str:
+        return f"trove-{self.pid}-c{carblock}-"
+
+    def gc(self, keep: Iterable[Path] = ()) -> Tuple[int, int]:
+        """remove what dead workers left in the roots, but not the paths in
+        keep. Returns (how many, bytes)."""
+        keep = {Path(p).resolve() for p in keep}
+        n = nbytes = 0
+        for r in self.roots:
+            for p in r.pth.iterdir():
+                m = ARTIFACT_RE.match(p.name)
+                if m is None or pid_alive(int(m.group(1))) or p.resolve() in keep:
+                    continue
+                size = _du(p)
+                if p.is_dir() and not p.is_symlink():
+                    shutil.rmtree(p, ignore_errors=True)
+                else:
+                    p.unlink(missing_ok=True)
+                n += 1
+                nbytes += size
+            self.admitted(r)  # drops the dead pids' admissions
+        if n:
+            logger.info(f"scratch gc: {n} orphans removed, {nbytes / GB:.2f}GB")
+        return n, nbytes
+
+
+def _du(pth: Path) -> int:
+    try:
+        if not pth.is_dir():
+            return pth.lstat().st_size
+        return sum(
+            (Path(d) / f).lstat().st_size for d, _, fs in os.walk(pth) for f in fs
+        )
+    except OSError:
+        return 0
+
+# done.
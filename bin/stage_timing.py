@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-03
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/stage_timing.py
+
+"""how long each stage of each carblock takes, and how much it moves.
+
+car-to-ipfs.py wraps each stage (lock, preflight, compress, pack, verify,
+upload, db, check) in Timings.stage(), which records its seconds, bytes
+in and out, files and retries. When the carblock is done (or rolled back)
+the records go to carblock_stage_timings, one row per stage, and into the
+running totals in a Prometheus textfile (for node_exporter's textfile
+collector), one file per worker. Which stage dominates, e.g.:
+
+  SELECT stage, count(*), avg(secs), sum(bytes_in) / sum(secs) AS bytes_per_s
+  FROM carblock_stage_timings WHERE ok GROUP BY stage ORDER BY 3 DESC ;
+
+With --profile cprofile each stage is run under cProfile and its stats
+dumped to {profdir}/carblock-{N}-{stage}.prof (see them with snakeviz or
+pstats). cProfile only sees the thread that runs the stage, which is the
+one doing the work, except for the compress pool's own workers. With
+--profile tracemalloc the peak traced memory of each stage is recorded;
+the peak is process-wide, so with several carblocks in flight it's an
+upper bound."""
+
+import cProfile
+from contextlib import contextmanager
+from collections import defaultdict
+import logging
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Iterator
+
+# --- these are not part of the std library
+import psycopg  # noqa: E402
+
+logger = logging.getLogger("main")
+PROFILERS = ("none", "cprofile", "tracemalloc")
+
+
+class Timings:
+    """the stage records of one carblock"""
+
+    def __init__(self, carblock: int, profile: str = "none", profdir: Path = None):
+        self.carblock = carblock
+        self.profile = profile
+        self.profdir = profdir
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name: str, files: int = 0, bytes_in: int = 0) -> Iterator:
+        """time the block; set .bytes_out, .retries etc on what it yields.
+        A stage that raises is recorded with ok=False and the error raised."""
+        st = SimpleNamespace(
+            stage=name,
+            start=time.time(),
+            secs=None,
+            files=files,
+            bytes_in=bytes_in,
+            bytes_out=0,
+            retries=0,
+            ok=False,
+            mem_peak=None,
+        )
+        self.stages.append(st)
+        prof = None
+        if self.profile == "cprofile":
+            prof = cProfile.Profile()
+            prof.enable()
+        elif self.profile == "tracemalloc":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        try:
+            yield st
+            st.ok = True
+        finally:
+            st.secs = time.perf_counter() - t0
+            if prof is not None:
+                prof.disable()
+                prof.dump_stats(self.profdir / f"carblock-{self.carblock}-{name}.prof")
+            elif self.profile == "tracemalloc":
+                st.mem_peak = tracemalloc.get_traced_memory()[1]
+            logger.debug(
+                f"carblock={self.carblock} {name}: {st.secs:.2f}s, "
+                f"{st.files} files, {st.bytes_in}B in, {st.bytes_out}B out"
+            )
+
+
+def ensure_timings_table(conn: psycopg.Connection) -> None:
+    create_q = """
+        CREATE TABLE IF NOT EXISTS carblock_stage_timings (
+            carblock INT,
+            worker TEXT,
+            stage TEXT,
+            start_tm TIMESTAMPTZ,
+            secs DOUBLE PRECISION,
+            nfiles INT,
+            bytes_in BIGINT,
+            bytes_out BIGINT,
+            retries INT,
+            ok BOOLEAN,
+            mem_peak BIGINT) ;"""
+    with conn.cursor() as cur:
+        cur.execute(create_q)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS carblock_stage_timings_stage
+            ON carblock_stage_timings (stage, start_tm) ;""")
+    conn.commit()
+
+
+def write_timings(conn: psycopg.Connection, worker: str, timings: Timings) -> int:
+    insert_q = """
+        INSERT INTO carblock_stage_timings (carblock, worker, stage, start_tm,
+            secs, nfiles, bytes_in, bytes_out, retries, ok, mem_peak)
+        VALUES (%s, %s, %s, to_timestamp(%s), %s, %s, %s, %s, %s, %s, %s)"""
+    rows = [
+        (
+            timings.carblock,
+            worker,
+            s.stage,
+            s.start,
+            s.secs,
+            s.files,
+            s.bytes_in,
+            s.bytes_out,
+            s.retries,
+            s.ok,
+            s.mem_peak,
+        )
+        for s in timings.stages
+    ]
+    with conn.cursor() as cur:
+        cur.executemany(insert_q, rows)
+    conn.commit()
+    return len(rows)
+
+
+class PromFile:
+    """running per-stage totals, rewritten whole after each carblock"""
+
+    COUNTERS = ("secs", "files", "bytes_in", "bytes_out", "retries")
+
+    def __init__(self, pth: Path, worker: str):
+        self.pth = Path(pth)
+        self.worker = worker
+        self.lock = threading.Lock()
+        self.totals = defaultdict(lambda: defaultdict(float))
+        self.last = {}
+
+    def add(self, timings: Timings) -> None:
+        with self.lock:
+            for s in timings.stages:
+                tot = self.totals[s.stage]
+                for c in self.COUNTERS:
+                    tot[c] += getattr(s, c)
+                tot["ok" if s.ok else "failed"] += 1
+                self.last[s.stage] = s.secs
+            self.write()
+
+    def write(self) -> None:
+        lbl = f'worker="{self.worker}"'
+        lines = []
+        for c in self.COUNTERS:
+            name = "trove_stage_" + ("seconds" if c == "secs" else c) + "_total"
+            lines.append(f"# TYPE {name} counter")
+            for stage, tot in sorted(self.totals.items()):
+                lines.append(f'{name}{{{lbl},stage="{stage}"}} {tot[c]}')
+        lines.append("# TYPE trove_stage_runs_total counter")
+        for stage, tot in sorted(self.totals.items()):
+            for result in ("ok", "failed"):
+                lines.append(
+                    f'trove_stage_runs_total{{{lbl},stage="{stage}",'
+                    f'result="{result}"}} {tot[result]:.0f}'
+                )
+        lines.append("# TYPE trove_stage_last_seconds gauge")
+        for stage, secs in sorted(self.last.items()):
+            lines.append(f'trove_stage_last_seconds{{{lbl},stage="{stage}"}} {secs}')
+        # node_exporter must never see half a file
+        fd, tmpname = tempfile.mkstemp(dir=self.pth.parent, suffix=".tmp")
+        with os.fdopen(fd, "wt") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmpname, self.pth)
+
+# done.
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-26
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/stand-in-gateway.py
+
+"""a local stand-in for w3s.link, serving the .car files in a directory, for
+testing the fetchers without the real network. It can be slow, fail, or cut
+downloads short on purpose.
+
+  /ipfs/{cid}?format=raw          one block
+  /ipfs/{cid}?format=dag-json     a dag-pb node as `ipfs dag get` prints it
+  /ipfs/{cid}[/path]              a file's bytes, or a directory's html table
+  /api/v0/ls?arg={cid}            (POST) the `ipfs ls` listing, as kubo's API
+
+Responses carry Etag and X-Ipfs-Roots like a real gateway, and honor
+`Range: bytes=N-`."""
+
+import argparse
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+from pathlib import Path
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+# --- in this repo
+import resolve_dir
+import unixfs
+
+logger = logging.getLogger("main")
+
+
+class CarIndex:
+    """cid -> (car, offset, length) for the blocks of the cars in a directory,
+    read from disk when asked for. A car that shows up later (bench-e2e.py's
+    stand-in `w3 up` drops them here) is indexed on the first miss."""
+
+    def __init__(self, cardir: Path):
+        self.cardir = cardir
+        self.where = {}
+        self.indexed = set()
+        self.lock = threading.Lock()
+        self.scan()
+
+    def scan(self) -> int:
+        """index the cars not seen yet; returns how many"""
+        new = sorted(set(self.cardir.glob("*.car")) - self.indexed)
+        for carpth in new:
+            with open(carpth, "rb") as f:
+                for cid, block in unixfs.iter_car(f):
+                    where = (carpth, f.tell() - len(block), len(block))
+                    self.where[unixfs.cid_str(cid)] = where
+            self.indexed.add(carpth)
+        if new:
+            logger.info(f"{len(self.where)} blocks in {len(self.indexed)} cars")
+        return len(new)
+
+    def __getitem__(self, cid: str) -> bytes:
+        if cid not in self.where:
+            with self.lock:
+                self.scan()
+        carpth, offset, length = self.where[cid]
+        with open(carpth, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+
+def dir_html(root: str, path: str, entries: list) -> bytes:
+    """every other row's hash is shortened to bafy…wxyz, as real gateways'
+    listings do; only its href has the whole CID"""
+    rows = []
+    for i, e in enumerate(entries):
+        href = "/".join(p for p in ["/ipfs", root, path, e.name] if p)
+        text = f"{e.hash[:4]}\u2026{e.hash[-4:]}" if i % 2 else e.hash
+        rows.append(
+            f'<tr><td><a href="{href}">{e.name}</a></td>'
+            f'<td><a class="ipfs-hash" href="/ipfs/{e.hash}?filename={e.name}">'
+            f"{text}</a></td><td>{e.tsize}</td></tr>"
+        )
+    body = "\n".join(rows)
+    return (
+        f"<!DOCTYPE html>\n<html><head><title>/ipfs/{root}/{path}</title></head>"
+        f"<body><table>\n{body}\n</table></body></html>\n"
+    ).encode("utf-8")
+
+
+def dag_json(cid: str, block: bytes) -> bytes:
+    links, data = unixfs.decode_dag_pb(block)
+    js = {
+        "Data": {"/": {"bytes": base64.b64encode(data or b"").decode().rstrip("=")}},
+        "Links": [
+            {"Hash": {"/": unixfs.cid_str(lk.cid)}, "Name": lk.name, "Tsize": lk.tsize}
+            for lk in links
+        ],
+    }
+    return json.dumps(js, indent=2).encode("utf-8")
+
+
+class Handler(BaseHTTPRequestHandler):
+    store = None  # resolve_dir.BlockStore over the cars' blocks
+    opts = None  # the parsed args
+
+    def log_message(self, fmt, *fargs):
+        logger.debug(fmt % fargs)
+
+    def _misbehave(self) -> bool:
+        """sleep, and maybe fail; True if the request was answered with a 5xx"""
+        time.sleep(self.opts.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.opts.fail_rate:
+            self.send_error(503, "stand-in failure")
+            return True
+        return False
+
+    def _send(self, body: bytes, ctype: str, roots: list) -> None:
+        start = 0
+        rng = self.headers.get("Range", "")
+        if rng.startswith("bytes=") and rng.endswith("-"):
+            start = min(int(rng[6:-1]), len(body))
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Etag", f'"{roots[-1]}"')
+        self.send_header("X-Ipfs-Roots", ",".join(roots))
+        if start:
+            crange = f"bytes {start}-{len(body) - 1}/{len(body)}"
+            self.send_header("Content-Range", crange)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        body = body[start:]
+        if random.random() < self.opts.truncate_rate:
+            # promise the whole thing, send part, hang up: what curl saw
+            self.wfile.write(body[: random.randint(0, len(body) // 2)])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self._misbehave():
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [p for p in url.path.split("/") if p]
+        if len(parts) < 2 or parts[0] != "ipfs":
+            self.send_error(404)
+            return
+        root, path = parts[1], "/".join(parts[2:])
+        try:
+            roots = resolve_dir.resolve_path(self.store, root, path)
+            cid = roots[-1]
+            fmt = query.get("format", [""])[0]
+            if fmt == "raw":
+                self._send(self.store.get(cid), "application/vnd.ipld.raw", roots)
+            elif fmt == "dag-json":
+                body = dag_json(cid, self.store.get(cid))
+                self._send(body, "application/vnd.ipld.dag-json", roots)
+            elif unixfs.cid_codec(unixfs.cid_bytes(cid)) == unixfs.CODEC_RAW:
+                self._send(self.store.get(cid), "application/octet-stream", roots)
+            else:
+                links, ufs = resolve_dir._node(self.store, cid)
+                if ufs["type"] == unixfs.UNIXFS_FILE:
+                    body = resolve_dir.cat_file(self.store, cid)
+                    self._send(body, "application/octet-stream", roots)
+                else:
+                    entries = resolve_dir.list_dir(self.store, cid)
+                    body = dir_html(root, path, entries)
+                    self._send(body, "text/html", roots)
+        except (KeyError, FileNotFoundError):
+            self.send_error(404)
+        except (resolve_dir.BlockError, ValueError) as e:
+            self.send_error(500, str(e))
+
+    def do_POST(self):
+        if self._misbehave():
+            return
+        url = urlparse(self.path)
+        if url.path != "/api/v0/ls":
+            self.send_error(404)
+            return
+        cid = parse_qs(url.query)["arg"][0]
+        try:
+            entries = resolve_dir.list_dir(self.store, cid)
+        except KeyError:
+            self.send_error(500, "block not found")
+            return
+        except (resolve_dir.BlockError, ValueError) as e:
+            self.send_error(500, str(e))
+            return
+        js = {
+            "Objects": [
+                {
+                    "Hash": cid,
+                    "Links": [
+                        {"Name": e.name, "Hash": e.hash, "Size": e.tsize, "Type": 2}
+                        for e in entries
+                    ],
+                }
+            ]
+        }
+        self._send(json.dumps(js).encode("utf-8"), "application/json", [cid])
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="local stand-in ipfs gateway")
+    parser.add_argument("-d", "--cardir", help="directory of .car files", required=True)
+    parser.add_argument("-p", "--port", default=8080, type=int)
+    parser.add_argument(
+        "--latency", help="mean seconds added to each request", default=0.0, type=float
+    )
+    parser.add_argument(
+        "--fail-rate", help="fraction of requests answered 503", default=0.0, type=float
+    )
+    parser.add_argument(
+        "--truncate-rate",
+        help="fraction of responses cut off partway",
+        default=0.0,
+        type=float,
+    )
+    return parser.parse_args()
+
+
+def serve(args: argparse.Namespace) -> ThreadingHTTPServer:
+    blocks = CarIndex(Path(args.cardir))
+    Handler.store = resolve_dir.BlockStore(None, blocks.__getitem__)
+    Handler.opts = args
+    return ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    server = serve(args)
+    logger.info(f"stand-in gateway on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+# done.
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-04
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/stand-in-ipfs.py
+
+"""a local stand-in for kubo's `ipfs dag get` and `ipfs ls`, answered by
+stand-in-gateway.py (at IPFS_STANDIN_GATEWAY), so scripts/get-*.sh can run
+against the cars bench-e2e.py uploaded. bench-e2e.py puts it on the PATH
+as `ipfs`."""
+
+import json
+import os
+import sys
+from urllib.request import Request, urlopen
+
+GATEWAY = os.environ.get("IPFS_STANDIN_GATEWAY", "http://127.0.0.1:8080")
+
+
+def main(argv: list) -> int:
+    if argv[:2] == ["dag", "get"]:
+        with urlopen(f"{GATEWAY}/ipfs/{argv[2]}?format=dag-json") as response:
+            sys.stdout.write(response.read().decode("utf-8") + "\n")
+    elif argv[:1] == ["ls"]:
+        req = Request(f"{GATEWAY}/api/v0/ls?arg={argv[-1]}", method="POST")
+        with urlopen(req) as response:
+            js = json.load(response)
+        for lk in js["Objects"][0]["Links"]:
+            print(f"{lk['Hash']} {lk['Size']} {lk['Name']}")
+    else:
+        print(f"stand-in ipfs: {' '.join(argv)} is not supported", file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+# done.
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-04
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/stand-in-w3.py
+
+"""a local stand-in for the `w3` cli, enough of it for car-to-ipfs.py, so
+the upload path can be run and timed without Storacha. bench-e2e.py puts
+it on the PATH as `w3`. Configured from the environment, since
+car-to-ipfs.py calls it with w3's own arguments:
+
+  W3_STANDIN_CARDIR     where `up` puts the car, as {root}.car, for
+                        stand-in-gateway.py to serve
+  W3_STANDIN_GATEWAY    the base of the url `up` prints
+  W3_STANDIN_DID        the did `whoami` prints
+  W3_STANDIN_LATENCY    mean seconds added to each `up`
+  W3_STANDIN_MBPS       simulated upload bandwidth, MB/s (0: unlimited)
+  W3_STANDIN_FAIL_RATE  fraction of `up`s that fail"""
+
+import os
+from pathlib import Path
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# --- in this repo
+import unixfs
+
+DID = os.environ.get("W3_STANDIN_DID", "did:key:z6MkStandIn")
+
+
+def up(carpth: Path) -> int:
+    cardir = Path(os.environ["W3_STANDIN_CARDIR"])
+    gateway = os.environ.get("W3_STANDIN_GATEWAY", "http://127.0.0.1:8080")
+    latency = float(os.environ.get("W3_STANDIN_LATENCY", 0))
+    mbps = float(os.environ.get("W3_STANDIN_MBPS", 0))
+    fail_rate = float(os.environ.get("W3_STANDIN_FAIL_RATE", 0))
+
+    secs = latency * random.uniform(0.5, 1.5)
+    if mbps > 0:
+        secs += carpth.stat().st_size / (mbps * 1024 * 1024)
+    time.sleep(secs)
+    if random.random() < fail_rate:
+        print("Error: stand-in upload failure", file=sys.stderr)
+        return 1
+    with open(carpth, "rb") as f:
+        root = unixfs.cid_str(unixfs.car_roots(f)[0])
+    # the gateway indexes *.car, so it must never see half of one
+    fd, tmpname = tempfile.mkstemp(dir=cardir, suffix=".part")
+    with os.fdopen(fd, "wb") as f_out, open(carpth, "rb") as f_in:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    os.replace(tmpname, cardir / f"{root}.car")
+    print(f"⁂ {gateway}/ipfs/{root}")
+    return 0
+
+
+def main(argv: list) -> int:
+    cmd = argv[:2]
+    if cmd[:1] == ["login"]:
+        print(f"Agent was authorized by did:mailto:{argv[1]}")
+    elif cmd[:1] == ["whoami"]:
+        print(DID)
+    elif cmd == ["space", "use"]:
+        print(argv[2])
+    elif cmd[:1] == ["ls"]:
+        cardir = Path(os.environ["W3_STANDIN_CARDIR"])
+        for carpth in sorted(cardir.glob("*.car")):
+            print(carpth.stem)
+    elif cmd[:1] == ["up"] and "--car" in argv:
+        return up(Path(argv[-1]))
+    else:
+        print(f"stand-in w3: {' '.join(argv)} is not supported", file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+# done.
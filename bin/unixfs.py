@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-10
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/unixfs.py
+
+"""a small, dependency-free UnixFS + CARv1 builder.
+
+This follows the defaults that `npx ipfs-car pack` uses (via @ipld/unixfs) so
+that the root CIDs match: CIDv1, sha2-256, raw leaves, 1MiB fixed chunks,
+balanced file layout 1024 wide, and directories with more than 1000 entries
+written as HAMT shards (fanout 256, murmur3-x64-64).
+
+The width is upload-client's withWidth(1024), which ipfs-car uses, not
+@ipld/unixfs's own default of 174 (kubo's). It only shows in files over
+174 chunks (174MiB): with 174, those get another level of nodes and a
+root CID that ipfs-car doesn't make. bench-carpack.py packs one.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+from pathlib import Path
+import struct
+from typing import BinaryIO, Iterable, List, NamedTuple, Tuple
+
+logger = logging.getLogger("main")
+
+CHUNK_SIZE = 1024 * 1024
+MAX_CHILDREN = 1024
+SHARD_THRESHOLD = 1000
+HAMT_FANOUT = 256
+
+CODEC_RAW = 0x55
+CODEC_DAG_PB = 0x70
+SHA2_256 = 0x12
+MURMUR3_X64_64 = 0x22
+
+# UnixFS Data.DataType
+UNIXFS_DIRECTORY = 1
+UNIXFS_FILE = 2
+UNIXFS_HAMT_SHARD = 5
+
+
+class FileCID(NamedTuple):
+    """same shape as the links in `ipfs dag get $CID`"""
+
+    hash: str
+    name: str
+    tsize: int
+
+
+class Link(NamedTuple):
+    """a dag-pb link, with the binary CID"""
+
+    name: str
+    cid: bytes
+    tsize: int
+
+
+# --- encoding primitives
+
+
+def varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def read_varint(buf: bytes, pos: int = 0) -> Tuple[int, int]:
+    """returns (value, position after the varint)"""
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _pb_bytes(field: int, value: bytes) -> bytes:
+    return varint(field << 3 | 2) + varint(len(value)) + value
+
+
+def _pb_varint(field: int, value: int) -> bytes:
+    return varint(field << 3) + varint(value)
+
+
+def make_cid(codec: int, block: bytes) -> bytes:
+    digest = hashlib.sha256(block).digest()
+    return b"\x01" + varint(codec) + bytes((SHA2_256, len(digest))) + digest
+
+
+def cid_str(cid: bytes) -> str:
+    """multibase base32 (lowercase, no padding), as printed by ipfs-car"""
+    return "b" + base64.b32encode(cid).decode("ascii").lower().rstrip("=")
+
+
+def cid_bytes(cid: str) -> bytes:
+    assert cid.startswith("b"), f"only base32 CIDv1 is handled, got {cid}"
+    body = cid[1:].upper()
+    return base64.b32decode(body + "=" * (-len(body) % 8))
+
+
+def cid_codec(cid: bytes) -> int:
+    version, pos = read_varint(cid)
+    assert version == 1
+    codec, _ = read_varint(cid, pos)
+    return codec
+
+
+def is_cid(s: str) -> bool:
+    """a whole base32 CIDv1, not an abbreviation like bafy…wxyz: the
+    multihash has to be as long as it says it is"""
+    try:
+        cid = cid_bytes(s)
+        version, pos = read_varint(cid)
+        _, pos = read_varint(cid, pos)
+        _, pos = read_varint(cid, pos)
+        length, pos = read_varint(cid, pos)
+    except Exception:
+        return False
+    return version == 1 and length > 0 and len(cid) == pos + length
+
+
+def encode_unixfs(
+    kind: int,
+    data: bytes | None = None,
+    filesize: int | None = None,
+    blocksizes: Iterable[int] = (),
+    hash_type: int | None = None,
+    fanout: int | None = None,
+) -> bytes:
+    out = _pb_varint(1, kind)
+    if data is not None:
+        out += _pb_bytes(2, data)
+    if filesize is not None:
+        out += _pb_varint(3, filesize)
+    for bs in blocksizes:  # proto2 repeated, not packed
+        out += _pb_varint(4, bs)
+    if hash_type is not None:
+        out += _pb_varint(5, hash_type)
+    if fanout is not None:
+        out += _pb_varint(6, fanout)
+    return out
+
+
+def encode_dag_pb(links: List[Link], data: bytes | None, named: bool = True) -> bytes:
+    """canonical dag-pb: links (sorted by name bytes) before data"""
+    out = bytearray()
+    if named:
+        links = sorted(links, key=lambda lk: lk.name.encode("utf-8"))
+    for lk in links:
+        body = _pb_bytes(1, lk.cid)
+        if named:
+            body += _pb_bytes(2, lk.name.encode("utf-8"))
+        body += _pb_varint(3, lk.tsize)
+        out += _pb_bytes(2, body)
+    if data is not None:
+        out += _pb_bytes(1, data)
+    return bytes(out)
+
+
+def _pb_fields(buf: bytes):
+    """yields (field number, value) from a protobuf message; value is an int
+    for varints and bytes for length-delimited fields"""
+    pos = 0
+    while pos < len(buf):
+        key, pos = read_varint(buf, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire == 2:
+            n, pos = read_varint(buf, pos)
+            value = buf[pos : pos + n]
+            if len(value) != n:
+                raise ValueError("truncated protobuf field")
+            pos += n
+        else:
+            raise ValueError(f"unexpected protobuf wire type {wire}")
+        yield field, value
+
+
+def decode_dag_pb(block: bytes) -> Tuple[List[Link], bytes | None]:
+    links = []
+    data = None
+    for field, value in _pb_fields(block):
+        if field == 2:
+            cid, name, tsize = b"", "", 0
+            for lf, lv in _pb_fields(value):
+                if lf == 1:
+                    cid = bytes(lv)
+                elif lf == 2:
+                    name = bytes(lv).decode("utf-8")
+                elif lf == 3:
+                    tsize = lv
+            links.append(Link(name, cid, tsize))
+        elif field == 1:
+            data = bytes(value)
+    return links, data
+
+
+def decode_unixfs(data: bytes) -> dict:
+    """the UnixFS Data message as a dict: type, data, filesize, blocksizes,
+    hash_type, fanout"""
+    out = {
+        "type": None,
+        "data": None,
+        "filesize": None,
+        "blocksizes": [],
+        "hash_type": None,
+        "fanout": None,
+    }
+    names = {1: "type", 2: "data", 3: "filesize", 5: "hash_type", 6: "fanout"}
+    for field, value in _pb_fields(data):
+        if field == 4:
+            out["blocksizes"].append(value)
+        elif field in names:
+            out[names[field]] = value
+    return out
+
+
+def dag_json_unixfs(js: dict) -> dict:
+    """decode_unixfs() of a node as `ipfs dag get` prints it, where Data is
+    {"/": {"bytes": <unpadded base64>}}"""
+    b64 = ((js.get("Data") or {}).get("/") or {}).get("bytes", "")
+    return decode_unixfs(base64.b64decode(b64 + "=" * (-len(b64) % 4)))
+
+
+# --- murmur3, for HAMT bucket placement
+
+_M64 = 0xFFFFFFFFFFFFFFFF
+_C1 = 0x87C37B91114253D5
+_C2 = 0x4CF5AD432745937F
+
+
+def _rotl(x: int, r: int) -> int:
+    return ((x << r) | (x >> (64 - r))) & _M64
+
+
+def _fmix(k: int) -> int:
+    k ^= k >> 33
+    k = (k * 0xFF51AFD7ED558CCD) & _M64
+    k ^= k >> 33
+    k = (k * 0xC4CEB9FE1A85EC53) & _M64
+    k ^= k >> 33
+    return k
+
+
+def murmur3_x64_64(data: bytes) -> bytes:
+    """first half of murmur3 x64_128 (seed 0), big-endian, as go-unixfs"""
+    h1 = h2 = 0
+    nblocks = len(data) // 16
+    for i in range(nblocks):
+        k1, k2 = struct.unpack_from("<QQ", data, i * 16)
+        h1 ^= (_rotl((k1 * _C1) & _M64, 31) * _C2) & _M64
+        h1 = (_rotl(h1, 27) + h2) & _M64
+        h1 = (h1 * 5 + 0x52DCE729) & _M64
+        h2 ^= (_rotl((k2 * _C2) & _M64, 33) * _C1) & _M64
+        h2 = (_rotl(h2, 31) + h1) & _M64
+        h2 = (h2 * 5 + 0x38495AB5) & _M64
+    tail = data[nblocks * 16 :]
+    if len(tail) > 8:
+        k2 = int.from_bytes(tail[8:], "little")
+        h2 ^= (_rotl((k2 * _C2) & _M64, 33) * _C1) & _M64
+    if len(tail) > 0:
+        k1 = int.from_bytes(tail[:8], "little")
+        h1 ^= (_rotl((k1 * _C1) & _M64, 31) * _C2) & _M64
+    h1 ^= len(data)
+    h2 ^= len(data)
+    h1 = (h1 + h2) & _M64
+    h2 = (h2 + h1) & _M64
+    h1 = _fmix(h1)
+    h2 = _fmix(h2)
+    h1 = (h1 + h2) & _M64
+    return h1.to_bytes(8, "big")
+
+
+# --- CAR output
+
+
+class CarWriter:
+    """CARv1 writer. The root isn't known until the end, so a placeholder
+    root of the same length is written and patched in `close()`."""
+
+    def __init__(self, fobj: BinaryIO):
+        self.fobj = fobj
+        self.seen = set()
+        self.nbytes = 0
+        self.fobj.write(self._header(make_cid(CODEC_DAG_PB, b"")))
+
+    @staticmethod
+    def _header(root: bytes) -> bytes:
+        # dag-cbor {"roots": [root], "version": 1}, keys in canonical order
+        tagged = b"\x00" + root
+        cbor = (
+            b"\xa2\x65roots\x81\xd8\x2a\x58"
+            + bytes((len(tagged),))
+            + tagged
+            + b"\x67version\x01"
+        )
+        return varint(len(cbor)) + cbor
+
+    def put(self, cid: bytes, block: bytes) -> None:
+        if cid in self.seen:
+            return
+        self.seen.add(cid)
+        self.fobj.write(varint(len(cid) + len(block)))
+        self.fobj.write(cid)
+        self.fobj.write(block)
+        self.nbytes += len(block)
+
+    def close(self, root: bytes) -> None:
+        self.fobj.seek(0)
+        self.fobj.write(self._header(root))
+        self.fobj.flush()
+
+
+class NullCar:
+    """stands in for a CarWriter when only the CIDs are wanted"""
+
+    def put(self, cid: bytes, block: bytes) -> None:
+        pass
+
+
+def _read_varint_f(fobj: BinaryIO) -> int | None:
+    """a varint from a stream, None at a clean EOF"""
+    n = shift = 0
+    while True:
+        byte = fobj.read(1)
+        if not byte:
+            if shift:
+                raise ValueError("truncated car")
+            return None
+        n |= (byte[0] & 0x7F) << shift
+        if not byte[0] & 0x80:
+            return n
+        shift += 7
+
+
+def iter_car(fobj: BinaryIO):
+    """yields (cid, block) from a CARv1 stream, after the header, one
+    section in memory at a time"""
+    hlen = _read_varint_f(fobj)
+    fobj.read(hlen)
+    while (n := _read_varint_f(fobj)) is not None:
+        section = fobj.read(n)
+        if len(section) != n:
+            raise ValueError("truncated car")
+        # CIDv1 = version, codec, multihash code, digest length, digest
+        _, p = read_varint(section)
+        _, p = read_varint(section, p)
+        _, p = read_varint(section, p)
+        dlen, p = read_varint(section, p)
+        yield section[: p + dlen], section[p + dlen :]
+
+
+def car_roots(fobj: BinaryIO) -> List[bytes]:
+    """the root CIDs from a CARv1 header (tag 42 byte strings in the cbor)"""
+    head = fobj.read(16)
+    hlen, pos = read_varint(head)
+    cbor = (head + fobj.read(hlen))[pos : pos + hlen]
+    roots = []
+    i = cbor.find(b"\xd8\x2a")
+    while i >= 0:
+        n = cbor[i + 3]  # d8 2a 58 <len> 00 <cid>
+        roots.append(bytes(cbor[i + 5 : i + 4 + n]))
+        i = cbor.find(b"\xd8\x2a", i + 4 + n)
+    return roots
+
+
+# --- files
+
+
+class FileBuilder:
+    """file-like sink: bytes written here are chunked into the CAR.
+
+    Call `close()` for the file's (cid, tsize), where tsize is the
+    cumulative block size, the same number `ipfs ls` reports."""
+
+    def __init__(self, car: CarWriter, chunk_size: int = CHUNK_SIZE):
+        self.car = car
+        self.chunk_size = chunk_size
+        self.buf = bytearray()
+        self.leaves = []  # (cid, tsize, filesize)
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.buf += data
+        while len(self.buf) >= self.chunk_size:
+            self._leaf(bytes(self.buf[: self.chunk_size]))
+            del self.buf[: self.chunk_size]
+        return len(data)
+
+    def _leaf(self, chunk: bytes) -> None:
+        cid = make_cid(CODEC_RAW, chunk)
+        self.car.put(cid, chunk)
+        self.leaves.append((cid, len(chunk), len(chunk)))
+        self.size += len(chunk)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> Tuple[bytes, int]:
+        if self.buf or not self.leaves:
+            self._leaf(bytes(self.buf))
+            self.buf = bytearray()
+        level = self.leaves
+        while len(level) > 1:
+            level = [
+                self._node(level[i : i + MAX_CHILDREN])
+                for i in range(0, len(level), MAX_CHILDREN)
+            ]
+        cid, tsize, _ = level[0]
+        return cid, tsize
+
+    def _node(self, children: list) -> Tuple[bytes, int, int]:
+        filesize = sum(c[2] for c in children)
+        data = encode_unixfs(
+            UNIXFS_FILE, filesize=filesize, blocksizes=[c[2] for c in children]
+        )
+        links = [Link("", cid, tsize) for cid, tsize, _ in children]
+        block = encode_dag_pb(links, data, named=False)
+        cid = make_cid(CODEC_DAG_PB, block)
+        self.car.put(cid, block)
+        return cid, len(block) + sum(c[1] for c in children), filesize
+
+
+def put_file(car: CarWriter, fobj: BinaryIO) -> Tuple[bytes, int]:
+    builder = FileBuilder(car)
+    while chunk := fobj.read(CHUNK_SIZE):
+        builder.write(chunk)
+    return builder.close()
+
+
+def file_cid(fobj: BinaryIO) -> Tuple[str, int]:
+    """the (cid, tsize) the file would have in a car, without writing one"""
+    cid, tsize = put_file(NullCar(), fobj)
+    return cid_str(cid), tsize
+
+
+# --- directories
+
+
+def _put_node(car: CarWriter, links: List[Link], data: bytes) -> Tuple[bytes, int]:
+    block = encode_dag_pb(links, data)
+    cid = make_cid(CODEC_DAG_PB, block)
+    car.put(cid, block)
+    return cid, len(block) + sum(lk.tsize for lk in links)
+
+
+def _hamt_insert(node: dict, name: str, link: Link, hashed: bytes, depth: int):
+    idx = hashed[depth]
+    here = node.get(idx)
+    if here is None:
+        node[idx] = (name, link, hashed)
+    elif isinstance(here, dict):
+        _hamt_insert(here, name, link, hashed, depth + 1)
+    else:
+        child = {}
+        _hamt_insert(child, *here, depth + 1)
+        _hamt_insert(child, name, link, hashed, depth + 1)
+        node[idx] = child
+
+
+def _hamt_put(car: CarWriter, node: dict) -> Tuple[bytes, int]:
+    bitfield = bytearray(HAMT_FANOUT // 8)
+    links = []
+    for idx in sorted(node):
+        bitfield[len(bitfield) - 1 - idx // 8] |= 1 << (idx % 8)
+        here = node[idx]
+        if isinstance(here, dict):
+            cid, tsize = _hamt_put(car, here)
+            links.append(Link(f"{idx:02X}", cid, tsize))
+        else:
+            name, link, _ = here
+            links.append(Link(f"{idx:02X}{name}", link.cid, link.tsize))
+    data = encode_unixfs(
+        UNIXFS_HAMT_SHARD,
+        data=bytes(bitfield),
+        hash_type=MURMUR3_X64_64,
+        fanout=HAMT_FANOUT,
+    )
+    return _put_node(car, links, data)
+
+
+def put_directory(
+    car: CarWriter, links: List[Link], shard_threshold: int = SHARD_THRESHOLD
+) -> Tuple[bytes, int]:
+    """flat directory up to `shard_threshold` entries, HAMT above that"""
+    if len(links) <= shard_threshold:
+        return _put_node(car, links, encode_unixfs(UNIXFS_DIRECTORY))
+    root = {}
+    for lk in links:
+        _hamt_insert(root, lk.name, lk, murmur3_x64_64(lk.name.encode("utf-8")), 0)
+    return _hamt_put(car, root)
+
+
+def put_tree(car: CarWriter, tree: dict) -> Tuple[bytes, int]:
+    """tree maps name -> Link (a file) or name -> dict (a subdirectory)"""
+    links = []
+    for name, node in tree.items():
+        if isinstance(node, dict):
+            cid, tsize = put_tree(car, node)
+            links.append(Link(name, cid, tsize))
+        else:
+            links.append(node._replace(name=name))
+    return put_directory(car, links)
+
+
+def add_to_tree(tree: dict, relpath: str, link: Link) -> None:
+    *dirs, name = relpath.split("/")
+    for d in dirs:
+        tree = tree.setdefault(d, {})
+    tree[name] = link
+
+
+# --- layout
+
+
+def nested_paths(names: List[str], max_entries: int) -> dict:
+    """name -> "a/3/name". Files go into subdirectories named by the hex
+    digits of sha256(name), split one digit (16 ways) at a time and only as
+    deep as needed to keep every directory to max_entries or fewer, so no
+    directory gets big enough to need a HAMT."""
+    assert max_entries >= 16, "a split makes up to 16 subdirectories"
+    paths = {}
+
+    def split(group: list, dirs: list, depth: int) -> None:
+        if len(group) <= max_entries or depth == 64:
+            for name, _ in group:
+                paths[name] = "/".join(dirs + [name])
+            return
+        buckets = {}
+        for name, digest in group:
+            buckets.setdefault(digest[depth], []).append((name, digest))
+        for digit, sub in buckets.items():
+            split(sub, dirs + [digit], depth + 1)
+
+    split([(n, hashlib.sha256(n.encode("utf-8")).hexdigest()) for n in names], [], 0)
+    return paths
+
+
+# --- the whole job
+
+
+def pack_dir(cardir: Path, carpth: Path) -> Tuple[str, List[FileCID]]:
+    """pack the directory `cardir` into `carpth`, like
+    `ipfs-car pack cardir --output carpth`. Returns the root CID and the
+    per-file CIDs, named by their path inside the car."""
+    tree = {}
+    filecids = []
+    with open(carpth, "wb") as f_car:
+        car = CarWriter(f_car)
+        for dirpath, dirnames, fnames in os.walk(cardir):
+            dirnames.sort()
+            for name in sorted(fnames):
+                fpath = Path(dirpath, name)
+                with open(fpath, "rb") as f_in:
+                    cid, tsize = put_file(car, f_in)
+                relpath = fpath.relative_to(cardir).as_posix()
+                add_to_tree(tree, relpath, Link(name, cid, tsize))
+                filecids.append(FileCID(hash=cid_str(cid), name=relpath, tsize=tsize))
+        root, _ = put_tree(car, tree)
+        car.close(root)
+    return cid_str(root), filecids
+
+# done.
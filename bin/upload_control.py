@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-04-07
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/upload_control.py
+
+"""how many `w3 up`s run at once, how fast, and how long to wait after one
+fails.
+
+The daemon starts --upload-workers upload threads, but each has to take a
+slot here first. With --adaptive the number of slots is set AIMD-style,
+like TCP's window: every few uploads the throughput over the whole
+process is measured; if it went up since the last step there's headroom
+and a slot is added, if it went down one is taken away, and any failure
+halves the slots (at most once per cooldown, so one bad minute isn't
+counted five times). Without --adaptive the slots stay at
+--upload-workers.
+
+--max-upload-mbps paces the starts of uploads so that the bytes started
+average under the cap; w3 up is a subprocess, so this is as close as we
+get to shaping the link. The cap is per process: run one daemon with more
+upload workers rather than several processes.
+
+A failed `w3 up` is retried after a jittered exponential backoff, and
+gives its slot back while it waits."""
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger("main")
+MB = 1024 * 1024
+
+
+class UploadController:
+    def __init__(
+        self,
+        max_slots: int,
+        adaptive: bool = False,
+        max_mbps: float = 0,
+        retries: int = 2,
+        backoff: float = 10.0,
+        max_backoff: float = 300.0,
+    ):
+        self.max_slots = max(1, max_slots)
+        self.min_slots = 1 if adaptive else self.max_slots
+        self.adaptive = adaptive
+        self.slots = float(self.min_slots)
+        self.rate = max_mbps * MB
+        self.retries = retries
+        self.backoff_secs = backoff
+        self.max_backoff = max_backoff
+        self.cond = threading.Condition()
+        self.inflight = 0
+        self.next_start = 0.0  # when the bandwidth cap lets the next one go
+        # the current measurement: uploads finished, bytes, failures, since t0
+        self.t0 = time.monotonic()
+        self.n = self.nbytes = self.nfailed = 0
+        self.last_rate = None
+        self.last_cut = 0.0
+        self.cooldown = 60.0
+
+    @property
+    def limit(self) -> int:
+        return int(self.slots)
+
+    def acquire(self, nbytes: int) -> None:
+        """wait for a slot, then for the bandwidth cap"""
+        with self.cond:
+            while self.inflight >= self.limit:
+                self.cond.wait()
+            self.inflight += 1
+            wait = 0.0
+            if self.rate > 0:
+                now = time.monotonic()
+                start = max(now, self.next_start)
+                self.next_start = start + nbytes / self.rate
+                wait = start - now
+        if wait > 0:
+            logger.debug(f"upload paced {wait:.1f}s by --max-upload-mbps")
+            time.sleep(wait)
+
+    def release(self) -> None:
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+
+    def succeeded(self, nbytes: int, secs: float) -> None:
+        with self.cond:
+            self.n += 1
+            self.nbytes += nbytes
+            # a cut is stale once an upload that started after it finishes
+            self.cooldown = max(10.0, secs)
+            if self.n >= max(2, self.limit):
+                self._step()
+
+    def failed(self) -> None:
+        with self.cond:
+            self.n += 1
+            self.nfailed += 1
+            now = time.monotonic()
+            if self.adaptive and now - self.last_cut > self.cooldown:
+                self._set(self.slots / 2, "an upload failed")
+                self.last_cut = now
+                self._restart()
+
+    def _step(self) -> None:
+        """additive increase while the throughput grows"""
+        rate = self.nbytes / max(time.monotonic() - self.t0, 1e-6)
+        if self.adaptive and self.nfailed == 0:
+            if self.last_rate is None or rate > self.last_rate * 1.05:
+                self._set(self.slots + 1, f"{rate / MB:.1f}MB/s, up")
+            elif rate < self.last_rate * 0.95:
+                self._set(self.slots - 1, f"{rate / MB:.1f}MB/s, down")
+        self.last_rate = rate
+        self._restart()
+
+    def _restart(self) -> None:
+        self.t0 = time.monotonic()
+        self.n = self.nbytes = self.nfailed = 0
+
+    def _set(self, slots: float, why: str) -> None:
+        old = self.limit
+        self.slots = min(self.max_slots, max(self.min_slots, slots))
+        if self.limit != old:
+            logger.info(f"upload slots {old} -> {self.limit}: {why}")
+            self.cond.notify_all()
+
+    def backoff(self, attempt: int) -> float:
+        """seconds to wait before retry `attempt` (1, 2, ...)"""
+        secs = min(self.max_backoff, self.backoff_secs * 2 ** (attempt - 1))
+        return secs * random.uniform(0.5, 1.5)
+
+# done.
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Author: Patrick Ball <pball@hrdag.org>
+# Maintainer: Patrick Ball <pball@hrdag.org>
+# Date: 2025-03-31
+# Copyright: HRDAG, GPL-2 or newer
+#
+# trove-to-ipfs/bin/verify_car.py
+
+"""check a car against what went into it, locally, by CID.
+
+test_car() downloaded one file from one carblock in ten and compared it
+byte for byte. This checks every file, without the network:
+
+  - every block in the .car hashes to its CID;
+  - the car's root is the CID we uploaded (w3 up returns it in car_url);
+  - walking the directory from that root (HAMT shards and nested subdirs
+    too) gives exactly the expected car_paths, each with the expected CID,
+    and every block each file needs is in the car;
+  - with the staged .gz files, their CIDs are recomputed from the files
+    themselves, independently of the packer.
+
+Then, for a sample, the file is fetched back through a gateway and its
+CID is computed as the bytes stream in, so nothing is written to disk or
+held whole. Point --gateway at bin/stand-in-gateway.py to test offline."""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from pathlib import Path
+import random
+from typing import Dict, List, Tuple
+
+# --- in this repo
+import resolve_dir
+import unixfs
+
+logger = logging.getLogger("main")
+
+
+class VerifyError(Exception):
+    """the car isn't what was staged, or a fetched file isn't what's in it"""
+
+
+def scan_car(carpth: Path) -> Tuple[List[str], set, dict]:
+    """(roots, every CID in the car, the dag-pb blocks by CID), with every
+    block checked against its CID. Raw leaves are hashed and dropped, so
+    only the (small) directory and file nodes are held in memory."""
+    have = set()
+    nodes = {}
+    with open(carpth, "rb") as f:
+        roots = [unixfs.cid_str(r) for r in unixfs.car_roots(f)]
+    with open(carpth, "rb") as f:
+        for cid, block in unixfs.iter_car(f):
+            cid = unixfs.cid_str(cid)
+            try:
+                resolve_dir.verify_block(cid, block)
+            except resolve_dir.BlockError as err:
+                raise VerifyError(str(err))
+            have.add(cid)
+            if unixfs.cid_codec(unixfs.cid_bytes(cid)) == unixfs.CODEC_DAG_PB:
+                nodes[cid] = block
+    return roots, have, nodes
+
+
+def _missing_blocks(store, have: set, cid: str) -> List[str]:
+    """blocks under a file that aren't in the car"""
+    if cid not in have:
+        return [cid]
+    if unixfs.cid_codec(unixfs.cid_bytes(cid)) == unixfs.CODEC_RAW:
+        return []
+    links, _ = resolve_dir._node(store, cid)
+    out = []
+    for lk in links:
+        out.extend(_missing_blocks(store, have, unixfs.cid_str(lk.cid)))
+    return out
+
+
+def car_listing(carpth: Path, car_cid: str) -> Dict[str, str]:
+    """car_path -> file CID, walked from the root in the car itself"""
+    roots, have, nodes = scan_car(carpth)
+    if roots != [car_cid]:
+        raise VerifyError(f"{carpth} has roots {roots}, expected {car_cid}")
+    store = resolve_dir.BlockStore(None, nodes.__getitem__)
+    try:
+        entries = resolve_dir.walk_dir(store, car_cid)
+    except (KeyError, resolve_dir.BlockError) as err:
+        raise VerifyError(f"{carpth}: directory incomplete: {err!r}")
+    for e in entries:
+        missing = _missing_blocks(store, have, e.hash)
+        if missing:
+            raise VerifyError(f"{e.name} ({e.hash}) is missing {len(missing)} blocks")
+    return {e.name: e.hash for e in entries}
+
+
+def staged_cids(cardir: Path, car_paths: List[str], workers: int = 1) -> dict:
+    """car_path -> CID recomputed from the staged .gz under cardir"""
+
+    def one(rel: str) -> str:
+        with open(cardir / rel, "rb") as f:
+            return unixfs.file_cid(f)[0]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(zip(car_paths, pool.map(one, car_paths)))
+
+
+def compare(expected: Dict[str, str], listing: Dict[str, str]) -> None:
+    """raises with a summary unless the listing is exactly what's expected"""
+    missing = expected.keys() - listing.keys()
+    extra = listing.keys() - expected.keys()
+    wrong = [p for p in expected.keys() & listing.keys() if expected[p] != listing[p]]
+    if missing or extra or wrong:
+        some = sorted(missing)[:3] + sorted(extra)[:3] + sorted(wrong)[:3]
+        raise VerifyError(
+            f"{len(missing)} files missing from the car, {len(extra)} extra, "
+            f"{len(wrong)} with the wrong CID, e.g. {some}"
+        )
+
+
+def verify_local(
+    carpth: Path,
+    car_cid: str,
+    expected: Dict[str, str] | None = None,
+    cardir: Path | None = None,
+    workers: int = 1,
+) -> Dict[str, str]:
+    """check the car against the packer's CIDs (expected, car_path -> CID)
+    and/or the staged files in cardir; returns the car's listing"""
+    listing = car_listing(carpth, car_cid)
+    if expected is not None:
+        compare(expected, listing)
+    if cardir is not None:
+        rels = [str(p.relative_to(cardir)) for p in cardir.rglob("*") if p.is_file()]
+        compare(staged_cids(cardir, rels, workers), listing)
+    return listing
+
+
+def stream_cid(url: str, timeout: int = 300) -> Tuple[str, int]:
+    """the CID of what url returns, computed while it downloads"""
+    import requests  # only needed for the sample
+
+    builder = unixfs.FileBuilder(unixfs.NullCar())
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        if response.status_code != 200:
+            raise VerifyError(f"{url} returned {response.status_code}")
+        for chunk in response.iter_content(chunk_size=unixfs.CHUNK_SIZE):
+            builder.write(chunk)
+    cid, tsize = builder.close()
+    return unixfs.cid_str(cid), tsize
+
+
+def verify_sample(
+    gateway: str, car_cid: str, listing: Dict[str, str], k: int = 1
+) -> int:
+    """fetch k random files through the gateway and check their CIDs"""
+    paths = random.sample(sorted(listing), min(k, len(listing)))
+    for car_path in paths:
+        cid, _ = stream_cid(f"{gateway}/ipfs/{car_cid}/{car_path}")
+        if cid != listing[car_path]:
+            raise VerifyError(
+                f"{car_path} from {gateway} has cid={cid}, car has {listing[car_path]}"
+            )
+    return len(paths)
+
+
+def getargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="verify a car by CID")
+    parser.add_argument("car", help="the .car file")
+    parser.add_argument("-d", "--cardir", help="the staged dir it was packed from")
+    parser.add_argument("-r", "--root", help="the root CID it should have")
+    parser.add_argument("-g", "--gateway", help="also fetch a sample through this")
+    parser.add_argument("-k", "--sample", default=1, type=int)
+    parser.add_argument("-j", "--jobs", default=4, type=int)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = getargs()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s[%(levelname)s]: %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+    )
+    carpth = Path(args.car)
+    if args.root is None:
+        with open(carpth, "rb") as f:
+            args.root = unixfs.cid_str(unixfs.car_roots(f)[0])
+    cardir = None if args.cardir is None else Path(args.cardir)
+    listing = verify_local(carpth, args.root, cardir=cardir, workers=args.jobs)
+    logger.info(f"{carpth}: {len(listing)} files OK under {args.root}")
+    if args.gateway:
+        n = verify_sample(args.gateway, args.root, listing, args.sample)
+        logger.info(f"{n} files fetched through {args.gateway} match")
+
+# done.
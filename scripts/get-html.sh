@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# superseded by bin/fetch_meta.py -k html, which retries, resumes, checks
+# that each listing is complete, and keeps a ledger of what is done.
+
 # precede by
 # psql -U $USER -d $DB  -c "select distinct car_url from fs where tsize is NULL;" > car_did_missed.txt
 
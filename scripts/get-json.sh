@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# superseded by bin/fetch_meta.py -k json, which retries, resumes, checks
+# that each listing is complete, and keeps a ledger of what is done.
+
 # precede with "w3 ls > car_did.txt"
 
 my_func() {